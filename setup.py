@@ -41,6 +41,7 @@ setup(name='tilequeue',
           'Jinja2',
           'mapbox-vector-tile',
           'ModestMaps',
+          'numpy',
           'protobuf',
           'psycopg2',
           'pyproj',
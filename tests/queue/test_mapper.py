@@ -149,6 +149,7 @@ class MultipleQueueMapperTest(unittest.TestCase):
     def test_toi_priority(self):
         from tilequeue.queue.mapper import ZoomRangeAndZoomGroupQueueMapper
         from tilequeue.queue.mapper import ZoomRangeQueueSpec
+        from tilequeue.tile import coord_marshall_int
         from tilequeue.tile import create_coord
 
         specs = [
@@ -166,10 +167,114 @@ class MultipleQueueMapperTest(unittest.TestCase):
             def fetch_tiles_of_interest(self):
                 return self.toi
 
-        toi = FakeToi(set([coord_in_toi]))
+        toi = FakeToi(set([coord_marshall_int(coord_in_toi)]))
         mapper = ZoomRangeAndZoomGroupQueueMapper(specs, toi=toi)
 
         for coord in (coord_in_toi, coord_not_in_toi):
             group = list(mapper.group([coord]))
             self.assertEquals(1, len(group))
             self.assertEquals(coord == coord_in_toi, group[0].queue_id == 0)
+
+        for coord in (coord_in_toi, coord_not_in_toi):
+            group = list(mapper.group_coord_ints(
+                [coord_marshall_int(coord)]))
+            self.assertEquals(1, len(group))
+            self.assertEquals(coord == coord_in_toi, group[0].queue_id == 0)
+
+    def test_group_coord_ints_matches_group(self):
+        from tilequeue.tile import coord_marshall_int
+        from tilequeue.tile import deserialize_coord
+        specs = (
+            (None, None, 'tile_queue_0', object(), None),
+            (0, 10, 'tile_queue_1', object(), None),
+            (10, 16, 'tile_queue_2', object(), 10),
+        )
+        qm = self.make_queue_mapper(specs)
+        coord_strs = (
+            '1/1/1',
+            '9/0/0',
+            '10/0/0',
+            '14/65536/65536',
+            '15/0/0',
+            '15/32767/32767',
+            '15/32768/32767',
+            '20/0/0',
+        )
+        coords = map(deserialize_coord, coord_strs)
+
+        def _key(coord_groups):
+            return sorted(
+                (cg.queue_id, sorted(map(coord_marshall_int, cg.coords)))
+                for cg in coord_groups)
+
+        expected = _key(qm.group(coords))
+        actual = _key(qm.group_coord_ints(map(coord_marshall_int, coords)))
+        self.assertEquals(expected, actual)
+
+    def test_refresh_toi(self):
+        from tilequeue.queue.mapper import ZoomRangeAndZoomGroupQueueMapper
+        from tilequeue.queue.mapper import ZoomRangeQueueSpec
+        from tilequeue.tile import coord_marshall_int
+        from tilequeue.tile import create_coord
+
+        specs = [
+            ZoomRangeQueueSpec(0, 10, 'q1', object(), None, in_toi=True),
+            ZoomRangeQueueSpec(0, 10, 'q2', object(), None, in_toi=False),
+        ]
+        coord = create_coord(1, 1, 1)
+        coord_int = coord_marshall_int(coord)
+
+        class FakeToi(object):
+            def __init__(self):
+                self.toi = set()
+                self.version = 0
+                self.n_fetches = 0
+
+            def fetch_tiles_of_interest_if_changed(self, version):
+                if version == self.version:
+                    return None, version
+                self.n_fetches += 1
+                return set(self.toi), self.version
+
+        toi = FakeToi()
+        toi.version = 1
+        mapper = ZoomRangeAndZoomGroupQueueMapper(specs, toi=toi)
+        self.assertEquals(1, toi.n_fetches)
+        self.assertEquals(1, list(mapper.group([coord]))[0].queue_id)
+        self.assertEquals(
+            1, list(mapper.group_coord_ints([coord_int]))[0].queue_id)
+
+        # unchanged, so nothing is fetched
+        self.assertFalse(mapper.refresh_toi())
+        self.assertEquals(1, toi.n_fetches)
+
+        toi.toi.add(coord_int)
+        toi.version = 2
+        self.assertTrue(mapper.refresh_toi())
+        self.assertEquals(2, toi.n_fetches)
+        self.assertEquals(0, list(mapper.group([coord]))[0].queue_id)
+        self.assertEquals(
+            0, list(mapper.group_coord_ints([coord_int]))[0].queue_id)
+
+    def test_stop_toi_refresh(self):
+        from tilequeue.queue.mapper import ZoomRangeAndZoomGroupQueueMapper
+        from tilequeue.queue.mapper import ZoomRangeQueueSpec
+        import threading
+
+        specs = [
+            ZoomRangeQueueSpec(0, 10, 'q1', object(), None, in_toi=True),
+        ]
+        fetched = threading.Event()
+
+        class FakeToi(object):
+            def fetch_tiles_of_interest_if_changed(self, version):
+                if version is not None:
+                    fetched.set()
+                return set(), 1
+
+        mapper = ZoomRangeAndZoomGroupQueueMapper(
+            specs, toi=FakeToi(), toi_refresh_interval_secs=0.01)
+        self.assertTrue(fetched.wait(5))
+        mapper.stop_toi_refresh()
+        mapper.toi_refresh_thread.join(5)
+        self.assertFalse(mapper.toi_refresh_thread.is_alive())
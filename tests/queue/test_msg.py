@@ -158,3 +158,106 @@ class MultipleMessageTrackerTest(unittest.TestCase):
 
         with self.assertRaises(AssertionError):
             self.tracker.track(queue_handle, coords, parent_tile)
+
+    def test_track_full_pyramid(self):
+        from tilequeue.tile import coord_children_subrange
+        from tilequeue.tile import deserialize_coord
+        from tilequeue.queue.message import QueueHandle
+        queue_handle = QueueHandle(1, 'handle')
+        parent_tile = deserialize_coord('10/163/395')
+        coords = list(coord_children_subrange(parent_tile, 10, 13))
+        self._assert_track_done(coords, queue_handle, parent_tile)
+
+    def test_done_unknown_coord(self):
+        from tilequeue.tile import deserialize_coord
+        from tilequeue.queue.message import QueueHandle
+        queue_handle = QueueHandle(1, 'handle')
+        coords = map(deserialize_coord, ('2/2/3', '2/2/2'))
+        parent_tile = deserialize_coord('1/1/1')
+        self.tracker.track(queue_handle, coords, parent_tile)
+        for coord_id in ((2, 3, 3), (2, 0, 0)):
+            track_result = self.tracker.done((coord_id, 'handle'))
+            self.assertFalse(track_result.all_done)
+        self.assertEqual(
+            2, self.tracker.msg_tracker_logger.unknown_coord_id.call_count)
+        self.assertEqual((1, 2), self.tracker.sizes())
+
+    def test_purge_expired(self):
+        from mock import MagicMock
+        from tilequeue.tile import deserialize_coord
+        from tilequeue.queue.message import QueueHandle
+        stats_handler = MagicMock()
+        self.tracker.stats_handler = stats_handler
+        coords = map(deserialize_coord, ('2/2/3', '2/2/2'))
+        parent_tile = deserialize_coord('1/1/1')
+        coord_handles = self.tracker.track(
+            QueueHandle(1, 'old'), coords, parent_tile)
+        self.tracker.track(QueueHandle(1, 'new'), coords, parent_tile)
+        self.tracker.tracked['old'].last_active -= self.tracker.expire_secs
+
+        n_expired = self.tracker.purge()
+        self.assertEqual(1, n_expired)
+        self.assertEqual((1, 2), self.tracker.sizes())
+        stats_handler.tracked_messages.assert_called_once_with(1, 2, 1)
+
+        track_result = self.tracker.done(coord_handles[0])
+        self.assertIsNone(track_result.queue_handle)
+        self.tracker.msg_tracker_logger.unknown_queue_handle_id.\
+            assert_called_once_with((2, 2, 3), 'old')
+
+
+class PyramidMarshallerTest(unittest.TestCase):
+
+    def setUp(self):
+        from tilequeue.queue.message import PyramidMarshaller
+        self.msg_marshaller = PyramidMarshaller()
+
+    def _assert_roundtrip(self, coords):
+        payload = self.msg_marshaller.marshall(coords)
+        actual = list(self.msg_marshaller.unmarshall(payload))
+        self.assertEqual(len(coords), len(actual))
+        self.assertEqual(set(coords), set(actual))
+        return payload
+
+    def test_marshall_empty_list(self):
+        actual = self.msg_marshaller.marshall([])
+        self.assertEqual('', actual)
+        self.assertEqual([], list(self.msg_marshaller.unmarshall('')))
+
+    def test_single_coord(self):
+        from tilequeue.tile import deserialize_coord
+        self._assert_roundtrip([deserialize_coord('10/163/395')])
+
+    def test_full_pyramid_is_small(self):
+        from tilequeue.tile import coord_children_subrange
+        from tilequeue.tile import deserialize_coord
+        parent = deserialize_coord('10/163/395')
+        coords = list(coord_children_subrange(parent, 10, 16))
+        payload = self._assert_roundtrip(coords)
+        self.assertTrue(len(payload) < 32)
+
+    def test_sparse_pyramid(self):
+        from tilequeue.tile import deserialize_coord
+        coords = map(deserialize_coord, (
+            '11/327/791', '12/655/1582', '16/10485/25325', '16/10490/25330'))
+        self._assert_roundtrip(coords)
+
+    def test_dense_level(self):
+        from tilequeue.tile import coord_children_subrange
+        from tilequeue.tile import deserialize_coord
+        parent = deserialize_coord('10/163/395')
+        coords = list(coord_children_subrange(parent, 13, 13))[::2]
+        self._assert_roundtrip(coords)
+
+    def test_siblings_use_common_parent(self):
+        from tilequeue.tile import deserialize_coord
+        coords = map(deserialize_coord, ('1/0/0', '1/1/1'))
+        self._assert_roundtrip(coords)
+
+    def test_unmarshall_is_lazy(self):
+        import types
+        from tilequeue.tile import deserialize_coord
+        payload = self.msg_marshaller.marshall(
+            [deserialize_coord('1/1/1')])
+        coords = self.msg_marshaller.unmarshall(payload)
+        self.assertIsInstance(coords, types.GeneratorType)
@@ -0,0 +1,84 @@
+import unittest
+
+
+class ReliableRedisQueueTest(unittest.TestCase):
+
+    def setUp(self):
+        from mock import MagicMock
+        from tilequeue.queue.redis_queue import ReliableRedisQueue
+        self.redis_client = MagicMock()
+        # a separate mock for each script
+        self.redis_client.register_script.side_effect = \
+            lambda script: MagicMock()
+        self.pipe = self.redis_client.pipeline.return_value.__enter__.\
+            return_value
+        self.queue = ReliableRedisQueue(
+            self.redis_client, 'queue', 3, 20, 3600, 60)
+
+    def test_enqueue_batch_encodes_unique_handles(self):
+        from tilequeue.queue.redis_queue import _decode_message
+        self.queue.enqueue_batch(['1/1/1', '1/1/1'])
+        args, _ = self.redis_client.lpush.call_args
+        key, v1, v2 = args
+        self.assertEqual('queue', key)
+        self.assertNotEqual(v1, v2)
+        payload, timestamp = _decode_message(v1)
+        self.assertEqual('1/1/1', payload)
+        self.assertIsNotNone(timestamp)
+
+    def test_read_empty_blocks_instead_of_sleeping(self):
+        self.redis_client.brpoplpush.return_value = None
+        msg_handles = self.queue.read()
+        self.assertEqual([], msg_handles)
+        self.redis_client.brpoplpush.assert_called_with(
+            'queue', 'queue.processing', timeout=20)
+        self.redis_client.hmset.assert_not_called()
+
+    def test_read_moves_to_processing_with_deadline(self):
+        from tilequeue.queue.redis_queue import _encode_message
+        v1 = _encode_message('1/1/1')
+        v2 = _encode_message('2/2/2')
+        self.redis_client.brpoplpush.return_value = v1
+        self.pipe.execute.return_value = [v2, None]
+        msg_handles = self.queue.read()
+        self.assertEqual(2, len(msg_handles))
+        self.assertEqual(v1, msg_handles[0].handle)
+        self.assertEqual('1/1/1', msg_handles[0].payload)
+        self.assertEqual('2/2/2', msg_handles[1].payload)
+        self.assertEqual(2, self.pipe.rpoplpush.call_count)
+        args, _ = self.redis_client.hmset.call_args
+        key, deadlines = args
+        self.assertEqual('queue.deadlines', key)
+        self.assertEqual(set([v1, v2]), set(deadlines.keys()))
+
+    def test_read_reaps_periodically(self):
+        self.redis_client.brpoplpush.return_value = None
+        self.queue.read()
+        self.queue.read()
+        self.assertEqual(1, self.queue.reap_script.call_count)
+        self.queue.last_reap -= 60
+        self.queue.read()
+        self.assertEqual(2, self.queue.reap_script.call_count)
+        _, kwargs = self.queue.reap_script.call_args
+        self.assertEqual(
+            ['queue', 'queue.processing', 'queue.deadlines'], kwargs['keys'])
+
+    def test_job_done_removes_from_processing(self):
+        self.queue.job_done('handle')
+        self.pipe.lrem.assert_called_with('queue.processing', 1, 'handle')
+        self.pipe.hdel.assert_called_with('queue.deadlines', 'handle')
+
+    def test_job_progress_extends_deadline(self):
+        self.queue.progress_script.return_value = 1
+        self.assertTrue(self.queue.job_progress('handle'))
+        _, kwargs = self.queue.progress_script.call_args
+        self.assertEqual(['queue.processing', 'queue.deadlines'],
+                         kwargs['keys'])
+        self.assertEqual('handle', kwargs['args'][0])
+
+    def test_job_progress_after_reap(self):
+        # the message was requeued, so the script finds it isn't in the
+        # processing list any more, and doesn't leave a deadline behind
+        self.queue.progress_script.return_value = 0
+        self.assertFalse(self.queue.job_progress('handle'))
+        self.redis_client.hset.assert_not_called()
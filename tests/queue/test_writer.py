@@ -26,3 +26,15 @@ class QueueWriterTest(unittest.TestCase):
         n_enqueued, n_inflight = queue_writer.enqueue_batch(coords)
         self.assertEquals(2, n_enqueued)
         self.assertEquals(0, n_inflight)
+
+    def test_write_coord_ints(self):
+        from tilequeue.tile import coord_marshall_int
+        from tilequeue.tile import deserialize_coord
+        coords = [deserialize_coord('1/1/1'), deserialize_coord('15/1/1')]
+        queue_writer = self.make_queue_writer()
+        n_enqueued, n_inflight = queue_writer.enqueue_coord_ints(
+            map(coord_marshall_int, coords))
+        self.assertEquals(2, n_enqueued)
+        self.assertEquals(0, n_inflight)
+        queue = queue_writer.queue_mapper.get_queue('queue_name')
+        queue.enqueue_batch.assert_called_once_with(['1/1/1', '15/1/1'])
@@ -61,6 +61,30 @@ class TestUniquifyGenerator(unittest.TestCase):
         self.assertEqual(0, metrics['misses'])
         self.assertEqual(4, metrics['total'])
 
+    def test_tilequeue_explode_and_intersect_sorted_array(self):
+        import numpy as np
+        from tilequeue.command import explode_and_intersect
+        from tilequeue.tile import coord_marshall_int
+        from ModestMaps.Core import Coordinate
+        parent = Coordinate(zoom=10, column=250, row=250)
+        child = Coordinate(zoom=11, column=500, row=500)
+        other = Coordinate(zoom=11, column=0, row=0)
+        toi = np.array(sorted(
+            [coord_marshall_int(parent), coord_marshall_int(other)]))
+        # the parent is reached both directly and from the child, and
+        # is counted each time. the child and the parents of other
+        # are misses.
+        exploded, metrics = explode_and_intersect(
+            map(coord_marshall_int, [child, parent, other]), toi, until=10)
+        self.assertEqual(
+            sorted([coord_marshall_int(parent)] * 2 +
+                   [coord_marshall_int(other)]),
+            sorted(exploded))
+        self.assertEqual(3, metrics['hits'])
+        self.assertEqual(2, metrics['misses'])
+        self.assertEqual(5, metrics['total'])
+        self.assertEqual(2, metrics['n_toi'])
+
 
 class ZoomToQueueNameMapTest(unittest.TestCase):
 
@@ -142,3 +166,95 @@ class ZoomToQueueNameMapTest(unittest.TestCase):
         zoom = long(7)
         queue_name = get_queue(zoom)
         self.assertEqual(queue_name, 'q1')
+
+
+class EmitToiStatsTest(unittest.TestCase):
+
+    def _call_fut(self, toi):
+        from tilequeue.command import emit_toi_stats
+
+        class FakeStats(object):
+            def __init__(self):
+                self.gauges = {}
+
+            def gauge(self, name, value):
+                self.gauges[name] = value
+
+        class FakePeripherals(object):
+            stats = FakeStats()
+
+        peripherals = FakePeripherals()
+        emit_toi_stats(toi, peripherals)
+        return peripherals.stats.gauges
+
+    def test_set_and_array_match(self):
+        import numpy as np
+        from ModestMaps.Core import Coordinate
+        from tilequeue.tile import coord_marshall_int
+        toi = set([
+            coord_marshall_int(Coordinate(zoom=0, column=0, row=0)),
+            coord_marshall_int(Coordinate(zoom=2, column=1, row=1)),
+            coord_marshall_int(Coordinate(zoom=2, column=3, row=1)),
+        ])
+        exp = {
+            'tiles-of-interest.count': 3,
+            'tiles-of-interest.by-zoom.z00': 1,
+            'tiles-of-interest.by-zoom.z02': 2,
+        }
+        self.assertEqual(exp, self._call_fut(toi))
+        toi_array = np.array(sorted(toi), dtype=np.int64)
+        self.assertEqual(exp, self._call_fut(toi_array))
+
+
+class TopRequestedTilesTest(unittest.TestCase):
+
+    def _call_fut(self, rows, min_requests, max_tiles):
+        from tilequeue.command import top_requested_tiles
+
+        class FakeLogger(object):
+            def __init__(self):
+                self.warnings = []
+
+            def warning(self, msg):
+                self.warnings.append(msg)
+
+        logger = FakeLogger()
+        top_tiles = top_requested_tiles(
+            iter(rows), min_requests, max_tiles, logger)
+        return top_tiles, logger.warnings
+
+    def test_keeps_most_requested(self):
+        from tilequeue.tile import coord_marshall_int
+        from tilequeue.tile import create_coord
+        rows = [
+            (1, 0, 0, None, 5),
+            (1, 1, 0, None, 50),
+            (1, 0, 1, None, 1),
+            (1, 1, 1, None, 20),
+            (None, None, None, '2048', 100),
+        ]
+        top_tiles, warnings = self._call_fut(rows, 2, 2)
+        self.assertEqual(
+            [(50, coord_marshall_int(create_coord(1, 0, 1))),
+             (20, coord_marshall_int(create_coord(1, 1, 1)))],
+            sorted(top_tiles, reverse=True))
+        self.assertEqual(1, len(warnings))
+
+    def test_no_tiles(self):
+        top_tiles, warnings = self._call_fut([(1, 0, 0, None, 5)], 0, 0)
+        self.assertEqual([], top_tiles)
+
+
+class TileTrafficQueryTest(unittest.TestCase):
+
+    def test_tile_sizes(self):
+        from tilequeue.command import tile_traffic_query
+        sql = tile_traffic_query(30, 16, 2)
+        # smaller tiles are offset to the metatile containing them
+        self.assertIn("when tilesize = '256' then 2", sql)
+        self.assertIn("when tilesize = '512' then 1", sql)
+        self.assertIn("when tilesize = '1024' then 0", sql)
+        self.assertNotIn("'2048'", sql)
+        self.assertIn("interval '30 days'", sql)
+        self.assertIn('between 0 and 16', sql)
+        self.assertNotIn('order by', sql)
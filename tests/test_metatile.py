@@ -110,6 +110,29 @@ class TestMetatile(unittest.TestCase):
         self.assertTrue(metatiles_are_equal(
             metatile_1[0]['tile'], metatile_2[0]['tile']))
 
+    def test_metatile_content_hash(self):
+        from time import gmtime, time
+        from tilequeue.metatile import metatile_content_hash
+
+        json = "{\"json\":true}"
+        tiles = [dict(tile=json, coord=Coordinate(0, 0, 0),
+                      format=json_format, layer='all')]
+        t = time()
+        metatile_1 = make_metatiles(1, tiles, gmtime(t - 10)[0:6])
+        metatile_2 = make_metatiles(1, tiles, gmtime(t)[0:6])
+        self.assertNotEqual(metatile_1[0]['tile'], metatile_2[0]['tile'])
+        self.assertEqual(metatile_content_hash(metatile_1[0]['tile']),
+                         metatile_content_hash(metatile_2[0]['tile']))
+
+        other_tiles = [dict(tile="{\"json\":false}",
+                            coord=Coordinate(0, 0, 0),
+                            format=json_format, layer='all')]
+        metatile_3 = make_metatiles(1, other_tiles)
+        self.assertNotEqual(metatile_content_hash(metatile_1[0]['tile']),
+                            metatile_content_hash(metatile_3[0]['tile']))
+
+        self.assertIsNone(metatile_content_hash('not a zip'))
+
     def test_metatile_common_parent(self):
         from tilequeue.metatile import common_parent
 
@@ -0,0 +1,252 @@
+import unittest
+
+
+class FakeRedis(object):
+
+    def __init__(self):
+        self.hashes = {}
+        self.values = {}
+
+    def get(self, key):
+        return self.values.get(key)
+
+    def incr(self, key):
+        self.values[key] = int(self.values.get(key, 0)) + 1
+        return self.values[key]
+
+    def hget(self, key, field):
+        return self.hashes.get(key, {}).get(field)
+
+    def hset(self, key, field, value):
+        self.hashes.setdefault(key, {})[field] = value
+
+    def expire(self, key, seconds):
+        pass
+
+    def delete(self, *keys):
+        for key in keys:
+            self.hashes.pop(key, None)
+
+    def pipeline(self):
+        return FakePipeline(self)
+
+
+class FakePipeline(object):
+
+    def __init__(self, redis):
+        self.redis = redis
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        return False
+
+    def __getattr__(self, name):
+        return getattr(self.redis, name)
+
+    def execute(self):
+        pass
+
+
+class QueryResultCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        import tempfile
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        import shutil
+        shutil.rmtree(self.tmp_dir)
+
+    def _make_cache(self, data_version='1', redis=None, disk_path=None):
+        from tilequeue.query.cache import DiskResultCache
+        from tilequeue.query.cache import QueryResultCache
+        from tilequeue.query.cache import RedisResultCache
+        disk = DiskResultCache(disk_path or self.tmp_dir, 1024 * 1024)
+        shared = None
+        if redis is not None:
+            shared = RedisResultCache(redis, 'test', 60, 1024 * 1024)
+        return QueryResultCache(8, 'templates', data_version, disk, shared)
+
+    def _fetcher(self, cache):
+        from tilequeue.query.cache import CachingDataFetcher
+        calls = []
+
+        def fetch(zoom, bounds):
+            calls.append((zoom, bounds))
+            return [dict(__id__=len(calls))]
+
+        return CachingDataFetcher(fetch, cache), calls
+
+    def test_bounds_coord(self):
+        from ModestMaps.Core import Coordinate
+        from tilequeue.query.cache import bounds_coord
+        from tilequeue.tile import coord_to_mercator_bounds
+        coord = Coordinate(zoom=3, column=5, row=2)
+        self.assertEqual(coord, bounds_coord(coord_to_mercator_bounds(coord)))
+
+    def test_cached_low_zoom(self):
+        from ModestMaps.Core import Coordinate
+        from tilequeue.tile import coord_to_mercator_bounds
+        fetcher, calls = self._fetcher(self._make_cache())
+        bounds = coord_to_mercator_bounds(Coordinate(zoom=2, column=1, row=1))
+        self.assertEqual([dict(__id__=1)], fetcher(4, bounds))
+        self.assertEqual([dict(__id__=1)], fetcher(4, bounds))
+        self.assertEqual(1, len(calls))
+
+        # high zooms aren't cached
+        fetcher(9, bounds)
+        fetcher(9, bounds)
+        self.assertEqual(3, len(calls))
+
+    def test_data_version(self):
+        from ModestMaps.Core import Coordinate
+        from tilequeue.tile import coord_to_mercator_bounds
+        bounds = coord_to_mercator_bounds(Coordinate(zoom=2, column=1, row=1))
+        fetcher, calls = self._fetcher(self._make_cache('1'))
+        fetcher(4, bounds)
+        fetcher, calls = self._fetcher(self._make_cache('2'))
+        fetcher(4, bounds)
+        self.assertEqual(1, len(calls))
+
+    def test_invalidate(self):
+        from ModestMaps.Core import Coordinate
+        from tilequeue.tile import coord_to_mercator_bounds
+        cache = self._make_cache(redis=FakeRedis())
+        fetcher, calls = self._fetcher(cache)
+        inside = coord_to_mercator_bounds(Coordinate(zoom=2, column=1, row=1))
+        outside = coord_to_mercator_bounds(
+            Coordinate(zoom=2, column=3, row=3))
+        fetcher(4, inside)
+        fetcher(4, outside)
+
+        # z14 tile inside the first tile, parents z0 - z8 are invalidated
+        n = cache.invalidate([Coordinate(zoom=14, column=4096, row=4096)])
+        self.assertEqual(9, n)
+
+        fetcher(4, inside)
+        fetcher(4, outside)
+        self.assertEqual(3, len(calls))
+
+    def test_invalidate_other_machines(self):
+        from ModestMaps.Core import Coordinate
+        from tilequeue.tile import coord_to_mercator_bounds
+        import os
+        redis = FakeRedis()
+        bounds = coord_to_mercator_bounds(Coordinate(zoom=2, column=1, row=1))
+        fetcher, calls = self._fetcher(self._make_cache(redis=redis))
+        fetcher(4, bounds)
+
+        # the tile is expired by a machine with its own disk cache, which
+        # leaves the result on the first machine's disk.
+        other_cache = self._make_cache(
+            redis=redis, disk_path=os.path.join(self.tmp_dir, 'other'))
+        other_cache.invalidate([Coordinate(zoom=2, column=1, row=1)])
+        self.assertEqual([dict(__id__=2)], fetcher(4, bounds))
+        self.assertEqual([dict(__id__=2)], fetcher(4, bounds))
+        self.assertEqual(2, len(calls))
+
+    def test_invalidate_needs_redis(self):
+        from ModestMaps.Core import Coordinate
+        cache = self._make_cache()
+        with self.assertRaises(AssertionError):
+            cache.invalidate([Coordinate(zoom=2, column=1, row=1)])
+
+    def test_tier_errors_ignored(self):
+        from ModestMaps.Core import Coordinate
+        from tilequeue.tile import coord_to_mercator_bounds
+
+        class FullDisk(object):
+            def get(self, coord, key):
+                return None
+
+            def set(self, coord, key, data):
+                raise IOError('No space left on device')
+
+        class BrokenRedis(FakeRedis):
+            def hget(self, key, field):
+                raise Exception('connection refused')
+
+            def pipeline(self):
+                raise Exception('connection refused')
+
+        bounds = coord_to_mercator_bounds(Coordinate(zoom=2, column=1, row=1))
+        cache = self._make_cache(redis=FakeRedis())
+        cache.tiers[0] = FullDisk()
+        fetcher, calls = self._fetcher(cache)
+        self.assertEqual([dict(__id__=1)], fetcher(4, bounds))
+        # still cached in redis
+        self.assertEqual([dict(__id__=1)], fetcher(4, bounds))
+        self.assertEqual(1, len(calls))
+
+        # failed reads are misses, and failed writes are skipped
+        cache = self._make_cache(redis=BrokenRedis())
+        cache.tiers[0] = FullDisk()
+        fetcher, calls = self._fetcher(cache)
+        self.assertEqual([dict(__id__=1)], fetcher(4, bounds))
+        self.assertEqual([dict(__id__=2)], fetcher(4, bounds))
+
+    def test_generation_error_skips_cache(self):
+        from ModestMaps.Core import Coordinate
+        from tilequeue.tile import coord_to_mercator_bounds
+
+        class BrokenRedis(FakeRedis):
+            def get(self, key):
+                raise Exception('connection refused')
+
+        bounds = coord_to_mercator_bounds(Coordinate(zoom=2, column=1, row=1))
+        fetcher, calls = self._fetcher(self._make_cache(redis=FakeRedis()))
+        fetcher(4, bounds)
+
+        # the disk result can't be trusted without the generation
+        fetcher, calls = self._fetcher(
+            self._make_cache(redis=BrokenRedis()))
+        self.assertEqual([dict(__id__=1)], fetcher(4, bounds))
+        self.assertEqual(1, len(calls))
+
+    def test_redis_fills_disk(self):
+        from ModestMaps.Core import Coordinate
+        from tilequeue.tile import coord_to_mercator_bounds
+        import shutil
+        redis = FakeRedis()
+        bounds = coord_to_mercator_bounds(Coordinate(zoom=2, column=1, row=1))
+        fetcher, calls = self._fetcher(self._make_cache(redis=redis))
+        fetcher(4, bounds)
+
+        # another machine with an empty disk cache
+        shutil.rmtree(self.tmp_dir)
+        cache = self._make_cache(redis=redis)
+        fetcher, calls = self._fetcher(cache)
+        self.assertEqual([dict(__id__=1)], fetcher(4, bounds))
+        self.assertEqual(0, len(calls))
+        coord = Coordinate(zoom=2, column=1, row=1)
+        self.assertIsNotNone(cache.disk.get(coord, cache.key(4, bounds)))
+
+
+class DiskResultCacheTest(unittest.TestCase):
+
+    def test_evicts_least_recently_used(self):
+        from ModestMaps.Core import Coordinate
+        from tilequeue.query.cache import DiskResultCache
+        import os
+        import shutil
+        import tempfile
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            cache = DiskResultCache(tmp_dir, 250)
+            coord = Coordinate(zoom=1, column=0, row=0)
+            cache.set(coord, 'a', 'x' * 100)
+            cache.set(coord, 'b', 'x' * 100)
+            file_path = os.path.join(tmp_dir, '1', '0', '0')
+            os.utime(os.path.join(file_path, 'a'), (1, 1))
+            os.utime(os.path.join(file_path, 'b'), (2, 2))
+            # use 'a', so that 'b' is the least recently used
+            self.assertIsNotNone(cache.get(coord, 'a'))
+            cache.set(coord, 'c', 'x' * 100)
+            self.assertIsNone(cache.get(coord, 'b'))
+            self.assertIsNotNone(cache.get(coord, 'a'))
+            self.assertIsNotNone(cache.get(coord, 'c'))
+            self.assertEqual(200, cache.size_bytes)
+        finally:
+            shutil.rmtree(tmp_dir)
@@ -0,0 +1,234 @@
+import unittest
+
+
+class FakeCursor(object):
+
+    def __init__(self, conn):
+        self.conn = conn
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        return False
+
+    def execute(self, query):
+        if not self.conn.healthy:
+            raise Exception('connection is broken')
+
+
+class FakeConnection(object):
+
+    def __init__(self, dbname, host=None):
+        from psycopg2.extensions import TRANSACTION_STATUS_IDLE
+        self.dbname = dbname
+        self.host = host
+        self.closed = 0
+        self.healthy = True
+        self.transaction_status = TRANSACTION_STATUS_IDLE
+
+    def cursor(self):
+        return FakeCursor(self)
+
+    def get_transaction_status(self):
+        return self.transaction_status
+
+    def close(self):
+        self.closed = 1
+
+
+class DBConnectionPoolTest(unittest.TestCase):
+
+    def _make_pool(self, dbnames, **kwargs):
+        from tilequeue.query.pool import DBConnectionPool
+
+        made = []
+
+        class FakeConnectionPool(DBConnectionPool):
+            def _make_conn(self, conn_info):
+                if conn_info.get('host') in self.down_hosts:
+                    raise Exception('could not connect')
+                conn = FakeConnection(
+                    conn_info['dbname'], conn_info.get('host'))
+                made.append(conn)
+                return conn
+
+        FakeConnectionPool.down_hosts = set()
+
+        pool = FakeConnectionPool(dbnames, {}, **kwargs)
+        return pool, made
+
+    def test_reuses_connections(self):
+        pool, made = self._make_pool(['db1', 'db2'])
+        with pool.get_conns(2) as conns:
+            self.assertEqual(['db1', 'db2'], [c.dbname for c in conns])
+            first_conns = list(conns)
+        with pool.get_conns(2) as conns:
+            self.assertEqual(set(first_conns), set(conns))
+        self.assertEqual(2, len(made))
+        self.assertFalse(any(c.closed for c in made))
+
+        pool.close()
+        self.assertTrue(all(c.closed for c in made))
+
+    def test_closed_connection_replaced(self):
+        pool, made = self._make_pool(['db'])
+        with pool.get_conns(1) as conns:
+            # a failed query closes the connection
+            conns[0].close()
+        with pool.get_conns(1) as conns:
+            self.assertFalse(conns[0].closed)
+        self.assertEqual(2, len(made))
+        self.assertEqual(1, pool.n_open_conns[(None, 'db')])
+
+    def test_unhealthy_connection_replaced(self):
+        pool, made = self._make_pool(['db'], health_check_seconds=0)
+        with pool.get_conns(1) as conns:
+            conns[0].healthy = False
+        with pool.get_conns(1) as conns:
+            self.assertTrue(conns[0].healthy)
+        self.assertEqual(2, len(made))
+        self.assertTrue(made[0].closed)
+
+    def test_expired_connection_replaced(self):
+        pool, made = self._make_pool(['db'], max_lifetime_seconds=-1)
+        with pool.get_conns(1):
+            pass
+        self.assertTrue(made[0].closed)
+        self.assertEqual(0, pool.n_open_conns[(None, 'db')])
+
+    def test_max_size(self):
+        import threading
+        pool, made = self._make_pool(['db'], max_size=1)
+        got_conn = threading.Event()
+
+        def get_conn():
+            with pool.get_conns(1):
+                got_conn.set()
+
+        with pool.get_conns(1):
+            t = threading.Thread(target=get_conn)
+            t.start()
+            # the only connection is in use, so the thread has to wait
+            self.assertFalse(got_conn.wait(0.1))
+        t.join()
+        self.assertTrue(got_conn.is_set())
+        self.assertEqual(1, len(made))
+
+    def test_more_conns_than_max_size(self):
+        pool, made = self._make_pool(['db'], max_size=2)
+        with self.assertRaises(ValueError):
+            pool.get_conns(3)
+
+    def test_timeout(self):
+        from tilequeue.query.pool import ConnectionPoolTimeout
+        pool, made = self._make_pool(['db'], max_size=2)
+        with pool.get_conns(1):
+            # waiting for a set doesn't hold on to part of it
+            with self.assertRaises(ConnectionPoolTimeout):
+                pool.get_conns(2, timeout=0.05)
+            self.assertEqual(1, pool.n_open_conns[(None, 'db')])
+            with pool.get_conns(1):
+                pass
+        self.assertEqual(0, pool.targets[0].n_inflight)
+
+    def test_sets_taken_together(self):
+        import threading
+        pool, made = self._make_pool(['db'], max_size=2)
+        got_conns = []
+
+        def get_conns():
+            with pool.get_conns(2) as conns:
+                got_conns.append(conns)
+
+        # each thread needs both connections, and neither can take one
+        # and wait for the other.
+        threads = [threading.Thread(target=get_conns) for i in range(4)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join(5)
+        self.assertEqual(4, len(got_conns))
+        self.assertEqual(2, len(made))
+
+    def test_least_loaded_target(self):
+        pool, made = self._make_pool(['db1', 'db2'])
+        with pool.get_conns(2) as conns:
+            db1_conn, db2_conn = conns
+            pool.record_latency(db1_conn, 1.0)
+            pool.record_latency(db2_conn, 0.1)
+        # db2 is faster, so gets the queries until it's busy enough
+        with pool.get_conns(3) as conns:
+            self.assertEqual(['db2', 'db2', 'db2'],
+                             [c.dbname for c in conns])
+        with pool.get_conns(12) as conns:
+            dbnames = [c.dbname for c in conns]
+            self.assertEqual(1, dbnames.count('db1'))
+        self.assertEqual(0, sum(t.n_inflight for t in pool.targets))
+
+    def test_full_target_skipped(self):
+        pool, made = self._make_pool(['db1', 'db2'], max_size=1)
+        with pool.get_conns(2) as conns:
+            db1_conn, db2_conn = conns
+            pool.record_latency(db1_conn, 0.1)
+            pool.record_latency(db2_conn, 1.0)
+        with pool.get_conns(1) as conns:
+            self.assertEqual('db1', conns[0].dbname)
+            # db1 is faster, but full, so db2 is used without waiting
+            with pool.get_conns(1, timeout=0.05) as conns:
+                self.assertEqual('db2', conns[0].dbname)
+
+    def test_failed_target_ejected(self):
+        pool, made = self._make_pool(['db1', 'db2'], eject_seconds=60)
+        with pool.get_conns(1) as conns:
+            self.assertEqual('db1', conns[0].dbname)
+            pool.record_failure(conns[0])
+        with pool.get_conns(2) as conns:
+            self.assertEqual(['db2', 'db2'], [c.dbname for c in conns])
+
+        # unless every target has failed
+        with pool.get_conns(1) as conns:
+            pool.record_failure(conns[0])
+        with pool.get_conns(1) as conns:
+            self.assertEqual('db1', conns[0].dbname)
+
+    def test_multiple_hosts(self):
+        pool, made = self._make_pool(['db'], hosts=['h1', 'h2'])
+        pool.down_hosts.add('h1')
+        with pool.get_conns(2) as conns:
+            self.assertEqual(['h2', 'h2'], [c.host for c in conns])
+        self.assertEqual(0, pool.n_open_conns[('h1', 'db')])
+        self.assertGreater(pool.targets[0].ejected_until, 0)
+
+        # with no idle connections left, and no host up
+        pool.close()
+        pool.down_hosts.add('h2')
+        with self.assertRaises(Exception):
+            pool.get_conns(1)
+
+
+class MakeDBConnectionPoolTest(unittest.TestCase):
+
+    def test_pool_config(self):
+        from tilequeue.query.pool import make_db_connection_pool
+        conn_info = dict(
+            host='localhost', dbnames=['db1', 'db2'], user='osm',
+            pool={'max-size': 4, 'max-lifetime-seconds': 60})
+        pool = make_db_connection_pool(conn_info)
+        self.assertEqual(dict(host='localhost', user='osm'), pool.conn_info)
+        self.assertEqual(4, pool.max_size)
+        self.assertEqual(60, pool.max_lifetime_seconds)
+        self.assertEqual(30, pool.health_check_seconds)
+        self.assertEqual(set([('localhost', 'db1'), ('localhost', 'db2')]),
+                         set(pool.idle_conns))
+        # the original config isn't modified
+        self.assertIn('dbnames', conn_info)
+
+    def test_hosts(self):
+        from tilequeue.query.pool import make_db_connection_pool
+        conn_info = dict(host='localhost', hosts=['h1', 'h2'],
+                         dbnames=['db'], pool={'eject-seconds': 5})
+        pool = make_db_connection_pool(conn_info)
+        self.assertEqual(set([('h1', 'db'), ('h2', 'db')]),
+                         set(pool.idle_conns))
+        self.assertEqual(5, pool.eject_seconds)
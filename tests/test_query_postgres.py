@@ -0,0 +1,373 @@
+import unittest
+
+
+class PreparedSourcesQueriesGeneratorTest(unittest.TestCase):
+
+    def _make_generator(self, render):
+        from tilequeue.query.postgres import DataSource
+        from tilequeue.query.postgres import PreparedSourcesQueriesGenerator
+        from tilequeue.query.postgres import TemplateSpec
+
+        calls = []
+
+        def query_generator(template, bounds, zoom):
+            calls.append((template, zoom))
+            return render(template, bounds, zoom)
+
+        sources = [
+            DataSource('src1', [TemplateSpec('t1', 0, 10),
+                                TemplateSpec('t2', 5, 21)]),
+            DataSource('src2', [TemplateSpec('t3', 12, 21)]),
+        ]
+        generator = PreparedSourcesQueriesGenerator(sources, query_generator)
+        return generator, calls
+
+    def test_rendered_once_per_zoom(self):
+        from tilequeue.query.postgres import PreparedQuery
+        from tilequeue.query.postgres import jinja_filter_bbox
+
+        def render(template, bounds, zoom):
+            return 'SELECT %s, %d, %s' % (
+                template, zoom, jinja_filter_bbox(bounds))
+
+        generator, calls = self._make_generator(render)
+        bounds = (1.0, 2.0, 3.0, 4.0)
+        queries = generator(7, bounds)
+        self.assertEqual(1, len(queries))
+        self.assertEqual('src1', queries[0].source)
+        self.assertEqual(('t1', 't2'), queries[0].templates)
+        query = queries[0].query
+        self.assertIsInstance(query, PreparedQuery)
+        self.assertEqual(bounds, query.bounds)
+        self.assertIn('ST_MakePoint($1, $2)', query.sql)
+        self.assertIn('ST_MakePoint($3, $4)', query.sql)
+        self.assertIn('UNION ALL', query.sql)
+        self.assertEqual([('t1', 7), ('t2', 7)], calls)
+
+        other_bounds = (5.0, 6.0, 7.0, 8.0)
+        other_queries = generator(7, other_bounds)
+        self.assertEqual(query.name, other_queries[0].query.name)
+        self.assertEqual(other_bounds, other_queries[0].query.bounds)
+        # not rendered again
+        self.assertEqual(2, len(calls))
+
+        # different zoom, different query
+        queries = generator(12, bounds)
+        self.assertEqual(2, len(queries))
+        self.assertNotEqual(query.name, queries[0].query.name)
+
+    def test_fallback_when_template_needs_values(self):
+        from tilequeue.query.postgres import QueryParam
+
+        def render(template, bounds, zoom):
+            if isinstance(bounds[0], QueryParam):
+                raise TypeError('template uses the bounds values')
+            return 'SELECT %f' % bounds[0]
+
+        generator, calls = self._make_generator(render)
+        queries = generator(7, (1.0, 2.0, 3.0, 4.0))
+        self.assertEqual(['SELECT 1.000000\nUNION ALL\nSELECT 1.000000'],
+                         [q.query for q in queries])
+
+    def test_fallback_when_template_interpolates_bounds(self):
+        from jinja2 import DictLoader
+        from jinja2 import Environment
+        from tilequeue.query.postgres import TemplateFinder
+        from tilequeue.query.postgres import TemplateQueryGenerator
+
+        environment = Environment(loader=DictLoader({
+            't1': 'SELECT {{ bounds.polygon[0] }}',
+            't2': "SELECT '{{ bounds.polygon }}'",
+            't3': 'SELECT {{ "%f"|format(bounds.polygon[0]) }}',
+        }))
+        render = TemplateQueryGenerator(TemplateFinder(environment))
+        for template in ('t1', 't2', 't3'):
+            generator, calls = self._make_generator(
+                lambda t, bounds, zoom: render(template, bounds, zoom))
+            queries = generator(7, (1.0, 2.0, 3.0, 4.0))
+            # rendered for the tile, rather than prepared
+            self.assertIsInstance(queries[0].query, basestring)
+            self.assertIn('1.0', queries[0].query)
+
+
+class PaddedBoundsParamsTest(unittest.TestCase):
+
+    def test_matches_calculate_padded_bounds(self):
+        import re
+        from tilequeue.query.postgres import _padded_bounds_params
+        from tilequeue.query.postgres import bounds_params
+        from tilequeue.transform import calculate_padded_bounds
+
+        bounds = (-100.0, 50.0, 300.0, 250.0)
+        exp = calculate_padded_bounds(1.1, bounds).bounds
+        params = _padded_bounds_params(1.1, bounds_params)
+
+        def substitute(match):
+            return repr(bounds[int(match.group(1)) - 1])
+
+        act = [eval(re.sub(r'\$(\d)', substitute, p.sql)) for p in params]
+        for e, a in zip(exp, act):
+            self.assertAlmostEqual(e, a)
+
+
+class ReadRowsTest(unittest.TestCase):
+
+    def test_read_rows(self):
+        from psycopg2 import BINARY
+        from psycopg2 import NUMBER
+        from tilequeue.query.postgres import read_rows
+
+        class FakeCursor(object):
+            description = (
+                ('__id__', NUMBER.values[0]),
+                ('__geometry__', BINARY.values[0]),
+                ('__properties__', 0),
+            )
+
+            def __iter__(self):
+                return iter([
+                    (1, buffer('wkb1'), {'kind': 'a'}),
+                    (2, buffer('wkb2'), None),
+                ])
+
+        rows = read_rows(FakeCursor())
+        self.assertEqual([
+            dict(__id__=1, __geometry__='wkb1',
+                 __properties__={'kind': 'a'}),
+            dict(__id__=2, __geometry__='wkb2'),
+        ], rows)
+        self.assertIs(bytes, type(rows[0]['__geometry__']))
+
+
+class FakeQueryCursor(object):
+
+    def __init__(self, executed):
+        self.executed = executed
+        self.description = (('__id__', 0),)
+
+    def execute(self, sql, params=None):
+        self.executed.append(sql)
+
+    def __iter__(self):
+        return iter([(1,), (2,)])
+
+
+class FakeQueryConnection(object):
+
+    def __init__(self):
+        self.executed = []
+
+    def cursor(self):
+        return FakeQueryCursor(self.executed)
+
+
+class FakeConnectionPool(object):
+
+    def __init__(self):
+        self.conns = []
+        self.failures = []
+
+    def get_conns(self, n_conn, timeout=None):
+        from contextlib import contextmanager
+
+        @contextmanager
+        def conns():
+            self.conns = [FakeQueryConnection() for i in xrange(n_conn)]
+            yield self.conns
+
+        return conns()
+
+    def record_latency(self, conn, duration_seconds):
+        pass
+
+    def record_failure(self, conn):
+        self.failures.append(conn)
+
+
+class ExecuteQueryTest(unittest.TestCase):
+
+    def test_statement_timeout(self):
+        from tilequeue.query.postgres import execute_query
+        conn = FakeQueryConnection()
+        rows = execute_query(conn, 'SELECT 1', 1.5)
+        self.assertEqual([dict(__id__=1), dict(__id__=2)], rows)
+        # the timeout only applies to the query's transaction
+        self.assertEqual(
+            ['BEGIN; SET LOCAL statement_timeout = %s', 'SELECT 1', 'COMMIT'],
+            conn.executed)
+
+    def test_no_statement_timeout(self):
+        from tilequeue.query.postgres import execute_query
+        conn = FakeQueryConnection()
+        execute_query(conn, 'SELECT 1')
+        self.assertEqual(['SELECT 1'], conn.executed)
+
+
+class DataFetcherStatsTest(unittest.TestCase):
+
+    def _fetch(self, slow_query_log=None):
+        from multiprocessing.pool import ThreadPool
+        from tilequeue.query.postgres import DataFetcher
+        from tilequeue.query.postgres import SourceQuery
+
+        class StatsHandler(object):
+            def __init__(self):
+                self.queries = []
+
+            def fetched_query(self, source, zoom, duration_millis, n_rows):
+                self.queries.append((source, zoom, n_rows))
+
+        def queries_generator(zoom, bounds):
+            return [SourceQuery('src1', ('t1',), 'SELECT 1'),
+                    SourceQuery('src2', ('t2', 't3'), 'SELECT 2')]
+
+        stats_handler = StatsHandler()
+        io_pool = ThreadPool(2)
+        fetcher = DataFetcher(
+            dict(dbnames=['db']), queries_generator, io_pool,
+            stats_handler, slow_query_log)
+        fetcher.sql_conn_pool = FakeConnectionPool()
+        try:
+            rows = fetcher(7, (0, 0, 1, 1))
+        finally:
+            io_pool.close()
+        return rows, stats_handler, fetcher.sql_conn_pool.conns
+
+    def test_per_source_stats(self):
+        rows, stats_handler, conns = self._fetch()
+        self.assertEqual(4, len(rows))
+        self.assertEqual([('src1', 7, 2), ('src2', 7, 2)],
+                         sorted(stats_handler.queries))
+
+    def test_slow_query_log(self):
+        from tilequeue.query.postgres import SlowQueryLog
+
+        class Logger(object):
+            def __init__(self):
+                self.msgs = []
+
+            def warning(self, msg):
+                self.msgs.append(msg)
+
+        logger = Logger()
+        self._fetch(SlowQueryLog(logger, 0, explain=False))
+        self.assertEqual(2, len(logger.msgs))
+        self.assertTrue(any('src2' in msg and 't2, t3' in msg and
+                            'SELECT 2' in msg for msg in logger.msgs))
+
+        logger = Logger()
+        rows, stats_handler, conns = self._fetch(
+            SlowQueryLog(logger, 0, explain=True))
+        self.assertEqual(
+            'EXPLAIN (ANALYZE, BUFFERS) SELECT 1', conns[0].executed[-1])
+
+        logger = Logger()
+        self._fetch(SlowQueryLog(logger, 60))
+        self.assertEqual([], logger.msgs)
+
+    def test_render_query_sql(self):
+        from tilequeue.query.postgres import PreparedQuery
+        from tilequeue.query.postgres import render_query_sql
+        query = PreparedQuery('q', 'SELECT $1, $2, $3, $4', (1, 2, 3, 4.5))
+        self.assertEqual(
+            'SELECT 1.000000000000, 2.000000000000, 3.000000000000, '
+            '4.500000000000', render_query_sql(query))
+
+
+class DataFetcherTimeoutTest(unittest.TestCase):
+
+    def test_slow_query_cancelled(self):
+        from multiprocessing.pool import ThreadPool
+        from tilequeue.query.postgres import DataFetcher
+        from tilequeue.query.postgres import DataFetchTimeout
+        from tilequeue.query.postgres import SourceQuery
+        import threading
+
+        class SlowCursor(FakeQueryCursor):
+            def execute(self, sql, params=None):
+                if sql == 'SLOW':
+                    from psycopg2.extensions import QueryCanceledError
+                    self.conn.cancelled.wait(10)
+                    raise QueryCanceledError('canceling statement')
+
+        class CancellableConnection(FakeQueryConnection):
+            def __init__(self):
+                super(CancellableConnection, self).__init__()
+                self.cancelled = threading.Event()
+
+            def cursor(self):
+                cursor = SlowCursor(self.executed)
+                cursor.conn = self
+                return cursor
+
+            def cancel(self):
+                self.cancelled.set()
+
+            def close(self):
+                pass
+
+        class Pool(FakeConnectionPool):
+            def get_conns(self, n_conn, timeout=None):
+                from contextlib import contextmanager
+
+                @contextmanager
+                def conns():
+                    self.conns = [CancellableConnection()
+                                  for i in xrange(n_conn)]
+                    try:
+                        yield self.conns
+                    finally:
+                        self.returned = list(self.conns)
+
+                return conns()
+
+        def queries_generator(zoom, bounds):
+            return [SourceQuery('fast', ('t1',), 'SELECT 1'),
+                    SourceQuery('slow', ('t2',), 'SLOW')]
+
+        io_pool = ThreadPool(2)
+        fetcher = DataFetcher(
+            dict(dbnames=['db']), queries_generator, io_pool,
+            fetch_timeout_seconds=0.1)
+        fetcher.sql_conn_pool = pool = Pool()
+        try:
+            with self.assertRaises(DataFetchTimeout) as cm:
+                fetcher(7, (0, 0, 1, 1))
+        finally:
+            io_pool.close()
+        self.assertEqual(['slow'], cm.exception.source_names)
+        self.assertFalse(pool.conns[0].cancelled.is_set())
+        self.assertTrue(pool.conns[1].cancelled.is_set())
+        self.assertEqual(2, len(pool.returned))
+        # cancelling the query doesn't count against the database
+        self.assertEqual([], pool.failures)
+
+    def test_pool_wait_timeout(self):
+        from multiprocessing.pool import ThreadPool
+        from tilequeue.query.pool import ConnectionPoolTimeout
+        from tilequeue.query.postgres import DataFetcher
+        from tilequeue.query.postgres import DataFetchTimeout
+        from tilequeue.query.postgres import SourceQuery
+
+        timeouts = []
+
+        class Pool(FakeConnectionPool):
+            def get_conns(self, n_conn, timeout=None):
+                timeouts.append(timeout)
+                raise ConnectionPoolTimeout()
+
+        def queries_generator(zoom, bounds):
+            return [SourceQuery('roads', ('t1',), 'SELECT 1')]
+
+        io_pool = ThreadPool(1)
+        fetcher = DataFetcher(
+            dict(dbnames=['db']), queries_generator, io_pool,
+            fetch_timeout_seconds=0.1)
+        fetcher.sql_conn_pool = Pool()
+        try:
+            with self.assertRaises(DataFetchTimeout) as cm:
+                fetcher(7, (0, 0, 1, 1))
+        finally:
+            io_pool.close()
+        self.assertEqual(['roads'], cm.exception.source_names)
+        self.assertEqual([0.1], timeouts)
@@ -732,3 +732,117 @@ class TestTileFootprint(unittest.TestCase):
                 expected.add(Tile(tile.z, tile.x + dx, tile.y + dy))
 
         self.assertEquals(expected, tiles)
+
+
+class TestRawrTileCache(RawrTestCase):
+
+    def test_lru(self):
+        from raw_tiles.tile import Tile
+        from tilequeue.query.rawr import RawrTileCache
+
+        cache = RawrTileCache(250)
+        t1, t2, t3 = Tile(10, 1, 1), Tile(10, 1, 2), Tile(10, 1, 3)
+        cache.put(t1, 'v1', 'tile1', 100)
+        cache.put(t2, 'v1', 'tile2', 100)
+        # use t1, so that t2 is the least recently used
+        self.assertEqual('tile1', cache.get(t1, 'v1'))
+        cache.put(t3, 'v1', 'tile3', 100)
+        self.assertIsNone(cache.get(t2, 'v1'))
+        self.assertEqual('tile1', cache.get(t1, 'v1'))
+        self.assertEqual('tile3', cache.get(t3, 'v1'))
+        self.assertEqual(200, cache.size_bytes)
+
+        # changed versions aren't used
+        self.assertIsNone(cache.get(t1, 'v2'))
+        self.assertEqual(100, cache.size_bytes)
+
+        # too big to cache at all
+        cache.put(t2, 'v1', 'tile2', 1000)
+        self.assertIsNone(cache.get(t2, 'v1'))
+
+    def test_fetch_tiles_reuses_rawr_tile(self):
+        from shapely.geometry import Point
+        from tilequeue.query.common import LayerInfo
+        from tilequeue.query.rawr import RawrTileCache
+        from tilequeue.query.rawr import make_rawr_data_fetcher
+        from tilequeue.tile import mercator_point_to_coord
+
+        shape = Point(0, 0)
+        tables = TestGetTable({
+            'planet_osm_point': [(0, shape.wkb, {})],
+        })
+        tables.size_bytes = 100
+
+        class VersionedStorage(ConstantStorage):
+            n_reads = 0
+            current_version = 'v1'
+
+            def version(self, tile):
+                return self.current_version
+
+            def __call__(self, top_tile):
+                self.n_reads += 1
+                return self.tables
+
+        storage = VersionedStorage(tables)
+        layers = {'testlayer': LayerInfo(lambda *args: 10, None)}
+        fetch = make_rawr_data_fetcher(
+            10, 16, storage, layers, [dict(type='osm')],
+            tile_cache=RawrTileCache(1024))
+
+        coord = mercator_point_to_coord(10, shape.x, shape.y)
+        fetchers = [fetcher for fetcher, _ in fetch.fetch_tiles(_wrap(coord))]
+        fetchers.extend(
+            fetcher for fetcher, _ in fetch.fetch_tiles(_wrap(coord)))
+        self.assertIs(fetchers[0], fetchers[1])
+        self.assertEqual(1, storage.n_reads)
+
+        storage.current_version = 'v2'
+        for fetcher, _ in fetch.fetch_tiles(_wrap(coord)):
+            self.assertIsNot(fetchers[0], fetcher)
+        self.assertEqual(2, storage.n_reads)
+
+
+class TestParallelIndexes(RawrTestCase):
+
+    def test_indexes_in_configured_order(self):
+        from multiprocessing.pool import ThreadPool
+        from shapely.geometry import Point
+        from tilequeue.query.common import LayerInfo
+        from tilequeue.query.rawr import RawrTile
+        from tilequeue.query.rawr import TilePyramid
+        from tilequeue.tile import mercator_point_to_coord
+
+        shape = Point(0, 0)
+        tables = TestGetTable({
+            'planet_osm_point': [(0, shape.wkb, {})],
+            'water_polygons': [(1, shape.wkb, {})],
+            'land_polygons': [(2, shape.wkb, {})],
+        })
+        layers = {
+            'pois': LayerInfo(lambda *args: 10, None),
+            'water': LayerInfo(lambda *args: 10, None),
+            'earth': LayerInfo(lambda *args: 10, None),
+        }
+        indexes_cfg = [
+            dict(type='simple', table='water_polygons', layer='water'),
+            dict(type='osm'),
+            dict(type='simple', table='land_polygons', layer='earth'),
+        ]
+        coord = mercator_point_to_coord(10, shape.x, shape.y)
+        tile_pyramid = TilePyramid(10, coord.column, coord.row, 16)
+
+        pool = ThreadPool(2)
+        try:
+            parallel = RawrTile(layers, tables, tile_pyramid, {}, indexes_cfg,
+                                pool)
+        finally:
+            pool.close()
+        serial = RawrTile(layers, tables, tile_pyramid, {}, indexes_cfg)
+
+        self.assertIsNotNone(parallel.osm)
+        self.assertEqual([type(i) for i in serial.indexes],
+                         [type(i) for i in parallel.indexes])
+        self.assertEqual(['water', 'earth'],
+                         [i.layers.keys()[0] for i in parallel.indexes
+                          if i is not parallel.indexes[1]])
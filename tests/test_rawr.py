@@ -0,0 +1,147 @@
+import unittest
+
+
+class UnpackRawrZipPayloadTest(unittest.TestCase):
+
+    def _make_payload(self, tables):
+        from cStringIO import StringIO
+        from msgpack import Packer
+        import zipfile
+        buf = StringIO()
+        with zipfile.ZipFile(buf, 'w', zipfile.ZIP_DEFLATED) as zfh:
+            for table_name, rows in tables.items():
+                packer = Packer()
+                zfh.writestr(table_name,
+                             ''.join(packer.pack(row) for row in rows))
+        return buf.getvalue()
+
+    def test_rows_streamed(self):
+        from tilequeue.process import Source
+        from tilequeue.rawr import unpack_rawr_zip_payload
+        import tilequeue.rawr
+
+        source = Source('osm', 'openstreetmap.org')
+        point_rows = [[i, 'wkb%d' % i, {'name': 'n%d' % i}]
+                      for i in xrange(1000)]
+        payload = self._make_payload(dict(
+            planet_osm_point=point_rows,
+            planet_osm_line=[],
+        ))
+        table_sources = dict(planet_osm_point=source, planet_osm_line=source)
+
+        # small chunks, so that rows span several of them
+        orig_chunk_size = tilequeue.rawr._unpack_chunk_size
+        tilequeue.rawr._unpack_chunk_size = 100
+        try:
+            tables = unpack_rawr_zip_payload(table_sources, payload)
+            table = tables('planet_osm_point')
+            self.assertEqual(source, table.source)
+            self.assertEqual(point_rows, list(table.rows))
+            self.assertEqual([], list(tables('planet_osm_line').rows))
+        finally:
+            tilequeue.rawr._unpack_chunk_size = orig_chunk_size
+
+    def test_tables_read_together(self):
+        from itertools import izip
+        from tilequeue.process import Source
+        from tilequeue.rawr import unpack_rawr_zip_payload
+
+        source = Source('osm', 'openstreetmap.org')
+        point_rows = [[i, 'point', {}] for i in xrange(100)]
+        line_rows = [[i, 'line', {}] for i in xrange(100)]
+        payload = self._make_payload(dict(
+            planet_osm_point=point_rows,
+            planet_osm_line=line_rows,
+        ))
+        tables = unpack_rawr_zip_payload(
+            dict(planet_osm_point=source, planet_osm_line=source), payload)
+        rows = list(izip(tables('planet_osm_point').rows,
+                         tables('planet_osm_line').rows))
+        self.assertEqual(zip(point_rows, line_rows), rows)
+
+    def test_spooled_body(self):
+        from cStringIO import StringIO
+        from tilequeue.process import Source
+        from tilequeue.rawr import _spool_body
+        from tilequeue.rawr import unpack_rawr_zip_payload
+
+        source = Source('osm', 'openstreetmap.org')
+        rows = [[1, 'wkb', {}], [2, 'wkb', {}]]
+        payload = self._make_payload(dict(planet_osm_point=rows))
+        # larger than the memory limit, so spooled to disk
+        body = _spool_body(StringIO(payload), 10)
+        tables = unpack_rawr_zip_payload(
+            dict(planet_osm_point=source), body)
+        self.assertEqual(rows, list(tables('planet_osm_point').rows))
+
+
+class RawrCachedSourceTest(unittest.TestCase):
+
+    def setUp(self):
+        import tempfile
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        import shutil
+        shutil.rmtree(self.tmp_dir)
+
+    def _make_source(self, payloads):
+        from cStringIO import StringIO
+        from tilequeue.process import Source
+        from tilequeue.query.cache import DiskResultCache
+        from tilequeue.rawr import RawrCachedSource
+
+        class FakeSource(object):
+            def __init__(self):
+                self.n_reads = 0
+
+            def get_payload(self, tile, version=None):
+                current_version, payload = payloads[-1]
+                if version == current_version:
+                    return version, None
+                self.n_reads += 1
+                return current_version, StringIO(payload)
+
+        class StatsHandler(object):
+            def __init__(self):
+                self.hits = []
+
+            def rawr_tile_cache(self, hit):
+                self.hits.append(hit)
+
+        source = FakeSource()
+        stats_handler = StatsHandler()
+        cache = DiskResultCache(self.tmp_dir, 1024 * 1024)
+        table_sources = dict(
+            planet_osm_point=Source('osm', 'openstreetmap.org'))
+        cached_source = RawrCachedSource(
+            source, cache, table_sources, stats_handler)
+        return cached_source, source, stats_handler, cache
+
+    def test_cached_until_changed(self):
+        from raw_tiles.tile import Tile
+        make_payload = UnpackRawrZipPayloadTest('run')._make_payload
+        rows1 = [[1, 'wkb', {}]]
+        rows2 = [[2, 'wkb', {}]]
+        payloads = [('v1', make_payload(dict(planet_osm_point=rows1)))]
+        cached_source, source, stats_handler, cache = \
+            self._make_source(payloads)
+        tile = Tile(10, 163, 395)
+
+        for i in xrange(2):
+            tables = cached_source(tile)
+            self.assertEqual(rows1, list(tables('planet_osm_point').rows))
+        self.assertEqual(1, source.n_reads)
+        self.assertEqual([False, True], stats_handler.hits)
+
+        # a new version replaces the old one
+        payloads.append(('v2', make_payload(dict(planet_osm_point=rows2))))
+        tables = cached_source(tile)
+        self.assertEqual(rows2, list(tables('planet_osm_point').rows))
+        self.assertEqual(2, source.n_reads)
+        from tilequeue.rawr import unconvert_coord_object
+        self.assertEqual(['v2'], cache.keys(unconvert_coord_object(tile)))
+
+    def test_version_key(self):
+        from tilequeue.rawr import rawr_version_key
+        self.assertEqual('abc123-2', rawr_version_key('"abc123-2"'))
@@ -56,6 +56,112 @@ class TestTileDirectory(unittest.TestCase):
 
             os.remove(expected_path)
 
+    def test_delete_tiles(self):
+        from ModestMaps.Core import Coordinate
+        from tilequeue.format import json_format
+        from tilequeue import store
+        import os
+        tile_dir = store.TileDirectory(self.dir_path, delete_threads=3)
+        layer = 'all'
+        coords = [Coordinate(zoom=10, column=x, row=1) for x in range(10)]
+        for coord in coords:
+            tile_dir.write_tile('tile', coord, json_format, layer)
+
+        # the missing tile shouldn't count as deleted
+        missing = Coordinate(zoom=10, column=100, row=100)
+        n_deleted = tile_dir.delete_tiles(
+            coords + [missing], json_format, layer)
+        self.assertEqual(len(coords), n_deleted)
+        for coord in coords:
+            path = store.make_file_path(
+                self.dir_path, coord, layer, json_format.extension)
+            self.assertFalse(os.path.exists(path))
+
+
+class FakeS3Client(object):
+    """
+    Minimal, thread safe stand in for the boto3 S3 client calls that
+    the store makes.
+    """
+
+    def __init__(self):
+        import threading
+        self.lock = threading.Lock()
+        self.objects = {}
+        self.delete_calls = []
+        self.failed = set()
+        self.fail_delete = lambda key_name: False
+
+    def put_object(self, Bucket, Key, Body, **kwargs):
+        with self.lock:
+            self.objects[Key] = (Body, kwargs)
+
+    def head_object(self, Bucket, Key):
+        from botocore.exceptions import ClientError
+        with self.lock:
+            if Key not in self.objects:
+                raise ClientError(
+                    {'Error': {'Code': '404'}}, 'HeadObject')
+            body, kwargs = self.objects[Key]
+        return dict(Metadata=kwargs.get('Metadata', {}))
+
+    def delete_objects(self, Bucket, Delete):
+        with self.lock:
+            key_names = [obj['Key'] for obj in Delete['Objects']]
+            self.delete_calls.append(key_names)
+            deleted = []
+            errors = []
+            for key_name in key_names:
+                if self.fail_delete(key_name) and \
+                   key_name not in self.failed:
+                    self.failed.add(key_name)
+                    errors.append(dict(Key=key_name, Code='InternalError'))
+                else:
+                    self.objects.pop(key_name, None)
+                    deleted.append(dict(Key=key_name))
+            return dict(Deleted=deleted, Errors=errors)
+
+
+class S3Test(unittest.TestCase):
+
+    def _make_store(self, s3_client):
+        from tilequeue.store import S3
+        return S3(s3_client, 'bucket', '20160121', 'osm', False, 60, None,
+                  delete_threads=4, delete_retry_initial_interval=0)
+
+    def test_write_and_read_hash(self):
+        from ModestMaps.Core import Coordinate
+        from tilequeue.format import json_format
+        from tilequeue.store import tile_content_hash
+        s3_client = FakeS3Client()
+        s3 = self._make_store(s3_client)
+        coord = Coordinate(zoom=8, column=72, row=105)
+
+        self.assertIsNone(s3.read_tile_hash(coord, json_format, 'all'))
+        s3.write_tile('tile', coord, json_format, 'all')
+        self.assertEqual(['20160121/b707d/osm/all/8/72/105.json'],
+                         s3_client.objects.keys())
+        self.assertEqual(tile_content_hash('tile', json_format),
+                         s3.read_tile_hash(coord, json_format, 'all'))
+
+    def test_delete_batches_and_retries(self):
+        from ModestMaps.Core import Coordinate
+        from tilequeue.format import json_format
+
+        s3_client = FakeS3Client()
+        # every tenth key fails once, transiently
+        s3_client.fail_delete = lambda key_name: key_name.endswith('0.json')
+        s3 = self._make_store(s3_client)
+        coords = [Coordinate(zoom=12, column=1, row=y) for y in range(2500)]
+        n_deleted = s3.delete_tiles(coords, json_format, 'all')
+
+        self.assertEqual(len(coords), n_deleted)
+        self.assertEqual(250, len(s3_client.failed))
+        # three batches, each with a retry of its failed keys
+        self.assertEqual(6, len(s3_client.delete_calls))
+        self.assertTrue(
+            all(len(call) <= 1000 for call in s3_client.delete_calls))
+
 
 class TestStoreKey(unittest.TestCase):
 
@@ -124,3 +230,171 @@ class WriteTileIfChangedTest(unittest.TestCase):
         did_write = self._call_fut('data')
         self.assertFalse(did_write)
         self.assertIsNone(self._out)
+
+
+class WriteTileIfChangedHashTest(unittest.TestCase):
+
+    def setUp(self):
+        self._hash = None
+        self._out = None
+        self.store = type(
+            'test-store',
+            (),
+            dict(read_tile=self._read_tile,
+                 read_tile_hash=self._read_tile_hash,
+                 write_tile=self._write_tile)
+        )
+
+    def _read_tile(self, coord, format, layer):
+        self.fail('tile data should not be read when the hash is available')
+
+    def _read_tile_hash(self, coord, format, layer):
+        return self._hash
+
+    def _write_tile(self, tile_data, coord, format, layer):
+        self._out = tile_data
+
+    def _call_fut(self, tile_data, format=None):
+        from tilequeue.store import write_tile_if_changed
+        coord = layer = None
+        result = write_tile_if_changed(
+            self.store, tile_data, coord, format, layer)
+        return result
+
+    def test_no_data(self):
+        did_write = self._call_fut('data')
+        self.assertTrue(did_write)
+        self.assertEquals('data', self._out)
+
+    def test_diff_data(self):
+        from tilequeue.store import tile_content_hash
+        self._hash = tile_content_hash('different data', None)
+        did_write = self._call_fut('data')
+        self.assertTrue(did_write)
+        self.assertEquals('data', self._out)
+
+    def test_same_data(self):
+        from tilequeue.store import tile_content_hash
+        self._hash = tile_content_hash('data', None)
+        did_write = self._call_fut('data')
+        self.assertFalse(did_write)
+        self.assertIsNone(self._out)
+
+    def test_same_metatile_different_time(self):
+        from ModestMaps.Core import Coordinate
+        from tilequeue.format import json_format
+        from tilequeue.format import zip_format
+        from tilequeue.metatile import make_metatiles
+        from tilequeue.store import tile_content_hash
+        tiles = [dict(tile='{"json":true}', coord=Coordinate(0, 0, 0),
+                      format=json_format, layer='all')]
+        then = make_metatiles(1, tiles, (2018, 1, 1, 0, 0, 0))[0]['tile']
+        now = make_metatiles(1, tiles, (2018, 1, 2, 0, 0, 0))[0]['tile']
+        self._hash = tile_content_hash(then, zip_format)
+        did_write = self._call_fut(now, zip_format)
+        self.assertFalse(did_write)
+        self.assertIsNone(self._out)
+
+
+class TileHashIndexTest(unittest.TestCase):
+
+    def setUp(self):
+        import tempfile
+        from tilequeue.store import TileHashIndex
+        self.dir_path = tempfile.mkdtemp()
+        self.index = TileHashIndex(self.dir_path + '/hashes.sqlite')
+
+    def tearDown(self):
+        import shutil
+        self.index.close()
+        shutil.rmtree(self.dir_path)
+
+    def test_put_get_invalidate(self):
+        from ModestMaps.Core import Coordinate
+        from tilequeue.format import json_format
+        from tilequeue.format import zip_format
+        coord = Coordinate(zoom=10, column=1, row=2)
+        other = Coordinate(zoom=10, column=1, row=3)
+        self.assertIsNone(self.index.get(coord, zip_format, 'all'))
+
+        self.index.put_many(
+            [(coord, 'hash1'), (other, 'hash2')], zip_format, 'all')
+        self.assertEqual('hash1', self.index.get(coord, zip_format, 'all'))
+        self.assertEqual('hash2', self.index.get(other, zip_format, 'all'))
+        # keyed on format and layer too
+        self.assertIsNone(self.index.get(coord, json_format, 'all'))
+        self.assertIsNone(self.index.get(coord, zip_format, 'other'))
+
+        self.index.put(coord, zip_format, 'all', 'hash3')
+        self.assertEqual('hash3', self.index.get(coord, zip_format, 'all'))
+
+        self.index.invalidate([coord], zip_format, 'all')
+        self.assertIsNone(self.index.get(coord, zip_format, 'all'))
+        self.assertEqual('hash2', self.index.get(other, zip_format, 'all'))
+
+        self.index.clear()
+        self.assertIsNone(self.index.get(other, zip_format, 'all'))
+
+    def test_write_tile_if_changed(self):
+        from ModestMaps.Core import Coordinate
+        from tilequeue.format import json_format
+        from tilequeue.store import tile_content_hash
+        from tilequeue.store import write_tile_if_changed
+
+        calls = []
+
+        class FakeStore(object):
+            hash_index = self.index
+
+            def read_tile_hash(self, coord, format, layer):
+                calls.append('head')
+                return tile_content_hash('old', format)
+
+            def write_tile(self, tile_data, coord, format, layer):
+                calls.append('write')
+
+        store = FakeStore()
+        coord = Coordinate(zoom=10, column=1, row=2)
+
+        # not in the index, so the store is asked for the hash
+        self.assertFalse(write_tile_if_changed(
+            store, 'old', coord, json_format, 'all'))
+        self.assertEqual(['head'], calls)
+
+        # now it's in the index, so the store isn't asked at all
+        del calls[:]
+        self.assertFalse(write_tile_if_changed(
+            store, 'old', coord, json_format, 'all'))
+        self.assertEqual([], calls)
+
+        # the index knows the tile changed, so it's written straight away
+        self.assertTrue(write_tile_if_changed(
+            store, 'new', coord, json_format, 'all'))
+        self.assertEqual(['write'], calls)
+        self.assertEqual(tile_content_hash('new', json_format),
+                         self.index.get(coord, json_format, 'all'))
+
+
+class StoreWriterTest(unittest.TestCase):
+
+    def test_write_tiles(self):
+        from ModestMaps.Core import Coordinate
+        from tilequeue.format import json_format
+        from tilequeue.store import Memory
+        from tilequeue.store import StoreWriter
+
+        store = Memory()
+        store_writer = StoreWriter(store, 2)
+        tiles = [dict(tile='tile', coord=Coordinate(zoom=1, column=0, row=0),
+                      format=json_format, layer='all')]
+        try:
+            async_results = store_writer.write_tiles(tiles)
+            self.assertEqual([True], [r.get() for r in async_results])
+            self.assertEqual('tile', store.read_tile(
+                tiles[0]['coord'], json_format, 'all'))
+
+            # unchanged, so not written again
+            async_results = store_writer.write_tiles(tiles)
+            self.assertEqual([False], [r.get() for r in async_results])
+        finally:
+            store_writer.close()
@@ -220,6 +220,47 @@ class CoordIntZoomTest(unittest.TestCase):
             act_int = coord_int_zoom_up(coord_int)
             self.assertEquals(exp_int, act_int)
 
+    def test_verify_array(self):
+        import numpy as np
+        from ModestMaps.Core import Coordinate
+        from tilequeue.tile import coord_int_zoom_up
+        from tilequeue.tile import coord_ints_zoom_up
+        from tilequeue.tile import coord_marshall_int
+        test_coords = (
+            Coordinate(zoom=20, column=1002463, row=312816),
+            Coordinate(zoom=20, column=(2 ** 20)-1, row=(2 ** 20)-1),
+            Coordinate(zoom=10, column=(2 ** 10)-1, row=(2 ** 10)-1),
+            Coordinate(zoom=5, column=20, row=20),
+            Coordinate(zoom=1, column=0, row=0),
+        )
+        coord_ints = map(coord_marshall_int, test_coords)
+        exp_ints = map(coord_int_zoom_up, coord_ints)
+        act_ints = coord_ints_zoom_up(np.array(coord_ints, dtype=np.int64))
+        self.assertEquals(exp_ints, act_ints.tolist())
+
+
+class CoordIntsValidTest(unittest.TestCase):
+
+    def test_matches_coord_is_valid(self):
+        import numpy as np
+        from ModestMaps.Core import Coordinate
+        from tilequeue.tile import coord_ints_are_valid
+        from tilequeue.tile import coord_is_valid
+        from tilequeue.tile import coord_marshall_int
+        test_coords = (
+            Coordinate(zoom=0, column=0, row=0),
+            Coordinate(zoom=1, column=1, row=1),
+            Coordinate(zoom=1, column=2, row=0),
+            Coordinate(zoom=3, column=0, row=8),
+            Coordinate(zoom=16, column=10, row=10),
+            Coordinate(zoom=17, column=10, row=10),
+        )
+        coord_ints = np.array(
+            map(coord_marshall_int, test_coords), dtype=np.int64)
+        exp = [coord_is_valid(coord, 16) for coord in test_coords]
+        act = coord_ints_are_valid(coord_ints, 16)
+        self.assertEquals(exp, act.tolist())
+
 
 class TestMetatileZoom(unittest.TestCase):
 
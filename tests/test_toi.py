@@ -89,3 +89,86 @@ class TestToiSet(unittest.TestCase):
             expected_toi_set.add(self._coord_str_to_int('1/1/0'))
 
             self.assertEquals(expected_toi_set, actual_toi_set)
+
+    def test_file_fetch_if_changed(self):
+        import os
+        import shutil
+        from tilequeue.toi import FileTilesOfInterestSet
+
+        tmpdir = tempfile.mkdtemp()
+        try:
+            toi = FileTilesOfInterestSet(os.path.join(tmpdir, 'toi.gz'))
+            toi_set = set([self._coord_str_to_int('0/0/0')])
+            toi.set_tiles_of_interest(toi_set)
+
+            actual, version = toi.fetch_tiles_of_interest_if_changed(None)
+            self.assertEquals(toi_set, actual)
+
+            actual, same_version = toi.fetch_tiles_of_interest_if_changed(
+                version)
+            self.assertIsNone(actual)
+            self.assertEquals(version, same_version)
+
+            toi_set.add(self._coord_str_to_int('1/0/0'))
+            toi.set_tiles_of_interest(toi_set)
+            actual, _ = toi.fetch_tiles_of_interest_if_changed(version)
+            self.assertEquals(toi_set, actual)
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_binary_roundtrip(self):
+        from tilequeue.toi import load_array_from_binary_fp
+        from tilequeue.toi import save_array_to_binary_fp
+
+        toi_set = set(map(self._coord_str_to_int, (
+            '0/0/0', '1/0/0', '1/1/0', '16/10485/25325', '20/1048575/0')))
+
+        with tempfile.TemporaryFile() as fp:
+            save_array_to_binary_fp(list(toi_set), fp)
+            fp.seek(0)
+            toi_array = load_array_from_binary_fp(fp)
+
+        self.assertEquals(sorted(toi_set), toi_array.tolist())
+
+    def test_binary_empty(self):
+        from tilequeue.toi import load_array_from_binary_fp
+        from tilequeue.toi import save_array_to_binary_fp
+
+        with tempfile.TemporaryFile() as fp:
+            save_array_to_binary_fp([], fp)
+            fp.seek(0)
+            toi_array = load_array_from_binary_fp(fp)
+
+        self.assertEquals(0, len(toi_array))
+
+    def test_load_detects_format(self):
+        from tilequeue.toi import load_array_from_toi_fp
+        from tilequeue.toi import load_set_from_toi_fp
+        from tilequeue.toi import save_toi_to_fp
+
+        toi_set = set(map(self._coord_str_to_int, ('0/0/0', '1/0/0')))
+        for toi_format in ('gzip', 'binary'):
+            with tempfile.TemporaryFile() as fp:
+                save_toi_to_fp(toi_set, fp, toi_format)
+                fp.seek(0)
+                self.assertEquals(toi_set, load_set_from_toi_fp(fp))
+                fp.seek(0)
+                self.assertEquals(
+                    sorted(toi_set), load_array_from_toi_fp(fp).tolist())
+
+    def test_file_binary_format(self):
+        import os
+        import shutil
+        from tilequeue.toi import FileTilesOfInterestSet
+
+        tmpdir = tempfile.mkdtemp()
+        try:
+            toi = FileTilesOfInterestSet(
+                os.path.join(tmpdir, 'toi.bin'), 'binary')
+            toi_set = set(map(self._coord_str_to_int, ('0/0/0', '1/0/0')))
+            toi.set_tiles_of_interest(toi_set)
+            self.assertEquals(toi_set, toi.fetch_tiles_of_interest())
+            self.assertEquals(
+                sorted(toi_set), toi.fetch_tiles_of_interest_array().tolist())
+        finally:
+            shutil.rmtree(tmpdir)
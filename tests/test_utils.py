@@ -74,3 +74,36 @@ class TestCoordsByParent(unittest.TestCase):
             count += 1
 
         self.assertEquals(1, count)
+
+
+class CountingThreadPoolTest(unittest.TestCase):
+
+    def test_counts(self):
+        import threading
+        from tilequeue.utils import CountingThreadPool
+
+        pool = CountingThreadPool(1)
+        started = threading.Event()
+        release = threading.Event()
+
+        def blocked():
+            started.set()
+            release.wait()
+            return 'blocked'
+
+        try:
+            first = pool.apply_async(blocked)
+            second = pool.apply_async(lambda x: x * 2, (21,))
+            started.wait()
+            # one job is running and the other is waiting for a thread
+            self.assertEqual((1, 1, 0), pool.counts())
+
+            release.set()
+            self.assertEqual('blocked', first.get())
+            self.assertEqual(42, second.get())
+            # completed count is reset each time that it's read
+            self.assertEqual((0, 0, 2), pool.counts())
+            self.assertEqual((0, 0, 0), pool.counts())
+        finally:
+            pool.close()
+            pool.join()
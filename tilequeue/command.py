@@ -1,4 +1,3 @@
-from collections import defaultdict
 from collections import namedtuple
 from contextlib import closing
 from itertools import chain
@@ -12,20 +11,21 @@ from tilequeue.metro_extract import city_bounds
 from tilequeue.metro_extract import parse_metro_extract
 from tilequeue.process import convert_source_data_to_feature_layers
 from tilequeue.process import process_coord
-from tilequeue.query import DBConnectionPool
+from tilequeue.query import make_db_connection_pool
 from tilequeue.query import make_data_fetcher
 from tilequeue.queue import make_sqs_queue
 from tilequeue.queue import make_visibility_manager
 from tilequeue.store import make_store
+from tilequeue.store import StoreWriter
 from tilequeue.tile import coord_children_range
-from tilequeue.tile import coord_int_zoom_up
+from tilequeue.tile import coord_ints_are_valid
+from tilequeue.tile import coord_ints_zoom_up
 from tilequeue.tile import coord_is_valid
 from tilequeue.tile import coord_marshall_int
 from tilequeue.tile import coord_to_mercator_bounds
 from tilequeue.tile import coord_unmarshall_int
 from tilequeue.tile import create_coord
 from tilequeue.tile import deserialize_coord
-from tilequeue.tile import metatile_zoom_from_str
 from tilequeue.tile import parse_expired_coord_string
 from tilequeue.tile import seed_tiles
 from tilequeue.tile import serialize_coord
@@ -35,11 +35,14 @@ from tilequeue.tile import zoom_mask
 from tilequeue.toi import load_set_from_fp
 from tilequeue.toi import save_set_to_fp
 from tilequeue.top_tiles import parse_top_tiles
+from tilequeue.utils import CountingThreadPool
 from tilequeue.utils import grouper
 from tilequeue.utils import parse_log_file
+from tilequeue.utils import sorted_array_contains
 from tilequeue.worker import DataFetch
 from tilequeue.worker import ProcessAndFormatData
 from tilequeue.worker import QueuePrint
+from tilequeue.worker import PoolStats
 from tilequeue.worker import S3Storage
 from tilequeue.worker import TileQueueReader
 from tilequeue.worker import TileQueueWriter
@@ -47,10 +50,11 @@ from urllib2 import urlopen
 from zope.dottedname.resolve import resolve
 import argparse
 import datetime
+import heapq
 import logging
 import logging.config
 import multiprocessing
-import operator
+import numpy as np
 import os
 import os.path
 import Queue
@@ -148,14 +152,18 @@ def make_queue_mapper(queue_mapper_yaml, tile_queue_name_map, toi):
             'Missing yaml config for multiple queue mapper'
         assert isinstance(multi_queue_map_yaml, list), \
             'Mulitple queue mapper config should be a list'
+        toi_refresh_interval_secs = queue_mapper_yaml.get(
+            'toi-refresh-seconds')
         return make_multi_queue_group_mapper_from_cfg(
-            multi_queue_map_yaml, tile_queue_name_map, toi)
+            multi_queue_map_yaml, tile_queue_name_map, toi,
+            toi_refresh_interval_secs)
     else:
         assert 0, 'Unknown queue mapper type: %s' % queue_mapper_type
 
 
 def make_multi_queue_group_mapper_from_cfg(
-        multi_queue_map_yaml, tile_queue_name_map, toi):
+        multi_queue_map_yaml, tile_queue_name_map, toi,
+        toi_refresh_interval_secs=None):
     from tilequeue.queue.mapper import ZoomRangeAndZoomGroupQueueMapper
     from tilequeue.queue.mapper import ZoomRangeQueueSpec
     zoom_range_specs = []
@@ -178,8 +186,13 @@ def make_multi_queue_group_mapper_from_cfg(
             start_zoom, end_zoom, queue_name, queue, group_by_zoom,
             in_toi)
         zoom_range_specs.append(zrs)
+    logger = None
+    if toi_refresh_interval_secs:
+        logger = logging.getLogger('queue_mapper')
     queue_mapper = ZoomRangeAndZoomGroupQueueMapper(
-        zoom_range_specs, toi=toi)
+        zoom_range_specs, toi=toi,
+        toi_refresh_interval_secs=toi_refresh_interval_secs,
+        logger=logger)
     return queue_mapper
 
 
@@ -198,6 +211,9 @@ def make_message_marshaller(msg_marshall_yaml_cfg):
     elif msg_mar_type == 'multiple':
         from tilequeue.queue.message import CommaSeparatedMarshaller
         return CommaSeparatedMarshaller()
+    elif msg_mar_type == 'pyramid':
+        from tilequeue.queue.message import PyramidMarshaller
+        return PyramidMarshaller()
     else:
         assert 0, 'Unknown message marshall type: %s' % msg_mar_type
 
@@ -290,12 +306,26 @@ def make_tile_queue(queue_yaml_cfg, all_cfg, redis_client=None):
             assert redis_client, 'redis_client required for redis tile_queue'
             from tilequeue.queue import make_redis_queue
             tile_queue = make_redis_queue(redis_client, queue_name)
+        elif queue_type == 'redis-reliable':
+            assert redis_client, 'redis_client required for redis tile_queue'
+            from tilequeue.queue import make_reliable_redis_queue
+            redis_queue_cfg = queue_yaml_cfg.get('redis') or {}
+            tile_queue = make_reliable_redis_queue(
+                redis_client, queue_name,
+                read_size=redis_queue_cfg.get('read-size', 10),
+                read_wait_seconds=redis_queue_cfg.get(
+                    'read-wait-seconds', 20),
+                visibility_timeout_seconds=redis_queue_cfg.get(
+                    'visibility-timeout-seconds', 3600),
+                reap_interval_seconds=redis_queue_cfg.get(
+                    'reap-interval-seconds', 60),
+            )
         else:
             raise ValueError('Unknown queue type: %s' % queue_type)
         return tile_queue, queue_name
 
 
-def make_msg_tracker(msg_tracker_yaml, logger):
+def make_msg_tracker(msg_tracker_yaml, logger, stats_handler=None):
     if not msg_tracker_yaml:
         from tilequeue.queue.message import SingleMessagePerCoordTracker
         return SingleMessagePerCoordTracker()
@@ -309,7 +339,11 @@ def make_msg_tracker(msg_tracker_yaml, logger):
             from tilequeue.queue.message import MultipleMessagesPerCoordTracker
             from tilequeue.log import MultipleMessagesTrackerLogger
             msg_tracker_logger = MultipleMessagesTrackerLogger(logger)
-            return MultipleMessagesPerCoordTracker(msg_tracker_logger)
+            multiple_yaml = msg_tracker_yaml.get('multiple') or {}
+            expire_secs = multiple_yaml.get('expire-seconds', 43200)
+            return MultipleMessagesPerCoordTracker(
+                msg_tracker_logger, expire_secs=expire_secs,
+                stats_handler=stats_handler)
         else:
             assert 0, 'Unknown message tracker type: %s' % msg_tracker_type
 
@@ -320,11 +354,13 @@ def make_toi_helper(cfg):
         return S3TilesOfInterestSet(
             cfg.toi_store_s3_bucket,
             cfg.toi_store_s3_key,
+            cfg.toi_store_format,
         )
     elif cfg.toi_store_type == 'file':
         from tilequeue.toi import FileTilesOfInterestSet
         return FileTilesOfInterestSet(
             cfg.toi_store_file_name,
+            cfg.toi_store_format,
         )
 
 
@@ -399,54 +435,59 @@ def make_seed_tile_generator(cfg):
     return tile_generator
 
 
-def _make_store(cfg, logger=None):
+def _make_store(cfg, logger=None, max_pool_connections=None):
     store_cfg = cfg.yml.get('store')
     assert store_cfg, "Store was not configured, but is necessary."
     credentials = cfg.subtree('aws credentials')
     if logger is None:
         logger = make_logger(cfg, 'process')
-    store = make_store(store_cfg, credentials=credentials, logger=logger)
+    store = make_store(store_cfg, credentials=credentials, logger=logger,
+                       max_pool_connections=max_pool_connections)
     return store
 
 
 def explode_and_intersect(coord_ints, tiles_of_interest, until=0):
+    """
+    intersect coord_ints and all their parents with the toi
 
-    next_coord_ints = coord_ints
-    coord_ints_at_parent_zoom = set()
+    Every coordinate and all of its parents, down to the until zoom,
+    are checked against the tiles of interest. Each zoom level of
+    parents is calculated and de-duplicated at once over an array.
+
+    The tiles_of_interest can be a sorted numpy array, as loaded by
+    load_array_from_toi_fp, or any other collection of coord ints.
+    """
+
+    if isinstance(tiles_of_interest, np.ndarray):
+        toi_array = tiles_of_interest
+    else:
+        toi_array = np.fromiter(
+            tiles_of_interest, dtype=np.int64, count=len(tiles_of_interest))
+        toi_array.sort()
+
+    next_coord_ints = np.fromiter(coord_ints, dtype=np.int64)
 
     total_coord_ints = []
 
     # to capture metrics
     total = 0
     hits = 0
-    misses = 0
 
-    while True:
+    while len(next_coord_ints):
+        total += len(next_coord_ints)
+        in_toi = sorted_array_contains(toi_array, next_coord_ints)
+        hit_coord_ints = next_coord_ints[in_toi]
+        hits += len(hit_coord_ints)
+        total_coord_ints.extend(hit_coord_ints.tolist())
 
-        for coord_int in next_coord_ints:
-
-            total += 1
-            if coord_int in tiles_of_interest:
-                hits += 1
-                total_coord_ints.append(coord_int)
-            else:
-                misses += 1
-
-            zoom = zoom_mask & coord_int
-            if zoom > until:
-                parent_coord_int = coord_int_zoom_up(coord_int)
-                coord_ints_at_parent_zoom.add(parent_coord_int)
-
-        if not coord_ints_at_parent_zoom:
-            break
-
-        next_coord_ints = coord_ints_at_parent_zoom
-        coord_ints_at_parent_zoom = set()
+        zooms = next_coord_ints & zoom_mask
+        next_coord_ints = np.unique(
+            coord_ints_zoom_up(next_coord_ints[zooms > until]))
 
     metrics = dict(
         total=total,
         hits=hits,
-        misses=misses,
+        misses=total - hits,
         n_toi=len(tiles_of_interest),
     )
     return total_coord_ints, metrics
@@ -619,8 +660,6 @@ def tilequeue_process(cfg, peripherals):
 
     formats = lookup_formats(cfg.output_formats)
 
-    store = _make_store(cfg)
-
     assert cfg.postgresql_conn_info, 'Missing postgresql connection info'
 
     from shapely import speedups
@@ -656,14 +695,26 @@ def tilequeue_process(cfg, peripherals):
         n_simultaneous_s3_storage = max(n_cpu / 2, 1)
     assert n_simultaneous_s3_storage > 0
 
-    # thread pool used for queries and uploading to s3
-    n_total_needed_query = n_layers * n_simultaneous_query_sets
-    n_total_needed_s3 = n_formats * n_simultaneous_s3_storage
-    n_total_needed = n_total_needed_query + n_total_needed_s3
-    n_max_io_workers = 50
-    n_io_workers = min(n_total_needed, n_max_io_workers)
-    io_pool = ThreadPool(n_io_workers)
-    feature_fetcher = make_data_fetcher(cfg, layer_data, query_cfg, io_pool)
+    # thread pool used for queries
+    n_io_workers = cfg.n_query_threads
+    if not n_io_workers:
+        n_total_needed_query = n_layers * n_simultaneous_query_sets
+        n_max_io_workers = 50
+        n_io_workers = min(n_total_needed_query, n_max_io_workers)
+    io_pool = CountingThreadPool(n_io_workers)
+
+    # uploads have their own threads, so that slow uploads don't hold
+    # up queries. every upload can be in flight at once, so the store's
+    # connection pool is sized to match.
+    n_store_threads = cfg.n_store_threads or \
+        n_formats * n_simultaneous_s3_storage
+    store = _make_store(cfg, max_pool_connections=n_store_threads)
+    store_writer = StoreWriter(store, n_store_threads)
+    from tilequeue.stats import TileProcessingStatsHandler
+    stats_handler = TileProcessingStatsHandler(peripherals.stats)
+    feature_fetcher = make_data_fetcher(
+        cfg, layer_data, query_cfg, io_pool, stats_handler,
+        make_logger(cfg, 'slow_query'))
 
     # create all queues used to manage pipeline
 
@@ -691,9 +742,7 @@ def tilequeue_process(cfg, peripherals):
     queue_mapper = peripherals.queue_mapper
     msg_marshaller = peripherals.msg_marshaller
     msg_tracker_yaml = cfg.yml.get('message-tracker')
-    msg_tracker = make_msg_tracker(msg_tracker_yaml, logger)
-    from tilequeue.stats import TileProcessingStatsHandler
-    stats_handler = TileProcessingStatsHandler(peripherals.stats)
+    msg_tracker = make_msg_tracker(msg_tracker_yaml, logger, stats_handler)
     tile_queue_reader = TileQueueReader(
         queue_mapper, msg_marshaller, msg_tracker, tile_input_queue,
         tile_proc_logger, stats_handler, thread_tile_queue_reader_stop,
@@ -709,7 +758,7 @@ def tilequeue_process(cfg, peripherals):
         cfg.buffer_cfg, output_calc_mapping, layer_data, tile_proc_logger,
         stats_handler)
 
-    s3_storage = S3Storage(processor_queue, s3_store_queue, io_pool, store,
+    s3_storage = S3Storage(processor_queue, s3_store_queue, store_writer,
                            tile_proc_logger, cfg.metatile_size)
 
     thread_tile_writer_stop = threading.Event()
@@ -774,6 +823,13 @@ def tilequeue_process(cfg, peripherals):
         queue_printer_thread = None
         queue_printer_thread_stop = None
 
+    pool_stats_thread_stop = threading.Event()
+    pool_stats = PoolStats(
+        cfg.pool_stats_interval_seconds,
+        (('query', io_pool), ('store', store_writer.pool)),
+        stats_handler, tile_proc_logger, pool_stats_thread_stop)
+    pool_stats_thread = create_and_start_thread(pool_stats)
+
     def stop_all_workers(signum, stack):
         tile_proc_logger.lifecycle('tilequeue processing shutdown ...')
 
@@ -794,6 +850,8 @@ def tilequeue_process(cfg, peripherals):
 
         if queue_printer_thread_stop:
             queue_printer_thread_stop.set()
+        pool_stats_thread_stop.set()
+        queue_mapper.stop_toi_refresh()
 
         tile_proc_logger.lifecycle(
             'requesting all workers (threads and processes) stop ... done')
@@ -849,6 +907,9 @@ def tilequeue_process(cfg, peripherals):
             tile_proc_logger.lifecycle('joining queue printer ...')
             queue_printer_thread.join()
             tile_proc_logger.lifecycle('joining queue printer ... done')
+        tile_proc_logger.lifecycle('joining pool stats ...')
+        pool_stats_thread.join()
+        tile_proc_logger.lifecycle('joining pool stats ... done')
 
         tile_proc_logger.lifecycle('joining all workers ... done')
 
@@ -857,6 +918,10 @@ def tilequeue_process(cfg, peripherals):
         io_pool.join()
         tile_proc_logger.lifecycle('joining io pool ... done')
 
+        tile_proc_logger.lifecycle('joining store writer ...')
+        store_writer.close()
+        tile_proc_logger.lifecycle('joining store writer ... done')
+
         tile_proc_logger.lifecycle('joining multiprocess data fetch queue ...')
         sql_data_fetch_queue.close()
         sql_data_fetch_queue.join_thread()
@@ -958,14 +1023,11 @@ def tilequeue_enqueue_tiles_of_interest(cfg, peripherals):
     n_toi = len(tiles_of_interest)
     logger.info('Fetching tiles of interest ... done')
 
-    coords = []
-    for coord_int in tiles_of_interest:
-        coord = coord_unmarshall_int(coord_int)
-        if coord.zoom <= cfg.max_zoom:
-            coords.append(coord)
+    coord_ints = np.fromiter(tiles_of_interest, dtype=np.int64, count=n_toi)
+    coord_ints = coord_ints[(coord_ints & zoom_mask) <= cfg.max_zoom]
 
     queue_writer = peripherals.queue_writer
-    n_queued, n_in_flight = queue_writer.enqueue_batch(coords)
+    n_queued, n_in_flight = queue_writer.enqueue_coord_ints(coord_ints)
 
     logger.info('%d enqueued - %d in flight' % (n_queued, n_in_flight))
     logger.info('%d tiles of interest processed' % n_toi)
@@ -1145,11 +1207,10 @@ def tilequeue_consume_tile_traffic(cfg, peripherals):
         logger.info("Couldn't parse log file")
         sys.exit(1)
 
-    conn_info = dict(cfg.postgresql_conn_info)
-    dbnames = conn_info.pop('dbnames')
-    sql_conn_pool = DBConnectionPool(dbnames, conn_info, False)
-    sql_conn = sql_conn_pool.get_conns(1)[0]
-    with sql_conn.cursor() as cursor:
+    sql_conn_pool = make_db_connection_pool(
+        cfg.postgresql_conn_info, readonly=False)
+    with sql_conn_pool.get_conns(1) as sql_conns, \
+            sql_conns[0].cursor() as cursor:
 
         # insert the log records after the latest_date
         cursor.execute('SELECT max(date) from tile_traffic_v4')
@@ -1169,7 +1230,7 @@ def tilequeue_consume_tile_traffic(cfg, peripherals):
 
         logger.info('Inserted %d records' % n_coords_inserted)
 
-    sql_conn_pool.put_conns([sql_conn])
+    sql_conn_pool.close()
 
 
 def emit_toi_stats(toi_set, peripherals):
@@ -1177,21 +1238,97 @@ def emit_toi_stats(toi_set, peripherals):
     Calculates new TOI stats and emits them via statsd.
     """
 
-    count_by_zoom = defaultdict(int)
-    total = 0
-    for coord_int in toi_set:
-        coord = coord_unmarshall_int(coord_int)
-        count_by_zoom[coord.zoom] += 1
-        total += 1
+    if isinstance(toi_set, np.ndarray):
+        coord_ints = toi_set
+    else:
+        coord_ints = np.fromiter(toi_set, dtype=np.int64, count=len(toi_set))
+    count_by_zoom = np.bincount(coord_ints & zoom_mask)
+    total = len(coord_ints)
 
     peripherals.stats.gauge('tiles-of-interest.count', total)
-    for zoom, count in count_by_zoom.items():
+    for zoom, count in enumerate(count_by_zoom.tolist()):
+        if not count:
+            continue
         peripherals.stats.gauge(
             'tiles-of-interest.by-zoom.z{:02d}'.format(zoom),
             count
         )
 
 
+def tile_traffic_query(days, max_zoom, metatile_zoom):
+    """
+    Returns the sql for the number of requests for each metatile in the
+    tile traffic over the last days.
+
+    Requests for tiles smaller than the metatile are counted against
+    the metatile which contains them, which is done in the query so
+    that only one row per metatile is returned. Rows with a tile size
+    larger than the metatile, which isn't supported, are returned with
+    a null coordinate and the tile size, once per tile size.
+    """
+
+    # the zoom offset from each supported tile size to the metatile.
+    # a missing tile size means the default 256px tile.
+    size_offsets = ["when tilesize is null or tilesize = '' then %d" %
+                    metatile_zoom]
+    for size_zoom in xrange(metatile_zoom + 1):
+        size_offsets.append("when tilesize = '%d' then %d" % (
+            256 << size_zoom, metatile_zoom - size_zoom))
+
+    return """
+        select
+          z - zoom_offset,
+          cast(floor(x / pow(2, zoom_offset)) as bigint),
+          cast(floor(y / pow(2, zoom_offset)) as bigint),
+          case when zoom_offset is null then tilesize end,
+          sum(requests)
+        from (
+          select x, y, z, tilesize, count(*) as requests,
+            case {size_offsets} end as zoom_offset
+          from tile_traffic_v4
+          where (date >= (current_timestamp - interval '{days} days'))
+            and (z between 0 and {max_zoom})
+            and (x between 0 and pow(2,z)-1)
+            and (y between 0 and pow(2,z)-1)
+            and (service = 'vector-tiles')
+          group by z, x, y, tilesize
+        ) traffic
+        where (zoom_offset is null or z - zoom_offset >= 0)
+        group by 1, 2, 3, 4
+        """.format(
+            size_offsets=' '.join(size_offsets),
+            days=days,
+            max_zoom=max_zoom,
+        )
+
+
+def top_requested_tiles(rows, min_requests, max_tiles, logger):
+    """
+    Returns (count, coord int) for the max_tiles most requested tiles with
+    at least min_requests, from the rows of tile_traffic_query.
+
+    Only the top tiles are held, in a heap bounded by max_tiles, so the
+    rows can be streamed.
+    """
+
+    top_tiles = []
+    for z, x, y, bogus_tile_size, count in rows:
+        if z is None:
+            # we don't want bogus data to kill the whole process, but
+            # it's helpful to have a warning. the rows are skipped.
+            logger.warning('Tile size %r is bogus. Should be None, '
+                           '256, 512 or 1024' % (bogus_tile_size,))
+            continue
+        if count < min_requests:
+            continue
+        item = (count, coord_marshall_int(create_coord(x, y, z)))
+        if len(top_tiles) < max_tiles:
+            heapq.heappush(top_tiles, item)
+        elif top_tiles:
+            heapq.heappushpop(top_tiles, item)
+    return top_tiles
+
+
 def tilequeue_prune_tiles_of_interest(cfg, peripherals):
     logger = make_logger(cfg, 'prune_tiles_of_interest')
     logger.info('Pruning tiles of interest ...')
@@ -1229,79 +1366,28 @@ def tilequeue_prune_tiles_of_interest(cfg, peripherals):
         cfg.s3_date_prefix = store_parts['date-prefix']
         cfg.s3_path = store_parts['path']
 
-    redshift_results = defaultdict(int)
-    with psycopg2.connect(db_conn_info) as conn:
-        with conn.cursor() as cur:
-            cur.execute("""
-                select x, y, z, tilesize, count(*)
-                from tile_traffic_v4
-                where (date >= (current_timestamp - interval '{days} days'))
-                  and (z between 0 and {max_zoom})
-                  and (x between 0 and pow(2,z)-1)
-                  and (y between 0 and pow(2,z)-1)
-                  and (service = 'vector-tiles')
-                group by z, x, y, tilesize
-                order by z, x, y, tilesize
-                """.format(
-                    days=redshift_days_to_query,
-                    max_zoom=redshift_zoom_cutoff
-            ))
-            for (x, y, z, tile_size, count) in cur:
-                coord = create_coord(x, y, z)
-
-                try:
-                    tile_size_as_zoom = metatile_zoom_from_str(tile_size)
-                    # tile size as zoom > cfg.metatile_zoom would mean that
-                    # someone requested a tile larger than the system is
-                    # currently configured to support (might have been a
-                    # previous configuration).
-                    assert tile_size_as_zoom <= cfg.metatile_zoom
-                    tile_zoom_offset = tile_size_as_zoom - cfg.metatile_zoom
-
-                except AssertionError:
-                    # we don't want bogus data to kill the whole process, but
-                    # it's helpful to have a warning. we'll just skip the bad
-                    # row and continue.
-                    logger.warning('Tile size %r is bogus. Should be None, '
-                                   '256, 512 or 1024' % (tile_size,))
-                    continue
-
-                if tile_zoom_offset:
-                    # if the tile is not the same size as the metatile, then we
-                    # need to offset the zoom to make sure we enqueue the job
-                    # which results in this coordinate being rendered.
-                    coord = coord.zoomBy(tile_zoom_offset).container()
-
-                # just in case we fell off the end of the zoom scale.
-                if coord.zoom < 0:
-                    continue
-
-                # Sum the counts from the 256 and 512 tile requests into the
-                # slot for the 512 tile.
-                coord_int = coord_marshall_int(coord)
-                redshift_results[coord_int] += count
-
-    logger.info('Fetching tiles recently requested ... done. %s found',
-                len(redshift_results))
-
     cutoff_cfg = prune_cfg.get('cutoff', {})
     cutoff_requests = cutoff_cfg.get('min-requests', 0)
     cutoff_tiles = cutoff_cfg.get('max-tiles', 0)
 
-    logger.info('Finding %s tiles requested %s+ times ...',
-                cutoff_tiles,
-                cutoff_requests,
-                )
+    with psycopg2.connect(db_conn_info) as conn:
+        # a named cursor is server side, so that the rows are streamed
+        # rather than all held in memory at once
+        with conn.cursor(name='tile_traffic') as cur:
+            cur.itersize = 10000
+            cur.execute(tile_traffic_query(
+                redshift_days_to_query, redshift_zoom_cutoff,
+                cfg.metatile_zoom))
+            top_tiles = top_requested_tiles(
+                cur, cutoff_requests, cutoff_tiles, logger)
 
-    new_toi = set()
-    for coord_int, count in sorted(
-            redshift_results.iteritems(),
-            key=operator.itemgetter(1),
-            reverse=True)[:cutoff_tiles]:
-        if count >= cutoff_requests:
-            new_toi.add(coord_int)
+    logger.info('Fetching tiles recently requested ... done')
 
-    redshift_results = None
+    new_toi = np.fromiter(
+        (coord_int for _, coord_int in top_tiles), dtype=np.int64,
+        count=len(top_tiles))
+
+    top_tiles = None
 
     logger.info('Finding %s tiles requested %s+ times ... done. Found %s',
                 cutoff_tiles,
@@ -1309,7 +1395,9 @@ def tilequeue_prune_tiles_of_interest(cfg, peripherals):
                 len(new_toi),
                 )
 
-    for name, info in prune_cfg.get('always-include', {}).items():
+    always_include_cfg = prune_cfg.get('always-include', {})
+    new_toi_parts = [new_toi]
+    for name, info in always_include_cfg.items():
         logger.info('Adding in tiles from %s ...', name)
 
         immortal_tiles = set()
@@ -1345,44 +1433,57 @@ def tilequeue_prune_tiles_of_interest(cfg, peripherals):
                     immortal_tiles.add(coord_int)
 
         # Filter out nulls that might sneak in for various reasons
-        immortal_tiles = filter(None, immortal_tiles)
+        immortal_tiles.discard(None)
 
         n_inc = len(immortal_tiles)
-        new_toi = new_toi.union(immortal_tiles)
-
-        # ensure that the new coordinates have valid zooms
-        new_toi_valid_range = set()
-        for coord_int in new_toi:
-            coord = coord_unmarshall_int(coord_int)
-            if coord_is_valid(coord, cfg.max_zoom):
-                new_toi_valid_range.add(coord_int)
-        new_toi = new_toi_valid_range
+        new_toi_parts.append(np.fromiter(
+            immortal_tiles, dtype=np.int64, count=n_inc))
 
         logger.info('Adding in tiles from %s ... done. %s found', name, n_inc)
 
+    new_toi = np.unique(np.concatenate(new_toi_parts))
+    new_toi_parts = None
+
+    if always_include_cfg:
+        # ensure that the new coordinates have valid zooms
+        new_toi = new_toi[coord_ints_are_valid(new_toi, cfg.max_zoom)]
+
     logger.info('New tiles of interest set includes %s tiles', len(new_toi))
 
     logger.info('Fetching existing tiles of interest ...')
-    tiles_of_interest = peripherals.toi.fetch_tiles_of_interest()
+    if hasattr(peripherals.toi, 'fetch_tiles_of_interest_array'):
+        tiles_of_interest = peripherals.toi.fetch_tiles_of_interest_array()
+    else:
+        tiles_of_interest = np.unique(np.fromiter(
+            peripherals.toi.fetch_tiles_of_interest(), dtype=np.int64))
     n_toi = len(tiles_of_interest)
     logger.info('Fetching existing tiles of interest ... done. %s found',
                 n_toi)
 
     logger.info('Computing tiles to remove ...')
-    toi_to_remove = tiles_of_interest - new_toi
+    toi_to_remove = np.setdiff1d(
+        tiles_of_interest, new_toi, assume_unique=True)
     logger.info('Computing tiles to remove ... done. %s found',
                 len(toi_to_remove))
     peripherals.stats.gauge('gardener.removed', len(toi_to_remove))
 
+    logger.info('Computing tiles to add ...')
+    toi_to_add = np.setdiff1d(new_toi, tiles_of_interest, assume_unique=True)
+    logger.info('Computing tiles to add ... done. %s found',
+                len(toi_to_add))
+    peripherals.stats.gauge('gardener.added', len(toi_to_add))
+
+    tiles_of_interest = None
+
     store = _make_store(cfg)
-    if not toi_to_remove:
-        logger.info('Skipping TOI remove step because there are '
-                    'no tiles to remove')
-    else:
+
+    def _remove_tiles():
         logger.info('Removing %s tiles from TOI and S3 ...',
                     len(toi_to_remove))
 
-        for coord_ints in grouper(toi_to_remove, 1000):
+        # the store deletes each group in concurrent batches, so the
+        # groups are large enough to keep all of its threads busy.
+        for coord_ints in grouper(toi_to_remove.tolist(), 50000):
             removed = store.delete_tiles(
                 map(coord_unmarshall_int, coord_ints),
                 lookup_format_by_extension(
@@ -1392,26 +1493,36 @@ def tilequeue_prune_tiles_of_interest(cfg, peripherals):
         logger.info('Removing %s tiles from TOI and S3 ... done',
                     len(toi_to_remove))
 
-    logger.info('Computing tiles to add ...')
-    toi_to_add = new_toi - tiles_of_interest
-    logger.info('Computing tiles to add ... done. %s found',
-                len(toi_to_add))
-    peripherals.stats.gauge('gardener.added', len(toi_to_add))
-
-    if not toi_to_add:
-        logger.info('Skipping TOI add step because there are '
-                    'no tiles to add')
-    else:
+    def _enqueue_tiles():
         logger.info('Enqueueing %s tiles ...', len(toi_to_add))
 
         queue_writer = peripherals.queue_writer
-        n_queued, n_in_flight = queue_writer.enqueue_batch(
-            coord_unmarshall_int(coord_int) for coord_int in toi_to_add
-        )
+        n_queued, n_in_flight = queue_writer.enqueue_coord_ints(toi_to_add)
 
         logger.info('Enqueueing %s tiles ... done', len(toi_to_add))
 
-    if toi_to_add or toi_to_remove:
+    # removing from the store and enqueueing are independent, and both
+    # mostly wait on the network, so they run at the same time
+    prune_pool = ThreadPool(2)
+    async_results = []
+    if not len(toi_to_remove):
+        logger.info('Skipping TOI remove step because there are '
+                    'no tiles to remove')
+    else:
+        async_results.append(prune_pool.apply_async(_remove_tiles))
+    if not len(toi_to_add):
+        logger.info('Skipping TOI add step because there are '
+                    'no tiles to add')
+    else:
+        async_results.append(prune_pool.apply_async(_enqueue_tiles))
+    prune_pool.close()
+    try:
+        for async_result in async_results:
+            async_result.get()
+    finally:
+        prune_pool.join()
+
+    if len(toi_to_add) or len(toi_to_remove):
         logger.info('Setting new tiles of interest ... ')
 
         peripherals.toi.set_tiles_of_interest(new_toi)
@@ -1581,6 +1692,63 @@ def tilequeue_delete_stuck_tiles(cfg, peripherals):
     logger.info('Removing tiles from S3 ... DONE')
 
 
+def _make_store_hash_index(cfg, logger):
+    store = _make_store(cfg, logger)
+    hash_index = getattr(store, 'hash_index', None)
+    assert hash_index is not None, \
+        'Store hash index was not configured, set store hash-index.'
+    return store, hash_index
+
+
+def tilequeue_hash_index_invalidate(cfg, args):
+    """
+    Forget the stored content hashes for the coordinates on stdin, or all
+    of them, so that those tiles are checked against the store again.
+    """
+    logger = make_logger(cfg, 'hash_index_invalidate')
+    store, hash_index = _make_store_hash_index(cfg, logger)
+
+    if args.all:
+        logger.info('Clearing tile hash index ...')
+        hash_index.clear()
+        logger.info('Clearing tile hash index ... DONE')
+        return
+
+    format = lookup_format_by_extension(args.format)
+    layer = args.layer
+
+    logger.info('Invalidating tiles in hash index ...')
+    total_invalidated = 0
+    for coord_strs in grouper(sys.stdin, 1000):
+        coords = filter(None, map(deserialize_coord, coord_strs))
+        hash_index.invalidate(coords, format, layer)
+        total_invalidated += len(coords)
+
+    logger.info('Total invalidated: %d', total_invalidated)
+    logger.info('Invalidating tiles in hash index ... DONE')
+
+
+def tilequeue_hash_index_warm(cfg, args):
+    """
+    Fill the hash index from the hashes of the tiles in the store.
+    """
+    logger = make_logger(cfg, 'hash_index_warm')
+    store, hash_index = _make_store_hash_index(cfg, logger)
+
+    format = lookup_format_by_extension(args.format)
+    layer = args.layer
+
+    logger.info('Warming tile hash index ...')
+    total_warmed = 0
+    for coord_hashes in grouper(store.list_tile_hashes(format, layer), 1000):
+        hash_index.put_many(coord_hashes, format, layer)
+        total_warmed += len(coord_hashes)
+        logger.info('Warmed %d tiles', total_warmed)
+
+    logger.info('Total warmed: %d', total_warmed)
+    logger.info('Warming tile hash index ... DONE')
+
+
 def tilequeue_tile_status(cfg, peripherals, args):
     """
     Report the status of the given tiles in the store, queue and TOI.
@@ -1752,9 +1920,47 @@ def tilequeue_rawr_enqueue(cfg, args):
 
     with open(args.expiry_path) as fh:
         coords = create_coords_generator_from_tiles_file(fh)
+        # the query result cache needs to see the expired coordinates too,
+        # so keep them rather than only passing them through.
+        if cfg.yml.get('query-cache'):
+            coords = list(coords)
+            _invalidate_query_cache(cfg, coords, logger)
         rawr_enqueuer(coords)
 
 
+def _invalidate_query_cache(cfg, coords, logger):
+    from tilequeue.query import make_query_result_cache
+
+    query_cache = make_query_result_cache(cfg)
+    if query_cache.shared is None:
+        # each machine's disk cache is only invalidated by changing the
+        # data-version, as clearing it here wouldn't reach the others.
+        logger.warning('Query cache has no redis configured, so expired '
+                       'tiles are not invalidated')
+        return
+    logger.info('Invalidating query cache ...')
+    n_invalidated = query_cache.invalidate(coords)
+    logger.info('Invalidating query cache ... done, %d tiles',
+                n_invalidated)
+
+
+def tilequeue_query_cache_invalidate(cfg, args):
+    """
+    Remove cached query results for the tiles in a tile expiry file.
+    """
+    logger = make_logger(cfg, 'query_cache_invalidate')
+    query_cache_yaml = cfg.yml.get('query-cache')
+    assert query_cache_yaml, \
+        'Query cache was not configured, set query-cache.'
+    assert query_cache_yaml.get('redis'), \
+        'Query cache tiles can only be invalidated with query-cache redis ' \
+        'configured, change the data-version instead.'
+
+    with open(args.expiry_path) as fh:
+        coords = list(create_coords_generator_from_tiles_file(fh, logger))
+    _invalidate_query_cache(cfg, coords, logger)
+
+
 def tilequeue_rawr_process(cfg, peripherals):
     """command to read from rawr queue and generate rawr tiles"""
     from tilequeue.rawr import make_rawr_queue_from_yaml
@@ -2229,6 +2435,32 @@ def tilequeue_main(argv_args=None):
                            help='path to tile expiry file')
     subparser.set_defaults(func=tilequeue_rawr_enqueue)
 
+    subparser = subparsers.add_parser('hash-index-invalidate')
+    subparser.add_argument('--config', required=True,
+                           help='The path to the tilequeue config file.')
+    subparser.add_argument('--all', action='store_true',
+                           help='Invalidate every tile, rather than the '
+                           'coordinates read from stdin.')
+    subparser.add_argument('--format', default='zip',
+                           help='Tile format extension.')
+    subparser.add_argument('--layer', default='all', help='Tile layer.')
+    subparser.set_defaults(func=tilequeue_hash_index_invalidate)
+
+    subparser = subparsers.add_parser('hash-index-warm')
+    subparser.add_argument('--config', required=True,
+                           help='The path to the tilequeue config file.')
+    subparser.add_argument('--format', default='zip',
+                           help='Tile format extension.')
+    subparser.add_argument('--layer', default='all', help='Tile layer.')
+    subparser.set_defaults(func=tilequeue_hash_index_warm)
+
+    subparser = subparsers.add_parser('query-cache-invalidate')
+    subparser.add_argument('--config', required=True,
+                           help='The path to the tilequeue config file.')
+    subparser.add_argument('--expiry-path', required=True,
+                           help='path to tile expiry file')
+    subparser.set_defaults(func=tilequeue_query_cache_invalidate)
+
     subparser = subparsers.add_parser('batch-process')
     subparser.add_argument('--config', required=True,
                            help='The path to the tilequeue config file.')
@@ -47,6 +47,7 @@ class Configuration(object):
 
         toi_store_cfg = self.yml['toi-store']
         self.toi_store_type = toi_store_cfg['type']
+        self.toi_store_format = toi_store_cfg['format']
         if self.toi_store_type == 's3':
             self.toi_store_s3_bucket = toi_store_cfg['s3']['bucket']
             self.toi_store_s3_key = toi_store_cfg['s3']['key']
@@ -96,12 +97,21 @@ class Configuration(object):
             process_cfg['n-simultaneous-query-sets']
         self.n_simultaneous_s3_storage = \
             process_cfg['n-simultaneous-s3-storage']
+        self.n_query_threads = process_cfg['n-query-threads']
+        self.n_store_threads = process_cfg['n-store-threads']
+        self.pool_stats_interval_seconds = \
+            process_cfg['pool-stats-interval-seconds']
         self.log_queue_sizes = process_cfg['log-queue-sizes']
         self.log_queue_sizes_interval_seconds = \
             process_cfg['log-queue-sizes-interval-seconds']
         self.query_cfg = process_cfg['query-config']
         self.template_path = process_cfg['template-path']
         self.reload_templates = process_cfg['reload-templates']
+        self.prepared_queries = process_cfg['prepared-queries']
+        self.slow_query_seconds = process_cfg['slow-query-seconds']
+        self.slow_query_explain = process_cfg['slow-query-explain']
+        self.query_timeout_seconds = process_cfg['query-timeout-seconds']
+        self.fetch_timeout_seconds = process_cfg['fetch-timeout-seconds']
         self.output_formats = process_cfg['formats']
         self.buffer_cfg = process_cfg['buffer']
         self.process_yaml_cfg = process_cfg['yaml']
@@ -163,6 +173,9 @@ def default_yml_config():
             'reduced-redundancy': False,
             'date-prefix': '',
             'delete-retry-interval': 60,
+            'delete-threads': 16,
+            'hash-index': None,
+            'max-attempts': 5,
         },
         'aws': {
             'credentials': {
@@ -204,6 +217,7 @@ def default_yml_config():
         },
         'toi-store': {
             'type': None,
+            'format': 'gzip',
         },
         'toi-prune': {
             'tile-traffic-log-path': '/tmp/tile-traffic.log',
@@ -211,11 +225,19 @@ def default_yml_config():
         'process': {
             'n-simultaneous-query-sets': 0,
             'n-simultaneous-s3-storage': 0,
+            'n-query-threads': 0,
+            'n-store-threads': 0,
+            'pool-stats-interval-seconds': 10,
             'log-queue-sizes': True,
             'log-queue-sizes-interval-seconds': 10,
             'query-config': None,
             'template-path': None,
             'reload-templates': False,
+            'prepared-queries': False,
+            'slow-query-seconds': None,
+            'slow-query-explain': False,
+            'query-timeout-seconds': None,
+            'fetch-timeout-seconds': None,
             'formats': ['json'],
             'buffer': {},
             'yaml': {
@@ -265,6 +265,16 @@ class MultipleMessagesTrackerLogger(object):
     def unknown_coord_id(self, coord_id, queue_handle_id):
         self._log('Unknown coord_id', coord_id, queue_handle_id)
 
+    def expired_queue_handle_id(self, queue_handle_id):
+        json_obj = dict(
+            type=log_level_name(LogLevel.WARNING),
+            category=log_category_name(LogCategory.PROCESS),
+            msg='Expired queue_handle_id',
+            handle=queue_handle_id,
+        )
+        json_str = json.dumps(json_obj)
+        self.logger.warning(json_str)
+
 
 class BatchProcessLogger(object):
 
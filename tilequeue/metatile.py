@@ -1,5 +1,6 @@
 import zipfile
 import cStringIO as StringIO
+import hashlib
 from collections import defaultdict
 from tilequeue.format import zip_format
 from time import gmtime
@@ -175,10 +176,39 @@ def metatiles_are_equal(tile_data_1, tile_data_2):
             with zipfile.ZipFile(buf_2, mode='r') as zip_2:
                 return _metatile_contents_equal(zip_1, zip_2)
 
-    except (StandardError, zipfile.BadZipFile, zipfile.LargeZipFile):
+    except (StandardError, zipfile.BadZipfile, zipfile.LargeZipFile):
         # errors, such as files not being proper zip files, or missing
         # some attributes or contents that we expect, are treated as not
         # equal.
         pass
 
     return False
+
+
+def metatile_content_hash(tile_data):
+    """
+    Return a hex digest of the contents of a zipped metatile, or None if
+    the data isn't a readable zip file.
+
+    The hash covers the names and contents of the files in the zip, in
+    sorted name order, so that two metatiles which metatiles_are_equal
+    considers equal have the same hash regardless of the timestamps or
+    order of the files within them.
+    """
+
+    try:
+        buf = StringIO.StringIO(tile_data)
+        with zipfile.ZipFile(buf, mode='r') as zf:
+            m = hashlib.md5()
+            for name in sorted(zf.namelist()):
+                contents = zf.read(name)
+                # lengths are included so that the boundaries between names
+                # and contents are unambiguous.
+                m.update('%d:%s%d:' % (len(name), name, len(contents)))
+                m.update(contents)
+            return m.hexdigest()
+
+    except (StandardError, zipfile.BadZipfile, zipfile.LargeZipFile):
+        pass
+
+    return None
@@ -1,5 +1,8 @@
+from tilequeue.query.cache import CachingDataFetcher
+from tilequeue.query.cache import make_query_result_cache
 from tilequeue.query.fixture import make_fixture_data_fetcher
 from tilequeue.query.pool import DBConnectionPool
+from tilequeue.query.pool import make_db_connection_pool
 from tilequeue.query.postgres import make_db_data_fetcher
 from tilequeue.query.rawr import make_rawr_data_fetcher
 from tilequeue.query.split import make_split_data_fetcher
@@ -7,21 +10,36 @@ from tilequeue.process import Source
 
 
 __all__ = [
+    'CachingDataFetcher',
     'DBConnectionPool',
+    'make_db_connection_pool',
     'make_db_data_fetcher',
     'make_fixture_data_fetcher',
+    'make_query_result_cache',
     'make_data_fetcher',
 ]
 
 
-def make_data_fetcher(cfg, layer_data, query_cfg, io_pool):
+def make_data_fetcher(cfg, layer_data, query_cfg, io_pool,
+                      stats_handler=None, logger=None):
+    slow_query_log = None
+    if cfg.slow_query_seconds is not None and logger is not None:
+        from tilequeue.query.postgres import SlowQueryLog
+        slow_query_log = SlowQueryLog(
+            logger, cfg.slow_query_seconds, cfg.slow_query_explain)
+
     db_fetcher = make_db_data_fetcher(
         cfg.postgresql_conn_info, cfg.template_path, cfg.reload_templates,
-        query_cfg, io_pool)
+        query_cfg, io_pool, cfg.prepared_queries, stats_handler,
+        slow_query_log, cfg.fetch_timeout_seconds, cfg.query_timeout_seconds)
+
+    query_cache = make_query_result_cache(cfg, query_cfg)
+    if query_cache is not None:
+        db_fetcher = CachingDataFetcher(db_fetcher, query_cache)
 
     if cfg.yml.get('use-rawr-tiles'):
         rawr_fetcher = _make_rawr_fetcher(
-            cfg, layer_data, query_cfg, io_pool)
+            cfg, layer_data, query_cfg, io_pool, stats_handler)
 
         group_by_zoom = cfg.yml.get('rawr').get('group-zoom')
         assert group_by_zoom is not None, 'Missing group-zoom rawr config'
@@ -53,7 +71,8 @@ class _NullRawrStorage(object):
         return _tables
 
 
-def _make_rawr_fetcher(cfg, layer_data, query_cfg, io_pool):
+def _make_rawr_fetcher(cfg, layer_data, query_cfg, io_pool,
+                       stats_handler=None):
     rawr_yaml = cfg.yml.get('rawr')
     assert rawr_yaml is not None, 'Missing rawr configuration in yaml'
 
@@ -134,15 +153,48 @@ def _make_rawr_fetcher(cfg, layer_data, query_cfg, io_pool):
         assert False, 'Source type %r not understood. ' \
             'Options are s3, generate and store.' % (source_type,)
 
+    # tiles read from s3 or a store can be kept on local disk, and are only
+    # read again when they change.
+    rawr_cache_yaml = rawr_source_yaml.get('cache')
+    if rawr_cache_yaml and source_type in ('s3', 'store'):
+        from tilequeue.query.cache import DiskResultCache
+        from tilequeue.rawr import RawrCachedSource
+
+        cache_path = rawr_cache_yaml.get('path')
+        assert cache_path, 'Missing rawr source cache path'
+        cache = DiskResultCache(
+            cache_path,
+            rawr_cache_yaml.get('max-size-bytes', 10 * 1024 * 1024 * 1024))
+        storage = RawrCachedSource(
+            storage, cache, table_sources, stats_handler)
+
     # TODO: this needs to be configurable, everywhere! this is a long term
     # refactor - it's hard-coded in a bunch of places :-(
     max_z = 16
 
     layers = _make_layer_info(layer_data, cfg.process_yaml_cfg)
 
+    # recently built RAWR tiles are kept in memory, so that jobs for the same
+    # RAWR tile don't have to index it again.
+    tile_cache = None
+    tile_cache_yaml = rawr_yaml.get('tile-cache')
+    if tile_cache_yaml:
+        from tilequeue.query.rawr import RawrTileCache
+        max_size_bytes = tile_cache_yaml.get('max-size-bytes')
+        assert max_size_bytes, 'Missing rawr tile-cache max-size-bytes'
+        tile_cache = RawrTileCache(max_size_bytes)
+
+    # the simple indexes can be built on their own threads, alongside the OSM
+    # index.
+    index_pool = None
+    n_index_threads = rawr_yaml.get('index-threads')
+    if n_index_threads:
+        from multiprocessing.pool import ThreadPool
+        index_pool = ThreadPool(n_index_threads)
+
     return make_rawr_data_fetcher(
         group_by_zoom, max_z, storage, layers, indexes_cfg,
-        label_placement_layers)
+        label_placement_layers, tile_cache, index_pool)
 
 
 def _make_layer_info(layer_data, process_yaml_cfg):
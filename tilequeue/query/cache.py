@@ -0,0 +1,459 @@
+from tilequeue.tile import coord_int_zoom_up
+from tilequeue.tile import coord_marshall_int
+from tilequeue.tile import coord_unmarshall_int
+from tilequeue.tile import mercator_point_to_coord
+from tilequeue.tile import serialize_coord
+import cPickle as pickle
+import hashlib
+import logging
+import math
+import os
+import threading
+
+
+# the width of the world in mercator meters, used to find the zoom of a
+# tile from the width of its bounds.
+_world_width = 2 * 20037508.342789244
+
+
+def bounds_coord(bounds):
+    """
+    Returns the coordinate of the tile with the given unpadded bounds.
+    """
+
+    minx, miny, maxx, maxy = bounds
+    zoom = int(round(math.log(_world_width / (maxx - minx), 2)))
+    return mercator_point_to_coord(
+        zoom, (minx + maxx) / 2.0, (miny + maxy) / 2.0)
+
+
+# files are written under a temporary name containing this, and then
+# renamed once complete.
+_swap_marker = '.swp-'
+
+# size of the chunks used to copy results to the cache
+_copy_chunk_size = 1024 * 1024
+
+
+def _coord_path(coord):
+    return os.path.join(
+        str(int(coord.zoom)), str(int(coord.column)), str(int(coord.row)))
+
+
+class DiskResultCache(object):
+
+    """Least recently used cache of results in a local directory
+
+    Used for query results and RAWR tiles. Results are stored in a
+    directory per tile. When the total size of the cache grows over
+    max_size_bytes, the least recently used results are removed.
+    """
+
+    def __init__(self, path, max_size_bytes):
+        self.path = path
+        self.max_size_bytes = max_size_bytes
+        self.lock = threading.Lock()
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        self.size_bytes = self._dir_size(path)
+
+    def _dir_size(self, path):
+        size_bytes = 0
+        for root, dirs, files in os.walk(path):
+            for name in files:
+                try:
+                    size_bytes += os.path.getsize(os.path.join(root, name))
+                except OSError:
+                    pass
+        return size_bytes
+
+    def get_path(self, coord, key):
+        """
+        Returns the path of the file holding the result, or None if it
+        isn't in the cache. The file can be removed by eviction at any
+        time after this, so should be opened straight away.
+        """
+
+        file_path = os.path.join(self.path, _coord_path(coord), key)
+        try:
+            # the modification time is used as the last use time
+            os.utime(file_path, None)
+        except OSError:
+            return None
+        return file_path
+
+    def get(self, coord, key):
+        file_path = self.get_path(coord, key)
+        if file_path is None:
+            return None
+        try:
+            with open(file_path, 'rb') as fp:
+                return fp.read()
+        except IOError:
+            return None
+
+    def keys(self, coord):
+        """
+        Returns the keys of the results cached for the coordinate.
+        """
+
+        dir_path = os.path.join(self.path, _coord_path(coord))
+        try:
+            names = os.listdir(dir_path)
+        except OSError:
+            return []
+        return [name for name in names if _swap_marker not in name]
+
+    def set(self, coord, key, data):
+        self._write(coord, key, lambda fp: fp.write(data))
+
+    def set_fp(self, coord, key, src_fp):
+        """
+        Cache the result read from the file-like object, a chunk at a
+        time so that it doesn't have to be held in memory.
+        """
+
+        def write(fp):
+            while True:
+                chunk = src_fp.read(_copy_chunk_size)
+                if not chunk:
+                    break
+                fp.write(chunk)
+        self._write(coord, key, write)
+
+    def _write(self, coord, key, write):
+        dir_path = os.path.join(self.path, _coord_path(coord))
+        try:
+            os.makedirs(dir_path)
+        except OSError:
+            pass
+        file_path = os.path.join(dir_path, key)
+        swap_file_path = '%s%s%s-%s' % (
+            file_path, _swap_marker, os.getpid(),
+            threading.currentThread().ident)
+        try:
+            with open(swap_file_path, 'wb') as fp:
+                write(fp)
+                size_bytes = fp.tell()
+            os.rename(swap_file_path, file_path)
+        except Exception:
+            try:
+                os.remove(swap_file_path)
+            except OSError:
+                pass
+            raise
+
+        with self.lock:
+            self.size_bytes += size_bytes
+            if self.size_bytes > self.max_size_bytes:
+                self._evict()
+
+    def remove(self, coord, key):
+        file_path = os.path.join(self.path, _coord_path(coord), key)
+        try:
+            size_bytes = os.path.getsize(file_path)
+            os.remove(file_path)
+        except OSError:
+            return
+        with self.lock:
+            self.size_bytes -= size_bytes
+
+    def _evict(self):
+        # must be called with the lock held. removes the least recently
+        # used results until the cache is back under 90% of its size, so
+        # that eviction doesn't happen on every write.
+        files = []
+        for root, dirs, names in os.walk(self.path):
+            for name in names:
+                # files still being written aren't evicted
+                if _swap_marker in name:
+                    continue
+                file_path = os.path.join(root, name)
+                try:
+                    st = os.stat(file_path)
+                except OSError:
+                    continue
+                files.append((st.st_mtime, st.st_size, file_path))
+        files.sort()
+
+        size_bytes = sum(size for _, size, _ in files)
+        target_size_bytes = int(self.max_size_bytes * 0.9)
+        for _, size, file_path in files:
+            if size_bytes <= target_size_bytes:
+                break
+            try:
+                os.remove(file_path)
+            except OSError:
+                continue
+            size_bytes -= size
+        self.size_bytes = size_bytes
+
+
+class RedisResultCache(object):
+
+    """Query results shared between machines in redis
+
+    The results for each tile are kept in a redis hash, so that they can
+    all be removed when the tile expires. Each tile also has a generation
+    number, which goes up every time the tile is invalidated. It's part
+    of the result keys, so that results cached on the local disks of
+    other machines are not used after an invalidation. The generations
+    don't expire, and there is one for at most every tile up to the
+    cache's max zoom.
+    """
+
+    def __init__(self, redis_client, key_prefix, ttl_seconds,
+                 max_entry_bytes):
+        self.redis_client = redis_client
+        self.key_prefix = key_prefix
+        self.ttl_seconds = ttl_seconds
+        self.max_entry_bytes = max_entry_bytes
+
+    def _key(self, coord):
+        return '%s.%d' % (self.key_prefix, coord_marshall_int(coord))
+
+    def _generation_key(self, coord):
+        return '%s.generation.%d' % (
+            self.key_prefix, coord_marshall_int(coord))
+
+    def generation(self, coord):
+        generation = self.redis_client.get(self._generation_key(coord))
+        if generation is None:
+            return 0
+        return int(generation)
+
+    def get(self, coord, key):
+        return self.redis_client.hget(self._key(coord), key)
+
+    def set(self, coord, key, data):
+        if len(data) > self.max_entry_bytes:
+            return
+        redis_key = self._key(coord)
+        with self.redis_client.pipeline() as pipe:
+            pipe.hset(redis_key, key, data)
+            if self.ttl_seconds:
+                pipe.expire(redis_key, self.ttl_seconds)
+            pipe.execute()
+
+    def invalidate(self, coords):
+        for i in xrange(0, len(coords), 1000):
+            batch = coords[i:i + 1000]
+            with self.redis_client.pipeline() as pipe:
+                for coord in batch:
+                    pipe.incr(self._generation_key(coord))
+                pipe.delete(*[self._key(coord) for coord in batch])
+                pipe.execute()
+
+
+class QueryResultCache(object):
+
+    """Cache of query results for low zoom tiles
+
+    Results are keyed on the zoom, bounds, a hash of the query templates
+    and a data version, which can be changed to invalidate the whole
+    cache. Results are looked up on local disk first, and then in the
+    shared tier if there is one.
+
+    Individual tiles can only be invalidated when there is a shared tier,
+    which keeps the generation of each tile for every machine. Without
+    one, the disk tier of each machine is only invalidated by changing
+    the data version.
+
+    Errors from the tiers, such as a lost redis connection or a full disk,
+    are logged rather than raised, and reads which fail are treated as
+    misses, so that tiles can still be fetched from the database.
+    """
+
+    def __init__(self, max_zoom, template_hash, data_version='',
+                 disk=None, shared=None, logger=None):
+        self.max_zoom = max_zoom
+        self.template_hash = template_hash
+        self.data_version = data_version
+        self.disk = disk
+        self.shared = shared
+        self.tiers = [tier for tier in (disk, shared) if tier is not None]
+        if logger is None:
+            logger = logging.getLogger('query_cache')
+        self.logger = logger
+
+    def _log_failure(self, action, tier, coord):
+        self.logger.warning(
+            'Query cache %s failed in %s for %s', action,
+            type(tier).__name__, serialize_coord(coord), exc_info=True)
+
+    def generation(self, coord):
+        """
+        Returns the generation of the tile, which has to be looked up
+        before its results are, and passed to get and set. Returns None
+        when it can't be looked up, and then nothing is cached.
+        """
+
+        if self.shared is None:
+            return 0
+        try:
+            return self.shared.generation(coord)
+        except Exception:
+            self._log_failure('generation read', self.shared, coord)
+            return None
+
+    def key(self, zoom, bounds, generation=0):
+        key_str = '%s:%s:%d:%d:%s' % (
+            self.data_version, self.template_hash, generation, zoom,
+            ','.join('%.6f' % b for b in bounds))
+        return hashlib.md5(key_str).hexdigest()
+
+    def get(self, zoom, bounds, generation=0):
+        if generation is None:
+            return None
+        coord = bounds_coord(bounds)
+        key = self.key(zoom, bounds, generation)
+        for i, tier in enumerate(self.tiers):
+            try:
+                data = tier.get(coord, key)
+            except Exception:
+                self._log_failure('read', tier, coord)
+                continue
+            if data is not None:
+                # fill in the faster tiers which missed
+                for faster_tier in self.tiers[:i]:
+                    self._set(faster_tier, coord, key, data)
+                return pickle.loads(data)
+        return None
+
+    def set(self, zoom, bounds, rows, generation=0):
+        if generation is None:
+            return
+        coord = bounds_coord(bounds)
+        key = self.key(zoom, bounds, generation)
+        data = pickle.dumps(rows, pickle.HIGHEST_PROTOCOL)
+        for tier in self.tiers:
+            self._set(tier, coord, key, data)
+
+    def _set(self, tier, coord, key, data):
+        try:
+            tier.set(coord, key, data)
+        except Exception:
+            self._log_failure('write', tier, coord)
+
+    def invalidate(self, coords):
+        """
+        Remove the cached results for tiles containing any of the
+        coordinates, for example from an expiry list. Needs a shared
+        tier.
+        """
+
+        assert self.shared is not None, \
+            'Query cache tiles can only be invalidated with redis ' \
+            'configured, change the data-version instead.'
+
+        coord_ints = set()
+        for coord in coords:
+            coord_int = coord_marshall_int(coord)
+            zoom = coord.zoom
+            while zoom > self.max_zoom:
+                coord_int = coord_int_zoom_up(coord_int)
+                zoom -= 1
+            while coord_int not in coord_ints:
+                coord_ints.add(coord_int)
+                if zoom == 0:
+                    break
+                coord_int = coord_int_zoom_up(coord_int)
+                zoom -= 1
+
+        tile_coords = map(coord_unmarshall_int, coord_ints)
+        self.shared.invalidate(tile_coords)
+        return len(tile_coords)
+
+
+class CachingDataFetcher(object):
+
+    """Data fetcher which caches the query results of low zoom tiles"""
+
+    def __init__(self, fetcher, cache):
+        self.fetcher = fetcher
+        self.cache = cache
+
+    def fetch_tiles(self, all_data):
+        for data in all_data:
+            yield self, data
+
+    def __call__(self, zoom, unpadded_bounds):
+        if zoom > self.cache.max_zoom:
+            return self.fetcher(zoom, unpadded_bounds)
+
+        # the generation is looked up before fetching, so that results
+        # fetched during an invalidation aren't cached as the new ones.
+        generation = self.cache.generation(bounds_coord(unpadded_bounds))
+        rows = self.cache.get(zoom, unpadded_bounds, generation)
+        if rows is None:
+            rows = self.fetcher(zoom, unpadded_bounds)
+            self.cache.set(zoom, unpadded_bounds, rows, generation)
+        return rows
+
+
+def templates_hash(sources, template_path):
+    """
+    Returns a hash of the sources config and the contents of all the
+    templates it uses, so that cached results aren't used after the
+    queries change.
+    """
+
+    m = hashlib.md5()
+    for source in sorted(sources, key=lambda s: s.name):
+        for spec in source.template_specs:
+            m.update('%s:%s:%d:%d\n' % (
+                source.name, spec.template, spec.start_zoom, spec.end_zoom))
+            with open(os.path.join(template_path, spec.template)) as fp:
+                m.update(fp.read())
+    return m.hexdigest()
+
+
+def make_query_result_cache(cfg, query_cfg=None, redis_client=None,
+                            logger=None):
+    """
+    Returns a QueryResultCache from the query-cache config, or None if
+    it isn't configured. The query config is only needed to look up
+    results, and can be left out when the cache is only invalidated.
+    """
+
+    cache_yaml = cfg.yml.get('query-cache')
+    if not cache_yaml:
+        return None
+
+    disk = None
+    disk_yaml = cache_yaml.get('disk')
+    if disk_yaml:
+        path = disk_yaml.get('path')
+        assert path, 'Missing query-cache disk path'
+        disk = DiskResultCache(
+            path, disk_yaml.get('max-size-bytes', 1024 * 1024 * 1024))
+
+    shared = None
+    redis_yaml = cache_yaml.get('redis')
+    if redis_yaml:
+        if redis_client is None:
+            from redis import StrictRedis
+            redis_client = StrictRedis(
+                cfg.redis_host, cfg.redis_port, cfg.redis_db)
+        shared = RedisResultCache(
+            redis_client,
+            redis_yaml.get('key-prefix', 'tilequeue.query-cache'),
+            redis_yaml.get('ttl-seconds', 7 * 24 * 60 * 60),
+            redis_yaml.get('max-entry-bytes', 32 * 1024 * 1024))
+
+    assert disk or shared, 'query-cache needs disk or redis configured'
+
+    template_hash = ''
+    if query_cfg is not None:
+        from tilequeue.query.postgres import parse_source_data
+        sources = parse_source_data(query_cfg)
+        template_hash = templates_hash(sources, cfg.template_path)
+
+    return QueryResultCache(
+        cache_yaml.get('max-zoom', 8),
+        template_hash,
+        str(cache_yaml.get('data-version', '')),
+        disk=disk,
+        shared=shared,
+        logger=logger,
+    )
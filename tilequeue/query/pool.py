@@ -1,56 +1,401 @@
-from itertools import cycle
-from itertools import islice
+from operator import attrgetter
+from psycopg2.extensions import TRANSACTION_STATUS_IDLE
+from psycopg2.extras import HstoreAdapter
 from psycopg2.extras import register_hstore, register_json
 import psycopg2
+import sys
 import threading
+import time
 import ujson
 
 
 class ConnectionsContextManager(object):
 
-    """Handle automatically closing connections via with statement"""
+    """Return connections to the pool via with statement"""
 
-    def __init__(self, conns):
+    def __init__(self, conns, pool):
         self.conns = conns
+        self.pool = pool
 
     def __enter__(self):
         return self.conns
 
     def __exit__(self, exc_type, exc_val, exc_tb):
-        for conn in self.conns:
-            try:
-                conn.close()
-            except Exception:
-                pass
+        self.pool.put_conns(self.conns)
         suppress_exception = False
         return suppress_exception
 
 
+class _ConnInfo(object):
+
+    __slots__ = ('target', 'created_at', 'last_used_at')
+
+    def __init__(self, target, now):
+        self.target = target
+        self.created_at = now
+        self.last_used_at = now
+
+
+class _Target(object):
+
+    """A database, a dbname on a host, that queries can be sent to"""
+
+    __slots__ = ('host', 'dbname', 'n_inflight', 'latency_seconds',
+                 'ejected_until')
+
+    def __init__(self, host, dbname):
+        self.host = host
+        self.dbname = dbname
+        # number of connections to the target which are in use
+        self.n_inflight = 0
+        # moving average of the query latency, None until the first query
+        self.latency_seconds = None
+        # the target isn't used until this time after it fails
+        self.ejected_until = 0
+
+    @property
+    def key(self):
+        return (self.host, self.dbname)
+
+
+class ConnectionPoolTimeout(Exception):
+
+    """Raised when connections aren't available in time"""
+
+
 class DBConnectionPool(object):
 
-    """Manage database connections with varying database names"""
+    """Manage database connections with varying hosts and database names
+
+    Each query set is sent to the least loaded of the targets, which are
+    every dbname on every host. The load of a target is the number of
+    connections to it in use, weighted by a moving average of its query
+    latency, so that slow replicas are sent fewer queries. Targets which
+    fail, either to connect or with record_failure, aren't used again for
+    eject_seconds, unless every target has failed.
 
-    def __init__(self, dbnames, conn_info, readonly=True):
-        self.dbnames = cycle(dbnames)
+    Connections are kept open between uses, idle per target, and re-used.
+    Connections which have been idle for longer than health_check_seconds
+    are checked before being handed out, and those older than
+    max_lifetime_seconds are closed rather than re-used. When max_size is
+    set, no more than that many connections are open to each target at
+    once and callers wait for enough of them to be returned.
+    """
+
+    # weight of the latest query in the moving average of the latency
+    latency_alpha = 0.2
+
+    def __init__(self, dbnames, conn_info, readonly=True, max_size=None,
+                 max_lifetime_seconds=3600, health_check_seconds=30,
+                 hosts=None, eject_seconds=30):
+        if not hosts:
+            hosts = [conn_info.get('host')]
+        self.targets = [_Target(host, dbname)
+                        for host in hosts for dbname in dbnames]
         self.conn_info = conn_info
-        self.conn_mapping = {}
         self.lock = threading.Lock()
+        self.conn_available = threading.Condition(self.lock)
         self.readonly = readonly
+        self.max_size = max_size
+        self.max_lifetime_seconds = max_lifetime_seconds
+        self.health_check_seconds = health_check_seconds
+        self.eject_seconds = eject_seconds
+
+        # target key -> list of idle connections, most recently used last
+        self.idle_conns = dict((t.key, []) for t in self.targets)
+        # target key -> number of open connections, idle or in use
+        self.n_open_conns = dict((t.key, 0) for t in self.targets)
+        # connection -> _ConnInfo, for every open connection
+        self.conn_infos = {}
+
+        # the type oids are the same for every connection to a database,
+        # so they're looked up once rather than on every connection.
+        # target key -> (hstore oids, hstore array oids)
+        self.hstore_oids = {}
 
     def _make_conn(self, conn_info):
         conn = psycopg2.connect(**conn_info)
         conn.set_session(readonly=self.readonly, autocommit=True)
-        register_hstore(conn)
+        key = (conn_info.get('host'), conn_info.get('dbname'))
+        oids = self.hstore_oids.get(key)
+        if oids is None:
+            oids = HstoreAdapter.get_oids(conn)
+            self.hstore_oids[key] = oids
+        oid, array_oid = oids
+        register_hstore(conn, oid=oid, array_oid=array_oid)
         register_json(conn, loads=ujson.loads)
         return conn
 
-    def get_conns(self, n_conn):
+    def _is_expired(self, conn_info, now):
+        return self.max_lifetime_seconds is not None and \
+            now - conn_info.created_at > self.max_lifetime_seconds
+
+    def _is_healthy(self, conn):
+        try:
+            with conn.cursor() as cursor:
+                cursor.execute('SELECT 1')
+            return True
+        except Exception:
+            return False
+
+    def _close(self, conn):
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+    def _discard(self, conn):
+        # must be called with the lock held
+        conn_info = self.conn_infos.pop(conn)
+        self.n_open_conns[conn_info.target.key] -= 1
+        self.conn_available.notify_all()
+
+    def _eject(self, target, now):
+        # must be called with the lock held
+        target.ejected_until = now + self.eject_seconds
+
+    def _load(self, target):
+        # with no latency yet, the target is treated as fast so that it
+        # gets tried.
+        latency = target.latency_seconds or 0.0
+        return (target.n_inflight + 1) * latency, target.n_inflight
+
+    def _has_capacity(self, target):
+        # must be called with the lock held
+        return self.max_size is None or \
+            bool(self.idle_conns[target.key]) or \
+            self.n_open_conns[target.key] < self.max_size
+
+    def _choose_target(self, now, exclude=()):
+        # must be called with the lock held. returns None when every
+        # target which could be used is full.
+        candidates = [t for t in self.targets if t not in exclude] or \
+            self.targets
+        healthy = [t for t in candidates if t.ejected_until <= now]
+        if healthy:
+            candidates = healthy
+            key = self._load
+        else:
+            # everything has failed recently, so try the target which
+            # will be back soonest rather than failing outright.
+            key = attrgetter('ejected_until')
+        candidates = [t for t in candidates if self._has_capacity(t)]
+        if not candidates:
+            return None
+        return min(candidates, key=key)
+
+    def _wait(self, deadline):
+        # must be called with the lock held
+        if deadline is None:
+            self.conn_available.wait()
+            return
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            raise ConnectionPoolTimeout()
+        self.conn_available.wait(remaining)
+
+    def _reserve(self, n_conn, deadline, exclude):
+        # must be called with the lock held. connections for the whole
+        # set are taken in one step, so that a caller never holds some
+        # connections while it waits for others. returns a list of
+        # (target, idle connection or None to connect to the target).
+        while True:
+            now = time.time()
+            reserved = []
+            for i in xrange(n_conn):
+                target = self._choose_target(now, exclude)
+                if target is None:
+                    break
+                target.n_inflight += 1
+                reserved.append((target, self._take(target)))
+            else:
+                return reserved
+
+            # every target is full, so give back what was taken and wait
+            # to choose again.
+            for target, conn in reversed(reserved):
+                target.n_inflight -= 1
+                if conn is None:
+                    self.n_open_conns[target.key] -= 1
+                else:
+                    self.idle_conns[target.key].append(conn)
+            self._wait(deadline)
+
+    def _take(self, target):
+        # must be called with the lock held
+        idle = self.idle_conns[target.key]
+        if idle:
+            return idle.pop()
+        # reserve the slot before connecting, outside the lock
+        self.n_open_conns[target.key] += 1
+        return None
+
+    def _release(self, target):
+        # must be called with the lock held. gives back a slot reserved
+        # with _take which didn't get a connection.
+        target.n_inflight -= 1
+        self.n_open_conns[target.key] -= 1
+        self.conn_available.notify_all()
+
+    def _connect(self, target):
+        conn_info_with_db = dict(self.conn_info, dbname=target.dbname)
+        if target.host is not None:
+            conn_info_with_db['host'] = target.host
+        conn = self._make_conn(conn_info_with_db)
+        with self.lock:
+            self.conn_infos[conn] = _ConnInfo(target, time.time())
+        return conn
+
+    def _check_conn(self, conn):
+        # returns the connection if it can be re-used, otherwise closes it
+        # and returns None, keeping its slot for a new connection.
+        now = time.time()
+        with self.lock:
+            conn_info = self.conn_infos[conn]
+        if self._is_expired(conn_info, now) or (
+                self.health_check_seconds is not None and
+                now - conn_info.last_used_at > self.health_check_seconds and
+                not self._is_healthy(conn)):
+            self._close(conn)
+            with self.lock:
+                del self.conn_infos[conn]
+            return None
+        return conn
+
+    def get_conns(self, n_conn, timeout=None):
+        """
+        Returns a context manager holding n_conn connections, which are
+        returned to the pool when it exits. When max_size is set and not
+        enough connections are available, waits for up to timeout seconds
+        for them, or forever when timeout is None, and then raises
+        ConnectionPoolTimeout.
+        """
+
+        if self.max_size is not None and \
+                n_conn > self.max_size * len(self.targets):
+            raise ValueError(
+                'Cannot get %d connections from a pool of at most %d' %
+                (n_conn, self.max_size * len(self.targets)))
+
+        deadline = None
+        if timeout is not None:
+            deadline = time.time() + timeout
+
+        failed = []
+        while True:
+            with self.lock:
+                reserved = self._reserve(n_conn, deadline, failed)
+
+            conns = []
+            for i, (target, conn) in enumerate(reserved):
+                if conn is not None:
+                    conn = self._check_conn(conn)
+                if conn is None:
+                    try:
+                        conn = self._connect(target)
+                    except Exception:
+                        exc_type, exc_value, exc_traceback = sys.exc_info()
+                        # give back everything, and try again without
+                        # the target.
+                        rest = reserved[i + 1:]
+                        with self.lock:
+                            self._release(target)
+                            self._eject(target, time.time())
+                            for rest_target, rest_conn in rest:
+                                if rest_conn is None:
+                                    self._release(rest_target)
+                        self.put_conns(
+                            conns + [c for _, c in rest if c is not None])
+                        failed.append(target)
+                        if len(failed) >= len(self.targets):
+                            raise exc_type, exc_value, exc_traceback
+                        break
+                conns.append(conn)
+            else:
+                return ConnectionsContextManager(conns, self)
+
+    def record_latency(self, conn, duration_seconds):
+        """
+        Add the time a query took on the connection to the moving average
+        of the latency of its target.
+        """
+
         with self.lock:
-            dbnames = list(islice(self.dbnames, n_conn))
-        conns = []
-        for dbname in dbnames:
-            conn_info_with_db = dict(self.conn_info, dbname=dbname)
-            conn = self._make_conn(conn_info_with_db)
-            conns.append(conn)
-        conns_ctx_mgr = ConnectionsContextManager(conns)
-        return conns_ctx_mgr
+            conn_info = self.conn_infos.get(conn)
+            if conn_info is None:
+                return
+            target = conn_info.target
+            if target.latency_seconds is None:
+                target.latency_seconds = duration_seconds
+            else:
+                target.latency_seconds += self.latency_alpha * (
+                    duration_seconds - target.latency_seconds)
+
+    def record_failure(self, conn):
+        """
+        Stop using the target of the connection for a while, after a
+        query on it failed because of the database rather than the query,
+        for example a lost connection or a timeout.
+        """
+
+        with self.lock:
+            conn_info = self.conn_infos.get(conn)
+            if conn_info is not None:
+                self._eject(conn_info.target, time.time())
+
+    def put_conns(self, conns):
+        """
+        Return connections to the pool. Connections that were closed,
+        for example after an error, or were left in a transaction are
+        not re-used.
+        """
+
+        now = time.time()
+        for conn in conns:
+            reusable = not conn.closed and \
+                conn.get_transaction_status() == TRANSACTION_STATUS_IDLE
+            with self.lock:
+                conn_info = self.conn_infos.get(conn)
+                if conn_info is None:
+                    continue
+                target = conn_info.target
+                target.n_inflight -= 1
+                if reusable and not self._is_expired(conn_info, now):
+                    conn_info.last_used_at = now
+                    self.idle_conns[target.key].append(conn)
+                    self.conn_available.notify_all()
+                    continue
+                self._discard(conn)
+            self._close(conn)
+
+    def close(self):
+        with self.lock:
+            conns = [conn for idle in self.idle_conns.values()
+                     for conn in idle]
+            for idle in self.idle_conns.values():
+                del idle[:]
+            for conn in conns:
+                self._discard(conn)
+        for conn in conns:
+            self._close(conn)
+
+
+def make_db_connection_pool(conn_info, readonly=True):
+    """
+    Makes a connection pool from the postgresql configuration, which has
+    the connection parameters along with the dbnames list, an optional
+    hosts list and optional pool settings.
+    """
+
+    conn_info = dict(conn_info)
+    dbnames = conn_info.pop('dbnames')
+    hosts = conn_info.pop('hosts', None)
+    pool_cfg = conn_info.pop('pool', None) or {}
+    return DBConnectionPool(
+        dbnames, conn_info, readonly,
+        max_size=pool_cfg.get('max-size'),
+        max_lifetime_seconds=pool_cfg.get('max-lifetime-seconds', 3600),
+        health_check_seconds=pool_cfg.get('health-check-seconds', 30),
+        hosts=hosts,
+        eject_seconds=pool_cfg.get('eject-seconds', 30),
+    )
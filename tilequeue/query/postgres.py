@@ -1,15 +1,59 @@
 from collections import namedtuple
+from itertools import izip
 from jinja2 import Environment
 from jinja2 import FileSystemLoader
-from psycopg2.extras import RealDictCursor
-from tilequeue.query import DBConnectionPool
+from multiprocessing import TimeoutError
+from psycopg2 import BINARY
+from psycopg2 import OperationalError
+from psycopg2.extensions import QueryCanceledError
+from tilequeue.query.pool import ConnectionPoolTimeout
+from tilequeue.query.pool import make_db_connection_pool
 from tilequeue.transform import calculate_padded_bounds
+from tilequeue.utils import convert_seconds_to_millis
+import hashlib
 import sys
+import threading
+import time
+import weakref
 
 
 TemplateSpec = namedtuple('TemplateSpec', 'template start_zoom end_zoom')
 DataSource = namedtuple('DataSource', 'name template_specs')
 
+# a query prepared on the server as name, which is executed with the
+# bounds as its parameters.
+PreparedQuery = namedtuple('PreparedQuery', 'name sql bounds')
+
+# the query for a source, which is either rendered sql or a
+# PreparedQuery, along with the names of the templates it was made from.
+SourceQuery = namedtuple('SourceQuery', 'source templates query')
+
+
+class QueryParam(object):
+
+    """SQL standing in for a bounds coordinate in a prepared query
+
+    Only the bbox filters know how to render it. Anything else which
+    tries to use it as a value, including interpolating it into the
+    template, raises TypeError so that the source falls back to being
+    rendered for each tile.
+    """
+
+    def __init__(self, sql):
+        self.sql = sql
+
+    def _not_a_value(self, *args):
+        raise TypeError('Bounds parameter %s used as a value' % self.sql)
+
+    __str__ = __unicode__ = __repr__ = _not_a_value
+    __float__ = __int__ = __long__ = __format__ = _not_a_value
+
+
+# bounds used to render templates for prepared queries, where each of
+# min x, min y, max x and max y is a parameter of the query.
+bounds_params = tuple(QueryParam('$%d' % i) for i in xrange(1, 5))
+bounds_param_types = ', '.join(['float8'] * len(bounds_params))
+
 
 class TemplateFinder(object):
 
@@ -65,25 +109,102 @@ class SourcesQueriesGenerator(object):
         queries = []
         for source in self.sources:
             template_queries = []
+            templates = []
             for template_spec in source.template_specs:
                 # NOTE: end_zoom is exclusive
                 if template_spec.start_zoom <= zoom < template_spec.end_zoom:
                     template_query = self.query_generator(
                         template_spec.template, bounds, zoom)
                     template_queries.append(template_query)
+                    templates.append(template_spec.template)
             if template_queries:
                 source_query = '\nUNION ALL\n'.join(template_queries)
-                queries.append(source_query)
+                queries.append(SourceQuery(
+                    source.name, tuple(templates), source_query))
         return queries
 
 
+class PreparedSourcesQueriesGenerator(object):
+
+    """Generate queries which are prepared on the database server
+
+    The templates for each source are rendered once per zoom, with the
+    bounds as query parameters, rather than for every tile. This also
+    means that the database only plans each query once per connection.
+
+    Sources with templates that can't be rendered with parameters for
+    the bounds fall back to being rendered for each tile.
+    """
+
+    def __init__(self, sources, query_generator):
+        self.sources = sources
+        self.query_generator = query_generator
+        # (source name, zoom) -> PreparedQuery with no bounds, or None
+        # when the source has no templates at the zoom, or False when
+        # it can't be prepared.
+        self.prepared_cache = {}
+
+    def _render(self, source, bounds, zoom):
+        template_queries = []
+        for template_spec in source.template_specs:
+            # NOTE: end_zoom is exclusive
+            if template_spec.start_zoom <= zoom < template_spec.end_zoom:
+                template_query = self.query_generator(
+                    template_spec.template, bounds, zoom)
+                template_queries.append(template_query)
+        if template_queries:
+            return '\nUNION ALL\n'.join(template_queries)
+        return None
+
+    def _prepare(self, source, zoom):
+        try:
+            sql = self._render(source, bounds_params, zoom)
+        except Exception:
+            return False
+        if sql is None:
+            return None
+        name = 'tilequeue_%s' % hashlib.md5(sql).hexdigest()
+        return PreparedQuery(name, sql, None)
+
+    def __call__(self, zoom, bounds):
+        queries = []
+        for source in self.sources:
+            key = (source.name, zoom)
+            prepared = self.prepared_cache.get(key)
+            if prepared is None and key not in self.prepared_cache:
+                prepared = self._prepare(source, zoom)
+                self.prepared_cache[key] = prepared
+
+            if prepared:
+                query = prepared._replace(bounds=tuple(bounds))
+            elif prepared is False:
+                query = self._render(source, bounds, zoom)
+            else:
+                continue
+            templates = tuple(
+                spec.template for spec in source.template_specs
+                if spec.start_zoom <= zoom < spec.end_zoom)
+            queries.append(SourceQuery(source.name, templates, query))
+        return queries
+
+
+def _bounds_value(value):
+    if isinstance(value, QueryParam):
+        return value.sql
+    return '%.12f' % value
+
+
+def _make_point(x, y):
+    return 'ST_MakePoint(%s, %s)' % (_bounds_value(x), _bounds_value(y))
+
+
 def jinja_filter_geometry(value):
     return 'ST_AsBinary(%s)' % value
 
 
 def jinja_filter_bbox_filter(bounds, geometry_col_name, srid=3857):
-    min_point = 'ST_MakePoint(%.12f, %.12f)' % (bounds[0], bounds[1])
-    max_point = 'ST_MakePoint(%.12f, %.12f)' % (bounds[2], bounds[3])
+    min_point = _make_point(bounds[0], bounds[1])
+    max_point = _make_point(bounds[2], bounds[3])
     bbox_no_srid = 'ST_MakeBox2D(%s, %s)' % (min_point, max_point)
     bbox = 'ST_SetSrid(%s, %d)' % (bbox_no_srid, srid)
     bbox_filter = '%s && %s' % (geometry_col_name, bbox)
@@ -91,32 +212,49 @@ def jinja_filter_bbox_filter(bounds, geometry_col_name, srid=3857):
 
 
 def jinja_filter_bbox_intersection(bounds, geometry_col_name, srid=3857):
-    min_point = 'ST_MakePoint(%.12f, %.12f)' % (bounds[0], bounds[1])
-    max_point = 'ST_MakePoint(%.12f, %.12f)' % (bounds[2], bounds[3])
+    min_point = _make_point(bounds[0], bounds[1])
+    max_point = _make_point(bounds[2], bounds[3])
     bbox_no_srid = 'ST_MakeBox2D(%s, %s)' % (min_point, max_point)
     bbox = 'ST_SetSrid(%s, %d)' % (bbox_no_srid, srid)
     bbox_intersection = 'st_intersection(%s, %s)' % (geometry_col_name, bbox)
     return bbox_intersection
 
 
+def _padded_bounds_params(pad_factor, bounds):
+    # the same as calculate_padded_bounds, but in SQL
+    min_x, min_y, max_x, max_y = [b.sql for b in bounds]
+    half_pad = 0.5 * (pad_factor - 1.0)
+    dx = '(%s - %s) * %.12f' % (max_x, min_x, half_pad)
+    dy = '(%s - %s) * %.12f' % (max_y, min_y, half_pad)
+    return (
+        QueryParam('(%s - %s)' % (min_x, dx)),
+        QueryParam('(%s - %s)' % (min_y, dy)),
+        QueryParam('(%s + %s)' % (max_x, dx)),
+        QueryParam('(%s + %s)' % (max_y, dy)),
+    )
+
+
 def jinja_filter_bbox_padded_intersection(
         bounds, geometry_col_name, pad_factor=1.1, srid=3857):
-    padded_bounds = calculate_padded_bounds(pad_factor, bounds)
+    if isinstance(bounds[0], QueryParam):
+        padded_bounds = _padded_bounds_params(pad_factor, bounds)
+    else:
+        padded_bounds = calculate_padded_bounds(pad_factor, bounds).bounds
     return jinja_filter_bbox_intersection(
-        padded_bounds.bounds, geometry_col_name, srid)
+        padded_bounds, geometry_col_name, srid)
 
 
 def jinja_filter_bbox(bounds, srid=3857):
-    min_point = 'ST_MakePoint(%.12f, %.12f)' % (bounds[0], bounds[1])
-    max_point = 'ST_MakePoint(%.12f, %.12f)' % (bounds[2], bounds[3])
+    min_point = _make_point(bounds[0], bounds[1])
+    max_point = _make_point(bounds[2], bounds[3])
     bbox_no_srid = 'ST_MakeBox2D(%s, %s)' % (min_point, max_point)
     bbox = 'ST_SetSrid(%s, %d)' % (bbox_no_srid, srid)
     return bbox
 
 
 def jinja_filter_bbox_overlaps(bounds, geometry_col_name, srid=3857):
-    min_point = 'ST_MakePoint(%.12f, %.12f)' % (bounds[0], bounds[1])
-    max_point = 'ST_MakePoint(%.12f, %.12f)' % (bounds[2], bounds[3])
+    min_point = _make_point(bounds[0], bounds[1])
+    max_point = _make_point(bounds[2], bounds[3])
     bbox_no_srid = 'ST_MakeBox2D(%s, %s)' % (min_point, max_point)
     bbox = 'ST_SetSrid(%s, %d)' % (bbox_no_srid, srid)
     bbox_filter = \
@@ -125,16 +263,137 @@ def jinja_filter_bbox_overlaps(bounds, geometry_col_name, srid=3857):
     return bbox_filter
 
 
-def execute_query(conn, query):
+# connection -> set of the names of the queries prepared on it
+_prepared_query_names = weakref.WeakKeyDictionary()
+_prepared_query_names_lock = threading.Lock()
+
+
+def _execute_prepared(conn, cursor, query):
+    with _prepared_query_names_lock:
+        prepared_names = _prepared_query_names.setdefault(conn, set())
+    if query.name not in prepared_names:
+        cursor.execute('PREPARE %s (%s) AS %s' % (
+            query.name, bounds_param_types, query.sql))
+        prepared_names.add(query.name)
+    cursor.execute('EXECUTE %s (%%s, %%s, %%s, %%s)' % query.name,
+                   query.bounds)
+
+
+def read_rows(cursor):
+    """
+    Read the rows from the cursor as dicts, without any null values.
+
+    The rows are read as plain tuples and the column names and types are
+    only looked at once, rather than per row. Binary columns, such as the
+    geometries, are read as buffers and are converted to bytes because
+    the rows are pickled to be sent to the processing workers.
+    """
+
+    description = cursor.description
+    if description is None:
+        return []
+    names = [column[0] for column in description]
+    binary_names = [column[0] for column in description
+                    if column[1] in BINARY.values]
+
+    rows = []
+    for row in cursor:
+        read_row = dict((name, value)
+                        for name, value in izip(names, row)
+                        if value is not None)
+        for name in binary_names:
+            value = read_row.get(name)
+            if value is not None:
+                read_row[name] = bytes(value)
+        rows.append(read_row)
+    return rows
+
+
+def render_query_sql(query):
+    """
+    Returns the sql for a query, with the bounds filled in if it's a
+    prepared query, so that it can be run by hand.
+    """
+
+    if not isinstance(query, PreparedQuery):
+        return query
+    sql = query.sql
+    # replace the higher numbered parameters first, so that $1 doesn't
+    # match the start of $10 should there ever be that many.
+    for i in reversed(xrange(len(query.bounds))):
+        sql = sql.replace('$%d' % (i + 1), '%.12f' % query.bounds[i])
+    return sql
+
+
+def explain_query(conn, query):
+    """
+    Returns the lines of the EXPLAIN (ANALYZE, BUFFERS) output for the
+    query. Note that this runs the query again.
+    """
+
+    cursor = conn.cursor()
+    if isinstance(query, PreparedQuery):
+        _execute_prepared(conn, cursor, query)
+        cursor.execute(
+            'EXPLAIN (ANALYZE, BUFFERS) EXECUTE %s (%%s, %%s, %%s, %%s)' %
+            query.name, query.bounds)
+    else:
+        cursor.execute('EXPLAIN (ANALYZE, BUFFERS) %s' % query)
+    return [row[0] for row in cursor]
+
+
+class SlowQueryLog(object):
+
+    """Log queries which take longer than threshold_seconds
+
+    The sql is logged with the bounds filled in and, when explain is set,
+    the output of EXPLAIN (ANALYZE, BUFFERS) for the query. Explaining
+    runs the query a second time, on the same connection.
+    """
+
+    def __init__(self, logger, threshold_seconds, explain=False):
+        self.logger = logger
+        self.threshold_seconds = threshold_seconds
+        self.explain = explain
+
+    def __call__(self, conn, source_query, zoom, duration_seconds, n_rows):
+        if duration_seconds < self.threshold_seconds:
+            return
+
+        query = source_query.query
+        msg = 'Slow query for source %s at zoom %d (templates %s): ' \
+            '%.3fs, %d rows\n%s' % (
+                source_query.source, zoom, ', '.join(source_query.templates),
+                duration_seconds, n_rows, render_query_sql(query))
+        if self.explain:
+            try:
+                plan = explain_query(conn, query)
+                msg += '\n' + '\n'.join(plan)
+            except Exception as e:
+                msg += '\nFailed to explain query: %s' % e
+        self.logger.warning(msg)
+
+
+def execute_query(conn, query, statement_timeout_seconds=None):
     try:
-        cursor = conn.cursor(cursor_factory=RealDictCursor)
-        cursor.execute(query)
-        rows = list(cursor.fetchall())
+        cursor = conn.cursor()
+        if statement_timeout_seconds is not None:
+            # the timeout is set for this transaction only, rather than
+            # the session, so that it doesn't stay on server connections
+            # shared through pgbouncer in transaction pooling mode.
+            cursor.execute(
+                'BEGIN; SET LOCAL statement_timeout = %s',
+                (int(statement_timeout_seconds * 1000),))
+        if isinstance(query, PreparedQuery):
+            _execute_prepared(conn, cursor, query)
+        else:
+            cursor.execute(query)
+        rows = read_rows(cursor)
+        if statement_timeout_seconds is not None:
+            cursor.execute('COMMIT')
 
         return rows
     except Exception:
-        # TODO this kind of thing is only necessary if we re-use connections
-
         # If any exception occurs during query execution, close the
         # connection to ensure it is not in an invalid state. The
         # connection pool knows to create new connections to replace
@@ -156,17 +415,45 @@ class DataFetchException(Exception):
         super(DataFetchException, self).__init__(msgs)
 
 
+class DataFetchTimeout(DataFetchException):
+
+    """Raised when the queries for a tile don't finish within the budget"""
+
+    def __init__(self, timeout_seconds, source_names):
+        self.exceptions = []
+        self.timeout_seconds = timeout_seconds
+        self.source_names = source_names
+        msg = 'Queries for %s did not finish within %ss' % (
+            ', '.join(source_names), timeout_seconds)
+        super(DataFetchException, self).__init__(msg)
+
+
+class QueryCancelled(Exception):
+
+    """Raised for queries which were cancelled before they started"""
+
+
 class DataFetcher(object):
 
-    def __init__(self, conn_info, queries_generator, io_pool):
+    # after a timeout, how long to wait for the cancelled queries to
+    # finish before leaving them to return their connections to the
+    # pool in the background.
+    cancel_wait_seconds = 1.0
+
+    def __init__(self, conn_info, queries_generator, io_pool,
+                 stats_handler=None, slow_query_log=None,
+                 fetch_timeout_seconds=None, query_timeout_seconds=None):
         self.conn_info = dict(conn_info)
         self.queries_generator = queries_generator
         self.io_pool = io_pool
+        self.stats_handler = stats_handler
+        self.slow_query_log = slow_query_log
+        self.fetch_timeout_seconds = fetch_timeout_seconds
+        self.query_timeout_seconds = query_timeout_seconds
 
-        self.dbnames = self.conn_info.pop('dbnames')
+        self.dbnames = self.conn_info['dbnames']
         self.dbnames_query_index = 0
-        self.sql_conn_pool = DBConnectionPool(
-            self.dbnames, self.conn_info)
+        self.sql_conn_pool = make_db_connection_pool(self.conn_info)
 
     def fetch_tiles(self, all_data):
         # postgres data fetcher doesn't need this kind of session management,
@@ -180,41 +467,129 @@ class DataFetcher(object):
         n_conns = len(queries)
         assert n_conns, 'no queries'
 
-        with self.sql_conn_pool.get_conns(n_conns) as sql_conns:
+        deadline = None
+        if self.fetch_timeout_seconds is not None:
+            deadline = time.time() + self.fetch_timeout_seconds
+        cancelled = threading.Event()
+
+        try:
+            conns_ctx_mgr = self.sql_conn_pool.get_conns(
+                n_conns, timeout=self.fetch_timeout_seconds)
+        except ConnectionPoolTimeout:
+            raise DataFetchTimeout(
+                self.fetch_timeout_seconds,
+                [source_query.source for source_query in queries])
+
+        with conns_ctx_mgr as sql_conns:
             async_results = []
-            for query, conn in zip(queries, sql_conns):
+            for source_query, conn in zip(queries, sql_conns):
                 async_result = self.io_pool.apply_async(
-                    execute_query, (conn, query))
+                    self._execute_source_query,
+                    (conn, source_query, zoom, cancelled))
                 async_results.append(async_result)
 
             all_source_rows = []
             async_exceptions = []
-            for async_result in async_results:
+            for source_query, async_result in zip(queries, async_results):
                 try:
-                    source_rows = async_result.get()
+                    timeout = None
+                    if deadline is not None:
+                        timeout = max(deadline - time.time(), 0)
+                    source_rows = async_result.get(timeout)
                     # TODO can all the source rows just be smashed together?
                     # seems like it because the data allows discrimination
                     all_source_rows.extend(source_rows)
+                except TimeoutError:
+                    # fail the whole tile straight away, so that the
+                    # message can be retried, rather than wait for the
+                    # rest of the queries.
+                    timed_out_sources = self._cancel(
+                        zoom, queries, sql_conns, async_results, cancelled)
+                    raise DataFetchTimeout(
+                        self.fetch_timeout_seconds, timed_out_sources)
                 except Exception:
                     exc_type, exc_value, exc_traceback = sys.exc_info()
                     async_exception = exc_value
                     async_exceptions.append(async_exception)
+                    if self.stats_handler:
+                        self.stats_handler.query_error(
+                            source_query.source, zoom)
                     continue
 
             if async_exceptions:
                 raise DataFetchException(async_exceptions)
 
-        read_rows = []
-        for row in all_source_rows:
-            read_row = {}
-            for k, v in row.items():
-                if isinstance(v, buffer):
-                    v = bytes(v)
-                if v is not None:
-                    read_row[k] = v
-            read_rows.append(read_row)
-
-        return read_rows
+        return all_source_rows
+
+    def _cancel(self, zoom, queries, sql_conns, async_results, cancelled):
+        # queries which haven't started yet won't start, and the ones
+        # running are cancelled on the server. returns the names of the
+        # sources which hadn't finished.
+        cancelled.set()
+        outstanding = [
+            (source_query, conn, async_result)
+            for source_query, conn, async_result in
+            zip(queries, list(sql_conns), async_results)
+            if not async_result.ready()]
+        for source_query, conn, async_result in outstanding:
+            try:
+                conn.cancel()
+            except Exception:
+                pass
+            if self.stats_handler:
+                self.stats_handler.query_timeout(source_query.source, zoom)
+
+        wait_until = time.time() + self.cancel_wait_seconds
+        for source_query, conn, async_result in outstanding:
+            async_result.wait(max(wait_until - time.time(), 0))
+            if async_result.ready():
+                continue
+            # the connection is still in use, so it can't go back to the
+            # pool with the others. it's returned once the query ends.
+            sql_conns.remove(conn)
+            thread = threading.Thread(
+                target=self._put_conn_when_ready, args=(conn, async_result))
+            thread.daemon = True
+            thread.start()
+
+        return [source_query.source for source_query, _, _ in outstanding]
+
+    def _put_conn_when_ready(self, conn, async_result):
+        async_result.wait()
+        self.sql_conn_pool.put_conns([conn])
+
+    def _execute_source_query(self, conn, source_query, zoom, cancelled):
+        if cancelled.is_set():
+            raise QueryCancelled(source_query.source)
+        start = time.time()
+        try:
+            rows = execute_query(
+                conn, source_query.query, self.query_timeout_seconds)
+        except QueryCanceledError:
+            # the query was cancelled after the fetch timed out, or went
+            # over the statement timeout. that's a slow query rather than
+            # a broken database, so the database isn't ejected, but a
+            # statement timeout still counts towards its latency.
+            if not cancelled.is_set():
+                self.sql_conn_pool.record_latency(
+                    conn, time.time() - start)
+            raise
+        except OperationalError:
+            # problems with the database, rather than the query, mean
+            # that the pool should use other databases for a while.
+            self.sql_conn_pool.record_failure(conn)
+            raise
+        duration_seconds = time.time() - start
+        self.sql_conn_pool.record_latency(conn, duration_seconds)
+
+        if self.stats_handler:
+            self.stats_handler.fetched_query(
+                source_query.source, zoom,
+                convert_seconds_to_millis(duration_seconds), len(rows))
+        if self.slow_query_log:
+            self.slow_query_log(
+                conn, source_query, zoom, duration_seconds, len(rows))
+        return rows
 
 
 def make_jinja_environment(template_path):
@@ -229,12 +604,19 @@ def make_jinja_environment(template_path):
     return environment
 
 
-def make_queries_generator(sources, template_path, reload_templates):
+def make_queries_generator(sources, template_path, reload_templates,
+                           prepared_queries=False):
     jinja_environment = make_jinja_environment(template_path)
     cache_templates = not reload_templates
     template_finder = TemplateFinder(jinja_environment, cache_templates)
     query_generator = TemplateQueryGenerator(template_finder)
-    queries_generator = SourcesQueriesGenerator(sources, query_generator)
+    # prepared queries are only rendered once, so wouldn't pick up
+    # changes to the templates.
+    if prepared_queries and not reload_templates:
+        queries_generator = PreparedSourcesQueriesGenerator(
+            sources, query_generator)
+    else:
+        queries_generator = SourcesQueriesGenerator(sources, query_generator)
     return queries_generator
 
 
@@ -256,7 +638,10 @@ def parse_source_data(queries_cfg):
 
 
 def make_db_data_fetcher(postgresql_conn_info, template_path, reload_templates,
-                         query_cfg, io_pool):
+                         query_cfg, io_pool, prepared_queries=False,
+                         stats_handler=None, slow_query_log=None,
+                         fetch_timeout_seconds=None,
+                         query_timeout_seconds=None):
     """
     Returns an object which is callable with the zoom and unpadded bounds and
     which returns a list of rows.
@@ -264,6 +649,7 @@ def make_db_data_fetcher(postgresql_conn_info, template_path, reload_templates,
 
     sources = parse_source_data(query_cfg)
     queries_generator = make_queries_generator(
-        sources, template_path, reload_templates)
+        sources, template_path, reload_templates, prepared_queries)
     return DataFetcher(
-        postgresql_conn_info, queries_generator, io_pool)
+        postgresql_conn_info, queries_generator, io_pool, stats_handler,
+        slow_query_log, fetch_timeout_seconds, query_timeout_seconds)
@@ -1,4 +1,4 @@
-from collections import namedtuple, defaultdict
+from collections import namedtuple, defaultdict, OrderedDict
 from shapely.geometry import box
 from shapely.wkb import loads as wkb_loads
 from tilequeue.query.common import layer_properties
@@ -14,6 +14,7 @@ from tilequeue.transform import calculate_padded_bounds
 from tilequeue.utils import CoordsByParent
 from raw_tiles.tile import shape_tile_coverage
 from math import floor
+import threading
 
 
 class Relation(object):
@@ -578,12 +579,16 @@ def simple_index(layers, tables, tile_pyramid, index_cfg):
 class RawrTile(object):
 
     def __init__(self, layers, tables, tile_pyramid, label_placement_layers,
-                 indexes_cfg):
+                 indexes_cfg, index_pool=None):
         """
         Expect layers to be a dict of layer name to LayerInfo (see fixture.py).
         Tables should be a callable which returns a Table object (namedtuple
         of a source and iterator over the rows in the table) when called with
         that table's name.
+
+        If an index_pool is given, the simple indexes are built on it while
+        the OSM index is built on the calling thread. This needs tables which
+        can be read at the same time.
         """
 
         self.layers = layers
@@ -591,23 +596,42 @@ class RawrTile(object):
         self.label_placement_layers = label_placement_layers
         self.osm = None
 
+        # each index is built independently, so the indexes are the same
+        # whatever order they're built in. they're kept in the configured
+        # order, which is the order features are looked up in.
         indexes = []
+        pending_indexes = []
+        osm_index_position = None
         for index_cfg in indexes_cfg:
             typ = index_cfg.get('type')
             assert typ, 'Index configuration must provide a type.'
 
             if typ == 'osm':
-                index, osm = osm_index(layers, tables, tile_pyramid)
-                assert self.osm is None, 'Cannot have more than one OSM index.'
-                self.osm = osm
-                indexes.append(index)
+                assert osm_index_position is None, \
+                    'Cannot have more than one OSM index.'
+                osm_index_position = len(indexes)
+                indexes.append(None)
 
             elif typ == 'simple':
-                indexes.append(simple_index(
-                    layers, tables, tile_pyramid, index_cfg))
+                args = (layers, tables, tile_pyramid, index_cfg)
+                if index_pool is not None:
+                    pending_indexes.append((
+                        len(indexes),
+                        index_pool.apply_async(simple_index, args)))
+                    indexes.append(None)
+                else:
+                    indexes.append(simple_index(*args))
             else:
                 raise ValueError('Unknown index type %r' % (typ,))
 
+        if osm_index_position is not None:
+            index, osm = osm_index(layers, tables, tile_pyramid)
+            self.osm = osm
+            indexes[osm_index_position] = index
+
+        for position, async_result in pending_indexes:
+            indexes[position] = async_result.get()
+
         self.indexes = indexes
 
     def _named_layer(self, layer_min_zooms):
@@ -730,16 +754,96 @@ class RawrTile(object):
         return read_row
 
 
+class RawrTileCache(object):
+
+    """Least recently used cache of built RawrTile objects
+
+    Building a RawrTile means decoding and indexing all of its tables, so
+    keeping recent ones means that jobs for the same RAWR tile, such as
+    retries or a pyramid split across several messages, don't need to do
+    that again. Tiles are kept along with the version of the RAWR tile
+    payload they were built from, and only used while it's current.
+
+    The size of a RawrTile is estimated from the uncompressed size of its
+    tables, or default_size_bytes if that isn't known, and the total is
+    kept under max_size_bytes.
+    """
+
+    def __init__(self, max_size_bytes, default_size_bytes=256 * 1024 * 1024):
+        self.max_size_bytes = max_size_bytes
+        self.default_size_bytes = default_size_bytes
+        self.lock = threading.Lock()
+        # (z, x, y) -> (version, rawr tile, size in bytes), least recently
+        # used first.
+        self.tiles = OrderedDict()
+        self.size_bytes = 0
+
+    def get(self, tile, version):
+        key = (tile.z, tile.x, tile.y)
+        with self.lock:
+            entry = self.tiles.pop(key, None)
+            if entry is None:
+                return None
+            entry_version, rawr_tile, size_bytes = entry
+            if entry_version != version:
+                self.size_bytes -= size_bytes
+                return None
+            self.tiles[key] = entry
+            return rawr_tile
+
+    def put(self, tile, version, rawr_tile, size_bytes=None):
+        if size_bytes is None:
+            size_bytes = self.default_size_bytes
+        if size_bytes > self.max_size_bytes:
+            return
+        key = (tile.z, tile.x, tile.y)
+        with self.lock:
+            old_entry = self.tiles.pop(key, None)
+            if old_entry is not None:
+                self.size_bytes -= old_entry[2]
+            self.tiles[key] = (version, rawr_tile, size_bytes)
+            self.size_bytes += size_bytes
+            while self.size_bytes > self.max_size_bytes:
+                _, (_, _, evicted_size_bytes) = self.tiles.popitem(last=False)
+                self.size_bytes -= evicted_size_bytes
+
+
 class DataFetcher(object):
 
     def __init__(self, min_z, max_z, storage, layers, indexes_cfg,
-                 label_placement_layers):
+                 label_placement_layers, tile_cache=None, index_pool=None):
         self.min_z = min_z
         self.max_z = max_z
         self.storage = storage
         self.layers = layers
         self.indexes_cfg = indexes_cfg
         self.label_placement_layers = label_placement_layers
+        self.tile_cache = tile_cache
+        self.index_pool = index_pool
+
+    def _rawr_tile(self, tile_pyramid):
+        tile = tile_pyramid.tile()
+
+        # storage which can tell the version of a tile without reading it
+        # has a version method, and its tiles can be cached.
+        version = None
+        get_version = getattr(self.storage, 'version', None)
+        if self.tile_cache is not None and get_version is not None:
+            version = get_version(tile)
+            if version is not None:
+                rawr_tile = self.tile_cache.get(tile, version)
+                if rawr_tile is not None:
+                    return rawr_tile
+
+        tables = self.storage(tile)
+        rawr_tile = RawrTile(self.layers, tables, tile_pyramid,
+                             self.label_placement_layers, self.indexes_cfg,
+                             self.index_pool)
+
+        if version is not None:
+            self.tile_cache.put(tile, version, rawr_tile,
+                                getattr(tables, 'size_bytes', None))
+        return rawr_tile
 
     def fetch_tiles(self, all_data):
         # group all coords by the "unit of work" zoom, i.e: z10 for
@@ -757,10 +861,7 @@ class DataFetcher(object):
                 self.min_z, int(top_coord.column), int(top_coord.row),
                 self.max_z)
 
-            tables = self.storage(tile_pyramid.tile())
-
-            fetcher = RawrTile(self.layers, tables, tile_pyramid,
-                               self.label_placement_layers, self.indexes_cfg)
+            fetcher = self._rawr_tile(tile_pyramid)
 
             for coord, data in coord_group:
                 yield fetcher, data
@@ -783,7 +884,12 @@ class DataFetcher(object):
 #             set (or other in-supporting collection) of layer names.
 #             Geometries of that type in that layer will have a label
 #             placement generated for them.
+#  - tile_cache: Optional RawrTileCache of recently built RAWR tiles, used
+#             when the storage has a version method.
+#  - index_pool: Optional thread pool on which to build the simple indexes,
+#             alongside the OSM index.
 def make_rawr_data_fetcher(min_z, max_z, storage, layers, indexes_cfg,
-                           label_placement_layers={}):
+                           label_placement_layers={}, tile_cache=None,
+                           index_pool=None):
     return DataFetcher(min_z, max_z, storage, layers, indexes_cfg,
-                       label_placement_layers)
+                       label_placement_layers, tile_cache, index_pool)
@@ -3,6 +3,7 @@ from message import MessageHandle
 from file import OutputFileQueue
 from memory import MemoryQueue
 from redis_queue import make_redis_queue
+from redis_queue import make_reliable_redis_queue
 from sqs import JobProgressException
 from sqs import make_sqs_queue
 from sqs import make_visibility_manager
@@ -11,6 +12,7 @@ from sqs import SqsQueue
 __all__ = [
     JobProgressException,
     make_redis_queue,
+    make_reliable_redis_queue,
     make_sqs_queue,
     make_visibility_manager,
     MemoryQueue,
@@ -27,6 +27,18 @@ class RedisInFlightManager(object):
             if not self.is_inflight(coord):
                 yield coord
 
+    def filter_coord_ints(self, coord_ints):
+        result = []
+        for coord_ints_chunk in grouper(coord_ints, self.chunk_size):
+            with self.redis_client.pipeline() as pipe:
+                for coord_int in coord_ints_chunk:
+                    pipe.sismember(self.inflight_key, int(coord_int))
+                is_inflight = pipe.execute()
+            for coord_int, inflight in zip(coord_ints_chunk, is_inflight):
+                if not inflight:
+                    result.append(coord_int)
+        return result
+
     def mark_inflight(self, coords):
         for coords_chunk in grouper(coords, self.chunk_size):
             coord_ints = map(coord_marshall_int, coords_chunk)
@@ -42,6 +54,9 @@ class NoopInFlightManager(object):
     def filter(self, coords):
         return coords
 
+    def filter_coord_ints(self, coord_ints):
+        return coord_ints
+
     def is_inflight(self, coord_int):
         return False
 
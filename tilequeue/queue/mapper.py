@@ -1,6 +1,16 @@
 from collections import defaultdict
 from collections import namedtuple
+from ModestMaps.Core import Coordinate
+from tilequeue.tile import col_mask
+from tilequeue.tile import col_offset
 from tilequeue.tile import coord_marshall_int
+from tilequeue.tile import coord_unmarshall_int
+from tilequeue.tile import row_mask
+from tilequeue.tile import row_offset
+from tilequeue.tile import zoom_mask
+from tilequeue.utils import sorted_array_contains
+import numpy as np
+import threading
 
 
 # this is what gets returned by the group function
@@ -21,6 +31,11 @@ class SingleQueueMapper(object):
         for coord in coords:
             yield CoordGroup([coord], self.queue_name)
 
+    def group_coord_ints(self, coord_ints):
+        for coord_int in coord_ints:
+            coord = coord_unmarshall_int(int(coord_int))
+            yield CoordGroup([coord], self.queue_name)
+
     def get_queue(self, queue_id):
         assert queue_id == self.queue_name, 'Unknown queue_id: %s' % queue_id
         return self.tile_queue
@@ -28,6 +43,9 @@ class SingleQueueMapper(object):
     def queues_in_priority_order(self):
         return ((self.queue_name, self.tile_queue),)
 
+    def stop_toi_refresh(self):
+        pass
+
 
 # what gets passed into the zoom range mapper
 # pass in None for start/end to add queues that are read from
@@ -48,7 +66,8 @@ ZoomRangeQueueItem = namedtuple(
 
 class ZoomRangeAndZoomGroupQueueMapper(object):
 
-    def __init__(self, zoom_range_specs, toi=None):
+    def __init__(self, zoom_range_specs, toi=None,
+                 toi_refresh_interval_secs=None, logger=None):
         # NOTE: zoom_range_specs should be passed in priority order
         self.zoom_range_items = []
         self.queue_mapping = []
@@ -66,10 +85,66 @@ class ZoomRangeAndZoomGroupQueueMapper(object):
                 "whether a coordinate is in the TOI then a TOI object must " \
                 "be provided, but there is only None."
 
-            # NOTE: this is a one-off operation, so for long-running processes,
-            # we must either re-create the mapper object, or periodically
-            # refresh the TOI set.
-            self.toi_set = toi.fetch_tiles_of_interest()
+        # sorted array version of the toi set, for the bulk grouping. this
+        # gets created on first use, and is paired with the set it was
+        # created from, so that a refresh can't leave a stale array.
+        self.toi_array_cache = None
+        self.toi = toi
+        self.toi_version = None
+        self.logger = logger
+        self.toi_refresh_stop = None
+        self.toi_refresh_thread = None
+        self.toi_set = None
+
+        if uses_toi:
+            # NOTE: for long-running processes, pass a refresh interval to
+            # periodically pick up changes to the TOI set. Otherwise this is
+            # a one-off operation, and the mapper needs to be re-created.
+            if hasattr(toi, 'fetch_tiles_of_interest_if_changed'):
+                self.toi_set, self.toi_version = \
+                    toi.fetch_tiles_of_interest_if_changed(None)
+            else:
+                self.toi_set = toi.fetch_tiles_of_interest()
+            if toi_refresh_interval_secs:
+                self.toi_refresh_stop = threading.Event()
+                t = threading.Thread(
+                    target=self._refresh_toi_loop,
+                    args=(toi_refresh_interval_secs,))
+                # don't hold up process exit for the refresh
+                t.daemon = True
+                t.start()
+                self.toi_refresh_thread = t
+
+    def refresh_toi(self):
+        """
+        fetch the TOI if it changed, and swap it in
+
+        Returns whether the TOI changed.
+        """
+        toi_set, self.toi_version = \
+            self.toi.fetch_tiles_of_interest_if_changed(self.toi_version)
+        if toi_set is None:
+            return False
+        # a single assignment, so readers see either the old or the new
+        self.toi_set = toi_set
+        return True
+
+    def _refresh_toi_loop(self, interval_secs):
+        while not self.toi_refresh_stop.wait(interval_secs):
+            try:
+                changed = self.refresh_toi()
+            except Exception:
+                # keep routing with the last TOI we had
+                if self.logger:
+                    self.logger.exception('Error refreshing TOI')
+                continue
+            if changed and self.logger:
+                self.logger.info(
+                    'Refreshed TOI: %d tiles' % len(self.toi_set))
+
+    def stop_toi_refresh(self):
+        if self.toi_refresh_stop is not None:
+            self.toi_refresh_stop.set()
 
     def group(self, coords):
         """return CoordGroups that can be used to send to queues
@@ -84,11 +159,17 @@ class ZoomRangeAndZoomGroupQueueMapper(object):
         for i in range(len(self.zoom_range_items)):
             groups.append([])
 
+        # hold on to the same set for the whole grouping, even if it
+        # gets refreshed in the meantime
+        toi_set = self.toi_set
+
         # first group the coordinates based on their queue
         for coord in coords:
+            coord_in_toi = None
             for i, zri in enumerate(self.zoom_range_items):
-                toi_match = zri.in_toi is None or \
-                            (coord in self.toi_set) == zri.in_toi
+                if zri.in_toi is not None and coord_in_toi is None:
+                    coord_in_toi = coord_marshall_int(coord) in toi_set
+                toi_match = zri.in_toi is None or coord_in_toi == zri.in_toi
                 if zri.start <= coord.zoom < zri.end and toi_match:
                     groups[i].append(coord)
                     break
@@ -121,9 +202,102 @@ class ZoomRangeAndZoomGroupQueueMapper(object):
                 for group_key, coords in by_parent_coords.iteritems():
                     yield CoordGroup(coords, zri.queue_id)
 
+    def group_coord_ints(self, coord_ints):
+        """return CoordGroups for marshalled coordinate integers
+
+        Produces the same groups as group, but does the zoom range,
+        toi and parent calculations on the whole array at once. The
+        order of the groups may differ. Useful when enqueueing the
+        whole toi.
+        """
+
+        coord_ints = np.asarray(coord_ints, dtype=np.int64)
+        if not len(coord_ints):
+            return
+
+        zooms = coord_ints & zoom_mask
+
+        in_toi = None
+        if any(zri.in_toi is not None for zri in self.zoom_range_items):
+            in_toi = self._in_toi(coord_ints)
+
+        unassigned = np.ones(len(coord_ints), dtype=bool)
+        for zri in self.zoom_range_items:
+            if zri.start is None or zri.end is None:
+                # these queues are only read from
+                continue
+            mask = unassigned & (zooms >= zri.start) & (zooms < zri.end)
+            if zri.in_toi is not None:
+                mask &= in_toi == zri.in_toi
+            if not mask.any():
+                continue
+            unassigned &= ~mask
+
+            group = coord_ints[mask]
+            if zri.group_by_zoom is None:
+                for coord in _coords_from_ints(group):
+                    yield CoordGroup([coord], zri.queue_id)
+                continue
+
+            group_zooms = zooms[mask]
+            below = group_zooms < zri.group_by_zoom
+            # see the comment in group about lower zooms
+            for coord in _coords_from_ints(group[below]):
+                yield CoordGroup([coord], zri.queue_id)
+
+            group = group[~below]
+            if not len(group):
+                continue
+            parent_keys = _zoom_up_coord_ints(
+                group, group_zooms[~below] - zri.group_by_zoom,
+                zri.group_by_zoom)
+            order = np.argsort(parent_keys, kind='mergesort')
+            sorted_keys = parent_keys[order]
+            boundaries = np.flatnonzero(sorted_keys[1:] != sorted_keys[:-1])
+            starts = np.concatenate(([0], boundaries + 1))
+            ends = np.concatenate((boundaries + 1, [len(order)]))
+            sorted_coords = _coords_from_ints(group[order])
+            for start, end in zip(starts.tolist(), ends.tolist()):
+                yield CoordGroup(sorted_coords[start:end], zri.queue_id)
+
+    def _in_toi(self, coord_ints):
+        toi_set = self.toi_set
+        cache = self.toi_array_cache
+        if cache is not None and cache[0] is toi_set:
+            toi_array = cache[1]
+        else:
+            toi_array = np.fromiter(
+                toi_set, dtype=np.int64, count=len(toi_set))
+            toi_array.sort()
+            self.toi_array_cache = toi_set, toi_array
+        return sorted_array_contains(toi_array, coord_ints)
+
     def get_queue(self, queue_id):
         assert 0 <= queue_id < len(self.queue_mapping)
         return self.queue_mapping[queue_id]
 
     def queues_in_priority_order(self):
         return enumerate(self.queue_mapping)
+
+
+def _zoom_up_coord_ints(coord_ints, delta_zooms, zoom):
+    """zoom up each coordinate integer by its delta, to the given zoom
+
+    This is the array equivalent of repeated coord_int_zoom_up calls,
+    but done in one step per coordinate by shifting the column and row
+    fields directly.
+    """
+    columns = (coord_ints >> col_offset) & col_mask
+    rows = (coord_ints >> row_offset) & row_mask
+    columns >>= delta_zooms
+    rows >>= delta_zooms
+    return zoom | (rows << row_offset) | (columns << col_offset)
+
+
+def _coords_from_ints(coord_ints):
+    """unmarshall an array of coordinate integers into a list of coords"""
+    zooms = (coord_ints & zoom_mask).tolist()
+    rows = ((coord_ints >> row_offset) & row_mask).tolist()
+    columns = ((coord_ints >> col_offset) & col_mask).tolist()
+    return [Coordinate(row=row, column=column, zoom=zoom)
+            for zoom, row, column in zip(zooms, rows, columns)]
@@ -1,7 +1,11 @@
 from collections import namedtuple
+from ModestMaps.Core import Coordinate
 from tilequeue.tile import deserialize_coord
 from tilequeue.tile import serialize_coord
+import base64
+import struct
 import threading
+import time
 
 
 class MessageHandle(object):
@@ -71,6 +75,161 @@ class CommaSeparatedMarshaller(object):
         return coords
 
 
+def _encode_varint(value, buf):
+    while value >= 0x80:
+        buf.append((value & 0x7f) | 0x80)
+        value >>= 7
+    buf.append(value)
+
+
+def _decode_varint(buf, offset):
+    value = 0
+    shift = 0
+    while True:
+        b = buf[offset]
+        offset += 1
+        value |= (b & 0x7f) << shift
+        if not b & 0x80:
+            return value, offset
+        shift += 7
+
+
+class PyramidMarshaller(object):
+
+    """
+    marshall/unmarshall coordinates as a compact binary pyramid
+
+    The coordinates are encoded relative to their common parent. For
+    each zoom level below the parent, the descendants present are
+    recorded as one of: nothing, every tile, a bitmap over all the
+    tiles at that level, or a delta encoded list of tile indexes,
+    whichever is smallest. A full pyramid therefore costs a single
+    byte per zoom level. The result is base64 encoded so that it can
+    be sent as an sqs message body.
+    """
+
+    version = 1
+    header = struct.Struct('!BBIIB')
+
+    # level encodings
+    level_empty = 0
+    level_full = 1
+    level_bitmap = 2
+    level_list = 3
+
+    # a bitmap for deeper levels would be unreasonably large. queue
+    # mappers group by zoom 10 and the max zoom is 16 or so, which is
+    # well within this.
+    max_depth = 10
+
+    def marshall(self, coords):
+        if not coords:
+            return ''
+
+        coord_tuples = set(
+            (int(c.zoom), int(c.column), int(c.row)) for c in coords)
+
+        parent_zoom = min(z for z, _, _ in coord_tuples)
+        max_zoom = max(z for z, _, _ in coord_tuples)
+        depth = max_zoom - parent_zoom
+        parents = set((x >> (z - parent_zoom), y >> (z - parent_zoom))
+                      for z, x, y in coord_tuples)
+        while len(parents) > 1:
+            assert parent_zoom > 0
+            parent_zoom -= 1
+            depth += 1
+            parents = set((x >> 1, y >> 1) for x, y in parents)
+        parent_x, parent_y = parents.pop()
+        assert depth <= self.max_depth, \
+            'Coordinates span too many zoom levels: %d' % depth
+
+        indexes_by_level = [[] for _ in xrange(depth + 1)]
+        for z, x, y in coord_tuples:
+            delta_z = z - parent_zoom
+            local_x = x - (parent_x << delta_z)
+            local_y = y - (parent_y << delta_z)
+            indexes_by_level[delta_z].append((local_y << delta_z) + local_x)
+
+        buf = bytearray(self.header.pack(
+            self.version, parent_zoom, parent_x, parent_y, depth))
+        for delta_z, indexes in enumerate(indexes_by_level):
+            n_tiles = 1 << (2 * delta_z)
+            if not indexes:
+                buf.append(self.level_empty)
+            elif len(indexes) == n_tiles:
+                buf.append(self.level_full)
+            else:
+                indexes.sort()
+                index_buf = bytearray()
+                last_index = 0
+                for index in indexes:
+                    _encode_varint(index - last_index, index_buf)
+                    last_index = index
+                n_bitmap_bytes = (n_tiles + 7) // 8
+                if len(index_buf) + 1 < n_bitmap_bytes:
+                    buf.append(self.level_list)
+                    _encode_varint(len(indexes), buf)
+                    buf.extend(index_buf)
+                else:
+                    bitmap = bytearray(n_bitmap_bytes)
+                    for index in indexes:
+                        bitmap[index >> 3] |= 1 << (index & 7)
+                    buf.append(self.level_bitmap)
+                    buf.extend(bitmap)
+
+        return base64.b64encode(bytes(buf))
+
+    def unmarshall(self, payload):
+        """yield the coordinates in the payload lazily"""
+
+        if not payload:
+            return
+        buf = bytearray(base64.b64decode(payload))
+        version, parent_zoom, parent_x, parent_y, depth = \
+            self.header.unpack_from(bytes(buf[:self.header.size]))
+        assert version == self.version, \
+            'Unknown pyramid message version: %d' % version
+        offset = self.header.size
+
+        for delta_z in xrange(depth + 1):
+            zoom = parent_zoom + delta_z
+            base_x = parent_x << delta_z
+            base_y = parent_y << delta_z
+            n_tiles = 1 << (2 * delta_z)
+
+            level_type = buf[offset]
+            offset += 1
+            if level_type == self.level_empty:
+                indexes = ()
+            elif level_type == self.level_full:
+                indexes = xrange(n_tiles)
+            elif level_type == self.level_bitmap:
+                n_bitmap_bytes = (n_tiles + 7) // 8
+                bitmap = buf[offset:offset + n_bitmap_bytes]
+                offset += n_bitmap_bytes
+                indexes = (i for i in xrange(n_tiles)
+                           if bitmap[i >> 3] & (1 << (i & 7)))
+            elif level_type == self.level_list:
+                n_indexes, offset = _decode_varint(buf, offset)
+                index_list = []
+                index = 0
+                for _ in xrange(n_indexes):
+                    delta, offset = _decode_varint(buf, offset)
+                    index += delta
+                    index_list.append(index)
+                indexes = index_list
+            else:
+                assert 0, 'Unknown pyramid level type: %d' % level_type
+
+            mask = (1 << delta_z) - 1
+            for index in indexes:
+                yield Coordinate(
+                    zoom=zoom,
+                    column=base_x + (index & mask),
+                    row=base_y + (index >> delta_z),
+                )
+
+
 MessageDoneResult = namedtuple(
     'MessageDoneResult',
     ('queue_handle all_done parent_tile'))
@@ -93,6 +252,58 @@ class SingleMessagePerCoordTracker(object):
         return MessageDoneResult(queue_handle, all_done, parent_tile)
 
 
+def _pyramid_index(base, coord_id):
+    # position of coord_id in a breadth first walk of the pyramid
+    # rooted at base, ie base is 0, its children are 1-4, and so on.
+    base_zoom, base_column, base_row = base
+    zoom, column, row = coord_id
+    delta_z = zoom - base_zoom
+    assert delta_z >= 0, 'Coordinate is above its parent'
+    local_column = column - (base_column << delta_z)
+    local_row = row - (base_row << delta_z)
+    assert 0 <= local_column < (1 << delta_z) and \
+        0 <= local_row < (1 << delta_z), \
+        'Coordinate is not contained by its parent'
+    n_above = ((1 << (2 * delta_z)) - 1) // 3
+    return n_above + (local_row << delta_z) + local_column
+
+
+class TrackedMessage(object):
+
+    """
+    pending coordinates for a single queue message
+
+    The coordinates are stored as a bitset, indexed by their position
+    in the pyramid below the base coordinate.
+    """
+
+    __slots__ = ('queue_handle', 'parent_tile', 'base', 'pending',
+                 'n_pending', 'last_active')
+
+    def __init__(self, queue_handle, parent_tile, base, n_bits, last_active):
+        self.queue_handle = queue_handle
+        self.parent_tile = parent_tile
+        self.base = base
+        self.pending = bytearray((n_bits + 7) // 8)
+        self.n_pending = 0
+        self.last_active = last_active
+
+    def add(self, index):
+        byte_idx, mask = index >> 3, 1 << (index & 7)
+        assert not self.pending[byte_idx] & mask
+        self.pending[byte_idx] |= mask
+        self.n_pending += 1
+
+    def remove(self, index):
+        byte_idx, mask = index >> 3, 1 << (index & 7)
+        if byte_idx >= len(self.pending) or \
+                not self.pending[byte_idx] & mask:
+            return False
+        self.pending[byte_idx] &= ~mask
+        self.n_pending -= 1
+        return True
+
+
 class MultipleMessagesPerCoordTracker(object):
 
     """
@@ -100,15 +311,21 @@ class MultipleMessagesPerCoordTracker(object):
 
     Support tracking a mapping for multiple coordinates to a single
     queue handle.
+
+    Messages that haven't seen any activity for expire_secs are
+    dropped, as the queue will have made them visible again by then
+    anyway. This should be at least as long as the queue visibility
+    timeout.
     """
 
-    def __init__(self, msg_tracker_logger):
+    def __init__(self, msg_tracker_logger, expire_secs=43200,
+                 purge_interval_secs=60, stats_handler=None):
         self.msg_tracker_logger = msg_tracker_logger
-        self.queue_handle_map = {}
-        self.coord_ids_map = {}
-        self.pyramid_map = {}
-        # TODO we might want to have a way to purge this, or risk
-        # running out of memory if a coordinate never completes
+        self.expire_secs = expire_secs
+        self.purge_interval_secs = purge_interval_secs
+        self.stats_handler = stats_handler
+        self.tracked = {}
+        self.last_purge = time.time()
         self.lock = threading.Lock()
 
     def track(self, queue_handle, coords, parent_tile=None):
@@ -117,26 +334,31 @@ class MultipleMessagesPerCoordTracker(object):
             assert parent_tile is not None, "parent tile was not provided, " \
                 "but is required for tracking pyramids of tiles."
 
-        with self.lock:
-            # rely on the queue handle token as the mapping key
-            queue_handle_id = queue_handle.handle
-            self.queue_handle_map[queue_handle_id] = queue_handle
-
-            coord_ids = set()
-            coord_handles = []
-            for coord in coords:
-                coord_id = (int(coord.zoom), int(coord.column), int(coord.row))
-                coord_handle = (coord_id, queue_handle_id)
-                assert coord_id not in coord_ids
-                coord_ids.add(coord_id)
-                coord_handles.append(coord_handle)
-
-            self.coord_ids_map[queue_handle_id] = coord_ids
+        now = time.time()
+        if now - self.last_purge >= self.purge_interval_secs:
+            self.purge(now)
 
+        coord_ids = [(int(coord.zoom), int(coord.column), int(coord.row))
+                     for coord in coords]
         if is_pyramid:
-            self.pyramid_map[queue_handle_id] = parent_tile
+            base = (int(parent_tile.zoom), int(parent_tile.column),
+                    int(parent_tile.row))
+        else:
+            base = coord_ids[0]
+        indexes = [_pyramid_index(base, coord_id) for coord_id in coord_ids]
+
+        # rely on the queue handle token as the mapping key
+        queue_handle_id = queue_handle.handle
+        tracked_msg = TrackedMessage(
+            queue_handle, parent_tile if is_pyramid else None, base,
+            max(indexes) + 1, now)
+        for index in indexes:
+            tracked_msg.add(index)
 
-        return coord_handles
+        with self.lock:
+            self.tracked[queue_handle_id] = tracked_msg
+
+        return [(coord_id, queue_handle_id) for coord_id in coord_ids]
 
     def done(self, coord_handle):
         queue_handle = None
@@ -146,31 +368,58 @@ class MultipleMessagesPerCoordTracker(object):
         with self.lock:
             coord_id, queue_handle_id = coord_handle
 
-            coord_ids = self.coord_ids_map.get(queue_handle_id)
-            queue_handle = self.queue_handle_map.get(queue_handle_id)
-
-            if queue_handle is None or coord_ids is None:
+            tracked_msg = self.tracked.get(queue_handle_id)
+            if tracked_msg is None:
                 self.msg_tracker_logger.unknown_queue_handle_id(
                     coord_id, queue_handle_id)
                 return MessageDoneResult(None, False, None)
 
-            if coord_id not in coord_ids:
+            queue_handle = tracked_msg.queue_handle
+            tracked_msg.last_active = time.time()
+
+            try:
+                index = _pyramid_index(tracked_msg.base, coord_id)
+            except AssertionError:
+                index = None
+            if index is None or not tracked_msg.remove(index):
                 self.msg_tracker_logger.unknown_coord_id(
                     coord_id, queue_handle_id)
-            else:
-                coord_ids.remove(coord_id)
 
-            if not coord_ids:
+            if not tracked_msg.n_pending:
                 # we're done with all coordinates for the queue message
-                try:
-                    del self.queue_handle_map[queue_handle_id]
-                except KeyError:
-                    pass
-                try:
-                    del self.coord_ids_map[queue_handle_id]
-                except KeyError:
-                    pass
+                del self.tracked[queue_handle_id]
                 all_done = True
-                parent_tile = self.pyramid_map.pop(queue_handle_id, None)
+                parent_tile = tracked_msg.parent_tile
 
         return MessageDoneResult(queue_handle, all_done, parent_tile)
+
+    def purge(self, now=None):
+        """drop messages that have been inactive for too long"""
+        if now is None:
+            now = time.time()
+        cutoff = now - self.expire_secs
+        with self.lock:
+            self.last_purge = now
+            expired = [queue_handle_id
+                       for queue_handle_id, tracked_msg
+                       in self.tracked.iteritems()
+                       if tracked_msg.last_active < cutoff]
+            for queue_handle_id in expired:
+                del self.tracked[queue_handle_id]
+            n_msgs, n_coords = self._sizes()
+        for queue_handle_id in expired:
+            self.msg_tracker_logger.expired_queue_handle_id(queue_handle_id)
+        if self.stats_handler is not None:
+            self.stats_handler.tracked_messages(
+                n_msgs, n_coords, len(expired))
+        return len(expired)
+
+    def _sizes(self):
+        n_msgs = len(self.tracked)
+        n_coords = sum(x.n_pending for x in self.tracked.itervalues())
+        return n_msgs, n_coords
+
+    def sizes(self):
+        """return the number of tracked messages and pending coords"""
+        with self.lock:
+            return self._sizes()
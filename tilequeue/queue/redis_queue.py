@@ -1,6 +1,8 @@
 from tilequeue.queue import MessageHandle
+from tilequeue.utils import convert_seconds_to_millis
 from tilequeue.utils import grouper
 import time
+import uuid
 
 
 class RedisQueue(object):
@@ -20,7 +22,7 @@ class RedisQueue(object):
         self.queue_key = queue_key
 
     def enqueue(self, payload):
-        self.redis_client.rpush(payload)
+        self.redis_client.rpush(self.queue_key, payload)
 
     def enqueue_batch(self, payloads):
         for payloads_chunk in grouper(payloads, self.enqueue_batch_size):
@@ -58,5 +60,218 @@ class RedisQueue(object):
         pass
 
 
+# move every message in the processing list whose deadline has passed
+# back onto the queue. running this as a script keeps the check and
+# the move atomic, so that two reapers can't requeue the same message
+# and a crash can't drop it in between.
+#
+# requeued messages get a new id, so that the handle held by the worker
+# which was too slow no longer matches, and its job_progress and
+# job_done can't touch the redelivered message. deadlines left for
+# messages which are no longer being processed are removed.
+#
+# KEYS: queue, processing list, deadlines hash
+# ARGV: now (seconds), visibility timeout (seconds)
+_reap_script = """
+local now = tonumber(ARGV[1])
+local timeout = tonumber(ARGV[2])
+local n = 0
+local processing = {}
+local values = redis.call('LRANGE', KEYS[2], 0, -1)
+for _, value in ipairs(values) do
+  local deadline = redis.call('HGET', KEYS[3], value)
+  if not deadline then
+    -- a reader died between moving the message and stamping it
+    redis.call('HSET', KEYS[3], value, now + timeout)
+    processing[value] = true
+  elseif tonumber(deadline) <= now then
+    redis.call('LREM', KEYS[2], 1, value)
+    redis.call('HDEL', KEYS[3], value)
+    local ts, id, payload = string.match(value, '^([^:]*):([^:]*):(.*)$')
+    if id then
+      local base, delivery = string.match(id, '^(.-)%.(%d+)$')
+      if base then
+        id = base .. '.' .. (tonumber(delivery) + 1)
+      else
+        id = id .. '.1'
+      end
+      value = ts .. ':' .. id .. ':' .. payload
+    end
+    redis.call('RPUSH', KEYS[1], value)
+    n = n + 1
+  else
+    processing[value] = true
+  end
+end
+for _, value in ipairs(redis.call('HKEYS', KEYS[3])) do
+  if not processing[value] then
+    redis.call('HDEL', KEYS[3], value)
+  end
+end
+return n
+"""
+
+# push back the deadline of a message, but only while it's still in the
+# processing list. otherwise a worker which was too slow, and whose
+# message has been requeued, would leave a deadline behind that nothing
+# removes.
+#
+# KEYS: processing list, deadlines hash
+# ARGV: message, deadline (seconds)
+_progress_script = """
+for _, value in ipairs(redis.call('LRANGE', KEYS[1], 0, -1)) do
+  if value == ARGV[1] then
+    redis.call('HSET', KEYS[2], ARGV[1], ARGV[2])
+    return 1
+  end
+end
+return 0
+"""
+
+
+def _encode_message(payload, now=None):
+    # payloads can be enqueued more than once, but the stored values
+    # are used as the message handles, so each one gets a unique id.
+    # the enqueue timestamp is kept to populate the message metadata.
+    if now is None:
+        now = time.time()
+    return '%d:%s:%s' % (
+        convert_seconds_to_millis(now), uuid.uuid4().hex, payload)
+
+
+def _decode_message(value):
+    timestamp_str, _, payload = value.split(':', 2)
+    try:
+        timestamp = float(timestamp_str)
+    except ValueError:
+        timestamp = None
+    return payload, timestamp
+
+
+class ReliableRedisQueue(object):
+    """
+    Redis backed queue implementation with acknowledgements
+
+    Reading a message atomically moves it onto a processing list and
+    stamps it with a visibility deadline. It is only removed when the
+    job is done, and job progress pushes the deadline back. Messages
+    whose deadline passes, for example because the worker crashed,
+    are moved back onto the queue by the reaper, which runs
+    periodically from read. Requeued messages get a new handle, so that
+    the worker which was too slow can't extend or finish the new
+    delivery.
+
+    Reads block on the queue instead of sleeping when it's empty.
+    """
+
+    enqueue_batch_size = 100
+
+    def __init__(self, redis_client, queue_key, read_size,
+                 read_wait_seconds, visibility_timeout_seconds,
+                 reap_interval_seconds):
+        assert read_wait_seconds > 0, \
+            'read_wait_seconds must be positive, 0 blocks forever'
+        self.redis_client = redis_client
+        self.queue_key = queue_key
+        self.processing_key = queue_key + '.processing'
+        self.deadlines_key = queue_key + '.deadlines'
+        self.read_size = read_size
+        self.read_wait_seconds = read_wait_seconds
+        self.visibility_timeout_seconds = visibility_timeout_seconds
+        self.reap_interval_seconds = reap_interval_seconds
+        self.last_reap = None
+        self.reap_script = redis_client.register_script(_reap_script)
+        self.progress_script = redis_client.register_script(_progress_script)
+
+    def enqueue(self, payload):
+        self.redis_client.lpush(self.queue_key, _encode_message(payload))
+
+    def enqueue_batch(self, payloads):
+        # messages are pushed on the left and read from the right, so
+        # that reads can use the atomic (b)rpoplpush
+        for payloads_chunk in grouper(payloads, self.enqueue_batch_size):
+            now = time.time()
+            values = [_encode_message(x, now) for x in payloads_chunk]
+            self.redis_client.lpush(self.queue_key, *values)
+
+    def read(self):
+        now = time.time()
+        if (self.last_reap is None or
+                now - self.last_reap >= self.reap_interval_seconds):
+            self.reap(now)
+
+        value = self.redis_client.brpoplpush(
+            self.queue_key, self.processing_key,
+            timeout=self.read_wait_seconds)
+        if value is None:
+            return []
+        values = [value]
+
+        if self.read_size > 1:
+            with self.redis_client.pipeline(transaction=False) as pipe:
+                for _ in range(self.read_size - 1):
+                    pipe.rpoplpush(self.queue_key, self.processing_key)
+                values.extend(x for x in pipe.execute() if x is not None)
+
+        deadline = time.time() + self.visibility_timeout_seconds
+        self.redis_client.hmset(
+            self.deadlines_key, dict((x, deadline) for x in values))
+
+        msg_handles = []
+        for value in values:
+            payload, timestamp = _decode_message(value)
+            metadata = dict(timestamp=timestamp)
+            msg_handle = MessageHandle(value, payload, metadata)
+            msg_handles.append(msg_handle)
+        return msg_handles
+
+    def reap(self, now=None):
+        """requeue messages whose visibility deadline has passed"""
+        if now is None:
+            now = time.time()
+        self.last_reap = now
+        n = self.reap_script(
+            keys=[self.queue_key, self.processing_key, self.deadlines_key],
+            args=[now, self.visibility_timeout_seconds])
+        return n
+
+    def job_progress(self, handle):
+        """
+        push back the visibility deadline of the message. returns False
+        when the message was requeued, or is done, and isn't held any
+        more.
+        """
+        deadline = time.time() + self.visibility_timeout_seconds
+        held = self.progress_script(
+            keys=[self.processing_key, self.deadlines_key],
+            args=[handle, deadline])
+        return bool(held)
+
+    def job_done(self, handle):
+        with self.redis_client.pipeline() as pipe:
+            pipe.lrem(self.processing_key, 1, handle)
+            pipe.hdel(self.deadlines_key, handle)
+            pipe.execute()
+
+    def clear(self):
+        with self.redis_client.pipeline() as pipe:
+            pipe.llen(self.queue_key)
+            pipe.delete(
+                self.queue_key, self.processing_key, self.deadlines_key)
+            n, _ = pipe.execute()
+        return n
+
+    def close(self):
+        pass
+
+
 def make_redis_queue(redis_client, queue_key):
     return RedisQueue(redis_client, queue_key)
+
+
+def make_reliable_redis_queue(
+        redis_client, queue_key, read_size=10, read_wait_seconds=20,
+        visibility_timeout_seconds=3600, reap_interval_seconds=60):
+    return ReliableRedisQueue(
+        redis_client, queue_key, read_size, read_wait_seconds,
+        visibility_timeout_seconds, reap_interval_seconds)
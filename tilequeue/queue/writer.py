@@ -46,7 +46,23 @@ class QueueWriter(object):
         inflight_ctr = InFlightCounter(self.inflight_mgr)
         coords = inflight_ctr.filter(coords)
         coord_groups = self.queue_mapper.group(coords)
+        self._enqueue_coord_groups(coord_groups)
+        return inflight_ctr.n_not_inflight, inflight_ctr.n_inflight
+
+    def enqueue_coord_ints(self, coord_ints):
+        """enqueue marshalled coordinate integers in bulk
+
+        This avoids creating coordinate objects until the payloads are
+        marshalled, which matters when enqueueing the whole toi.
+        """
+        n_coords = len(coord_ints)
+        coord_ints = self.inflight_mgr.filter_coord_ints(coord_ints)
+        n_not_inflight = len(coord_ints)
+        coord_groups = self.queue_mapper.group_coord_ints(coord_ints)
+        self._enqueue_coord_groups(coord_groups)
+        return n_not_inflight, n_coords - n_not_inflight
 
+    def _enqueue_coord_groups(self, coord_groups):
         # buffer the coords to send out per queue
         queue_send_buffer = defaultdict(list)
 
@@ -64,5 +80,3 @@ class QueueWriter(object):
         for queue_id, send_data in queue_send_buffer.iteritems():
             if send_data:
                 self._enqueue_batch(queue_id, send_data)
-
-        return inflight_ctr.n_not_inflight, inflight_ctr.n_inflight
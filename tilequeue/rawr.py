@@ -15,11 +15,12 @@ from tilequeue.store import calc_hash
 from tilequeue.tile import coord_marshall_int
 from tilequeue.tile import coord_unmarshall_int
 from tilequeue.tile import deserialize_coord
-from tilequeue.toi import load_set_from_gzipped_fp
+from tilequeue.toi import load_array_from_toi_fp
 from tilequeue.utils import format_stacktrace_one_line
 from tilequeue.utils import grouper
 from tilequeue.utils import time_block
 from time import gmtime
+import re
 import zipfile
 
 
@@ -280,7 +281,7 @@ class RawrToiIntersector(object):
                 raise e
         status_code = resp['ResponseMetadata']['HTTPStatusCode']
         if status_code == 304:
-            assert self.prev_toi
+            assert self.prev_toi is not None
             toi = self.prev_toi
             is_cached = True
         elif status_code == 200:
@@ -293,7 +294,7 @@ class RawrToiIntersector(object):
                 except Exception:
                     pass
             gzip_file_obj = StringIO(gzip_payload)
-            toi = load_set_from_gzipped_fp(gzip_file_obj)
+            toi = load_array_from_toi_fp(gzip_file_obj)
             self.prev_toi = toi
             self.etag = resp['ETag']
         else:
@@ -539,28 +540,90 @@ def make_rawr_zip_payload(rawr_tile, date_time=None):
     return buf.getvalue()
 
 
+# size of the chunks of decompressed table data which are fed to the msgpack
+# unpacker.
+_unpack_chunk_size = 1024 * 1024
+
+
+def _iter_zip_member_rows(zfh, name):
+    # decompress the member a chunk at a time, so that the whole table never
+    # has to be held in memory, and rows are available as soon as their chunk
+    # has been read.
+    unpacker = Unpacker()
+    with closing(zfh.open(name, 'r')) as member_fp:
+        while True:
+            chunk = member_fp.read(_unpack_chunk_size)
+            if not chunk:
+                break
+            unpacker.feed(chunk)
+            for row in unpacker:
+                yield row
+
+
 def unpack_rawr_zip_payload(table_sources, payload):
-    """unpack a zipfile and turn it into a callable "tables" object."""
-    # the io we get from S3 is streaming, so we can't seek on it, but zipfile
-    # seems to require that. so we buffer it all in memory. RAWR tiles are
-    # generally up to around 100MB in size, which should be safe to store in
-    # RAM.
-    from tilequeue.query.common import Table
-    from io import BytesIO
+    """unpack a zipfile and turn it into a callable "tables" object.
 
-    zfh = zipfile.ZipFile(BytesIO(payload), 'r')
+    the payload is the zipfile as a buffer, either a string or a memory map.
+    the rows of each table are decompressed and unpacked lazily as they're
+    iterated over. each table reads the payload through its own zipfile
+    reader, so tables can be read at the same time from different threads.
+    """
+    from tilequeue.query.common import Table
 
     def get_table(table_name):
-        # need to extract the whole compressed file from zip reader, as it
-        # doesn't support .tell() on the filelike, which gzip requires.
-        data = zfh.open(table_name, 'r').read()
-        unpacker = Unpacker(file_like=BytesIO(data))
+        # StringIO reads from the buffer rather than copying it.
+        zfh = zipfile.ZipFile(StringIO(payload), 'r')
+        rows = _iter_zip_member_rows(zfh, table_name)
         source = table_sources[table_name]
-        return Table(source, unpacker)
+        return Table(source, rows)
+
+    # the uncompressed size of the tables, as an estimate of how much
+    # memory indexing them takes.
+    zfh = zipfile.ZipFile(StringIO(payload), 'r')
+    get_table.size_bytes = sum(info.file_size for info in zfh.infolist())
 
     return get_table
 
 
+# size up to which RAWR tile payloads are spooled in memory rather than
+# on disk.
+_default_max_memory_size = 16 * 1024 * 1024
+
+
+def _spool_body(body_fp, max_memory_size):
+    # zipfile needs to seek to the central directory at the end of the file,
+    # but the io we get from S3 is streaming. rather than buffer the whole of
+    # a RAWR tile, which can be around 100MB, in memory, the body is spooled
+    # to a temporary file, which is memory mapped, once it grows larger than
+    # max_memory_size.
+    import mmap
+    from tempfile import TemporaryFile
+
+    chunks = []
+    size = 0
+    spool = None
+    while True:
+        chunk = body_fp.read(_unpack_chunk_size)
+        if not chunk:
+            break
+        if spool is None:
+            size += len(chunk)
+            chunks.append(chunk)
+            if size > max_memory_size:
+                spool = TemporaryFile()
+                spool.writelines(chunks)
+                del chunks[:]
+        else:
+            spool.write(chunk)
+
+    if spool is None:
+        return ''.join(chunks)
+
+    with spool:
+        spool.flush()
+        return mmap.mmap(spool.fileno(), 0, access=mmap.ACCESS_READ)
+
+
 def make_rawr_s3_path(tile, prefix, suffix):
     path_to_hash = '%d/%d/%d%s' % (tile.z, tile.x, tile.y, suffix)
     path_hash = calc_hash(path_to_hash)
@@ -624,21 +687,28 @@ class RawrS3Source(object):
     """Rawr source to read from S3."""
 
     def __init__(self, s3_client, bucket, prefix, suffix, table_sources,
-                 allow_missing_tiles=False):
+                 allow_missing_tiles=False,
+                 max_memory_size=_default_max_memory_size):
         self.s3_client = s3_client
         self.bucket = bucket
         self.prefix = prefix
         self.suffix = suffix
         self.table_sources = table_sources
         self.allow_missing_tiles = allow_missing_tiles
+        self.max_memory_size = max_memory_size
 
-    def _get_object(self, tile):
+    def _get_object(self, tile, version=None):
         location = make_rawr_s3_path(tile, self.prefix, self.suffix)
 
+        kwargs = {}
+        if version is not None:
+            kwargs['IfNoneMatch'] = '"%s"' % version
+
         try:
             response = self.s3_client.get_object(
                 Bucket=self.bucket,
                 Key=location,
+                **kwargs
             )
         except Exception, e:
             # if we allow missing tiles, then translate a 404 exception into a
@@ -652,18 +722,58 @@ class RawrS3Source(object):
 
         return response
 
-    def __call__(self, tile):
+    def get_payload(self, tile, version=None):
+        """
+        Returns the version of the tile, its ETag, and a file-like object
+        for its payload. If the version is given and the tile hasn't
+        changed, the payload is None. Both are None if the tile is missing
+        and allowed to be.
+        """
+
         # throws an exception if the object is missing - RAWR tiles
-        response = self._get_object(tile)
+        try:
+            response = self._get_object(tile, version)
+        except ClientError, e:
+            status = e.response['ResponseMetadata']['HTTPStatusCode']
+            if version is not None and status == 304:
+                return version, None
+            raise
 
         if response is None:
-            return _empty_table
+            return None, None
 
         # check that the response isn't a delete marker.
         assert 'DeleteMarker' not in response
 
-        with closing(response['Body']) as body_fp:
-            body = body_fp.read()
+        return rawr_version_key(response['ETag']), response['Body']
+
+    def version(self, tile):
+        """
+        Returns the version of the tile, its ETag, without reading it, or
+        None if it's missing and allowed to be.
+        """
+
+        location = make_rawr_s3_path(tile, self.prefix, self.suffix)
+        try:
+            response = self.s3_client.head_object(
+                Bucket=self.bucket,
+                Key=location,
+            )
+        except ClientError, e:
+            status = e.response['ResponseMetadata']['HTTPStatusCode']
+            if self.allow_missing_tiles and status == 404:
+                return None
+            raise
+        return rawr_version_key(response['ETag'])
+
+    def __call__(self, tile):
+        version, body_fp = self.get_payload(tile)
+
+        if body_fp is None:
+            return _empty_table
+
+        with closing(body_fp):
+            body = _spool_body(body_fp, self.max_memory_size)
         return unpack_rawr_zip_payload(self.table_sources, body)
 
 
@@ -682,11 +792,123 @@ class RawrStoreSource(object):
         payload = self.store.read_tile(coord, format, layer)
         return payload
 
+    def version(self, tile):
+        """
+        Returns the version of the tile, its content hash, or None if the
+        store doesn't have content hashes.
+        """
+
+        read_tile_hash = getattr(self.store, 'read_tile_hash', None)
+        if read_tile_hash is None:
+            return None
+        coord = unconvert_coord_object(tile)
+        tile_hash = read_tile_hash(coord, zip_format, 'rawr')
+        if not tile_hash:
+            return None
+        return rawr_version_key(tile_hash)
+
+    def get_payload(self, tile, version=None):
+        """
+        Returns the version of the tile, its content hash if the store
+        has them, and a file-like object for its payload. If the version
+        is given and the tile hasn't changed, the payload is None.
+        """
+
+        current_version = self.version(tile)
+        if version is not None and version == current_version:
+            return version, None
+
+        payload = self._get_object(tile)
+        return current_version, StringIO(payload)
+
     def __call__(self, tile):
         payload = self._get_object(tile)
         return unpack_rawr_zip_payload(self.table_sources, payload)
 
 
+def rawr_version_key(version):
+    """
+    Returns a version of a RAWR tile, such as an ETag, in a form that can
+    be used as a file name.
+    """
+    return re.sub('[^0-9A-Za-z-]', '', version)
+
+
+class RawrCachedSource(object):
+
+    """Rawr source which keeps the tiles it reads on local disk
+
+    Wraps a RawrS3Source or RawrStoreSource. Tiles are kept in the cache
+    along with their version, the ETag or content hash, and are only
+    read again from the wrapped source if the version changed. Cached
+    tiles are memory mapped rather than read.
+    """
+
+    def __init__(self, source, cache, table_sources, stats_handler=None):
+        self.source = source
+        self.cache = cache
+        self.table_sources = table_sources
+        self.stats_handler = stats_handler
+
+    def version(self, tile):
+        return self.source.version(tile)
+
+    def _read_cached(self, coord, version):
+        # memory maps the cached tile, or returns None if it isn't there,
+        # for example because it was evicted.
+        import mmap
+        file_path = self.cache.get_path(coord, version)
+        if file_path is None:
+            return None
+        try:
+            with open(file_path, 'rb') as fp:
+                return mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+        except (IOError, OSError):
+            return None
+
+    def _cached(self, hit):
+        if self.stats_handler:
+            self.stats_handler.rawr_tile_cache(hit)
+
+    def __call__(self, tile):
+        coord = unconvert_coord_object(tile)
+        cached_versions = self.cache.keys(coord)
+        cached_version = cached_versions[0] if cached_versions else None
+
+        version, body_fp = self.source.get_payload(tile, cached_version)
+        if body_fp is None and version is not None:
+            payload = self._read_cached(coord, version)
+            if payload is not None:
+                self._cached(True)
+                return unpack_rawr_zip_payload(self.table_sources, payload)
+            # evicted since it was looked up
+            version, body_fp = self.source.get_payload(tile)
+
+        if body_fp is None:
+            return _empty_table
+
+        self._cached(False)
+        if version is not None:
+            with closing(body_fp):
+                self.cache.set_fp(coord, version, body_fp)
+            for old_version in cached_versions:
+                if old_version != version:
+                    self.cache.remove(coord, old_version)
+
+            payload = self._read_cached(coord, version)
+            if payload is not None:
+                return unpack_rawr_zip_payload(self.table_sources, payload)
+            # too large for the cache, so read it again
+            version, body_fp = self.source.get_payload(tile)
+            if body_fp is None:
+                return _empty_table
+
+        # without a version, the tile can't be cached
+        with closing(body_fp):
+            body = _spool_body(body_fp, _default_max_memory_size)
+        return unpack_rawr_zip_payload(self.table_sources, body)
+
+
 def make_rawr_queue(name, region, wait_time_secs):
     import boto3
     sqs_client = boto3.client('sqs', region_name=region)
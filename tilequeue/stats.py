@@ -26,6 +26,38 @@ class TileProcessingStatsHandler(object):
         duration = stop_time - start_time
         self.stats.timing('process.pyramid', duration)
 
+    def tracked_messages(self, n_msgs, n_coords, n_expired):
+        with self.stats.pipeline() as pipe:
+            pipe.gauge('process.tracker.messages', n_msgs)
+            pipe.gauge('process.tracker.coords', n_coords)
+            pipe.incr('process.tracker.expired', n_expired)
+
+    def pool_counts(self, pool_name, n_active, n_queued, n_completed):
+        prefix = 'process.pool.%s' % pool_name
+        with self.stats.pipeline() as pipe:
+            pipe.gauge('%s.active' % prefix, n_active)
+            pipe.gauge('%s.queued' % prefix, n_queued)
+            pipe.incr('%s.completed' % prefix, n_completed)
+
+    def fetched_query(self, source_name, zoom, duration_millis, n_rows):
+        prefix = 'process.query.%s.%d' % (source_name, zoom)
+        with self.stats.pipeline() as pipe:
+            pipe.timing(prefix, duration_millis)
+            pipe.gauge('%s.rows' % prefix, n_rows)
+
+    def query_error(self, source_name, zoom):
+        self.stats.incr('process.query.%s.%d.errors' % (source_name, zoom), 1)
+
+    def query_timeout(self, source_name, zoom):
+        self.stats.incr(
+            'process.query.%s.%d.timeouts' % (source_name, zoom), 1)
+
+    def rawr_tile_cache(self, hit):
+        if hit:
+            self.stats.incr('process.rawr.cache.hit', 1)
+        else:
+            self.stats.incr('process.rawr.cache.miss', 1)
+
     def fetch_error(self):
         self.stats.incr('process.errors.fetch', 1)
 
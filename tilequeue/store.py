@@ -1,15 +1,19 @@
 # define locations to store the rendered data
 
-from boto import connect_s3
-from boto.s3.bucket import Bucket
 from builtins import range
 from future.utils import raise_from
+import errno
 import md5
 from ModestMaps.Core import Coordinate
+from multiprocessing.pool import ThreadPool
 import os
+from tilequeue.metatile import metatile_content_hash
 from tilequeue.metatile import metatiles_are_equal
 from tilequeue.format import zip_format
+from tilequeue.tile import coord_marshall_int
+from tilequeue.utils import CountingThreadPool
 import random
+import sqlite3
 import threading
 import time
 
@@ -59,117 +63,330 @@ def parse_coordinate_from_path(path, extension, layer):
                         pass
 
 
-# decorates a function to back off and retry
-def _backoff_and_retry(ExceptionType, num_tries=5, retry_factor=2,
-                       retry_interval=1, logger=None):
-    from time import sleep
-    from functools import wraps
+def _batches(items, batch_size):
+    for i in xrange(0, len(items), batch_size):
+        yield items[i:i + batch_size]
 
-    def decorator(f):
-        @wraps(f)
-        def func(*args, **kwargs):
-            # do the first num_tries-1 attempts wrapped in something to catch
-            # any exceptions, optionally log them, and try again.
-            interval = retry_interval
-            factor = retry_factor
 
-            for _ in xrange(1, num_tries):
-                try:
-                    return f(*args, **kwargs)
+def _map_in_pool(f, batches, n_threads):
+    """
+    Map f over batches with a bounded pool of threads.
+
+    The pool is only created when there is more than one batch, so that
+    small deletes don't pay for thread start up.
+    """
+
+    if n_threads <= 1 or len(batches) <= 1:
+        return map(f, batches)
+
+    pool = ThreadPool(min(n_threads, len(batches)))
+    try:
+        return pool.map(f, batches, chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
+
+
+def tile_content_hash(tile_data, fmt):
+    """
+    Returns a hex digest of the tile data, which is equal for two tiles
+    exactly when tiles_are_equal would consider them equal.
+    """
 
-                except ExceptionType as e:
-                    if logger:
-                        logger.warning("Failed. Backing off and retrying. "
-                                       "Error: %s" % str(e))
+    if fmt and fmt == zip_format:
+        content_hash = metatile_content_hash(tile_data)
+        if content_hash is not None:
+            return content_hash
 
-                sleep(interval)
-                interval *= factor
+    return md5.new(tile_data).hexdigest()
 
-            # do final attempt without try-except, so we get the exception
-            # in normal code.
-            return f(*args, **kwargs)
 
-        return func
-    return decorator
+class TileHashIndex(object):
+    """
+    Local index of the content hash of the last tile successfully
+    written to a store, keyed on (layer, format, coord).
+
+    This lets unchanged tiles be skipped without making any request to
+    the store at all. The index is a sqlite file, so it is shared
+    between threads and processes on the same machine.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(
+            path, timeout=60, check_same_thread=False)
+        with self.lock, self.conn:
+            self.conn.execute(
+                'CREATE TABLE IF NOT EXISTS tile_hash ('
+                'layer TEXT NOT NULL, '
+                'extension TEXT NOT NULL, '
+                'coord INTEGER NOT NULL, '
+                'hash TEXT NOT NULL, '
+                'PRIMARY KEY (layer, extension, coord))')
+
+    def get(self, coord, format, layer):
+        with self.lock:
+            row = self.conn.execute(
+                'SELECT hash FROM tile_hash '
+                'WHERE layer = ? AND extension = ? AND coord = ?',
+                (layer, format.extension, coord_marshall_int(coord)),
+            ).fetchone()
+        return row[0] if row else None
+
+    def put(self, coord, format, layer, content_hash):
+        self.put_many([(coord, content_hash)], format, layer)
+
+    def put_many(self, coord_hashes, format, layer):
+        rows = ((layer, format.extension, coord_marshall_int(coord), h)
+                for coord, h in coord_hashes)
+        with self.lock, self.conn:
+            self.conn.executemany(
+                'INSERT OR REPLACE INTO tile_hash '
+                '(layer, extension, coord, hash) VALUES (?, ?, ?, ?)',
+                rows)
+
+    def invalidate(self, coords, format, layer):
+        rows = ((layer, format.extension, coord_marshall_int(coord))
+                for coord in coords)
+        with self.lock, self.conn:
+            self.conn.executemany(
+                'DELETE FROM tile_hash '
+                'WHERE layer = ? AND extension = ? AND coord = ?',
+                rows)
+
+    def clear(self):
+        with self.lock, self.conn:
+            self.conn.execute('DELETE FROM tile_hash')
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+
+def make_tile_hash_index(path):
+    return TileHashIndex(path)
 
 
 class S3(object):
 
+    # metadata key under which the content hash of the tile is kept
+    content_hash_metadata_key = 'content-hash'
+
+    # the maximum number of keys that s3 accepts in a multi-delete request
+    delete_batch_size = 1000
+
+    # tiles larger than this are uploaded in parts
+    multipart_threshold = 8 * 1024 * 1024
+
     def __init__(
-            self, bucket, date_prefix, path, reduced_redundancy,
-            delete_retry_interval, logger):
-        self.bucket = bucket
+            self, s3_client, bucket_name, date_prefix, path,
+            reduced_redundancy, delete_retry_interval, logger,
+            delete_threads=1, delete_retry_initial_interval=1,
+            hash_index=None):
+        self.s3_client = s3_client
+        self.bucket_name = bucket_name
         self.date_prefix = date_prefix
         self.path = path
         self.reduced_redundancy = reduced_redundancy
         self.delete_retry_interval = delete_retry_interval
         self.logger = logger
+        self.delete_threads = delete_threads
+        self.delete_retry_initial_interval = delete_retry_initial_interval
+        self.hash_index = hash_index
+
+    def _key_name(self, coord, format, layer):
+        return s3_tile_key(
+            self.date_prefix, self.path, layer, coord,
+            format.extension).lstrip('/')
 
     def write_tile(self, tile_data, coord, format, layer):
-        key_name = s3_tile_key(
-            self.date_prefix, self.path, layer, coord, format.extension)
-        key = self.bucket.new_key(key_name)
-
-        @_backoff_and_retry(Exception, logger=self.logger)
-        def write_to_s3():
-            key.set_contents_from_string(
-                tile_data,
-                headers={'Content-Type': format.mimetype},
-                policy='public-read',
-                reduced_redundancy=self.reduced_redundancy,
-            )
+        key_name = self._key_name(coord, format, layer)
+        storage_class = 'STANDARD'
+        if self.reduced_redundancy:
+            storage_class = 'REDUCED_REDUNDANCY'
+        args = dict(
+            ACL='public-read',
+            ContentType=format.mimetype,
+            Metadata={
+                self.content_hash_metadata_key:
+                    tile_content_hash(tile_data, format),
+            },
+            StorageClass=storage_class,
+        )
 
-        write_to_s3()
+        # the client retries failed requests itself, according to its
+        # retry configuration.
+        if len(tile_data) < self.multipart_threshold:
+            self.s3_client.put_object(
+                Bucket=self.bucket_name, Key=key_name, Body=tile_data,
+                **args)
+        else:
+            from boto3.s3.transfer import TransferConfig
+            from io import BytesIO
+            self.s3_client.upload_fileobj(
+                BytesIO(tile_data), self.bucket_name, key_name,
+                ExtraArgs=args,
+                Config=TransferConfig(
+                    multipart_threshold=self.multipart_threshold,
+                    use_threads=False))
+
+    def _head(self, key_name):
+        from botocore.exceptions import ClientError
+        try:
+            return self.s3_client.head_object(
+                Bucket=self.bucket_name, Key=key_name)
+        except ClientError as e:
+            if e.response['Error']['Code'] in ('404', 'NoSuchKey'):
+                return None
+            raise
 
     def read_tile(self, coord, format, layer):
-        key_name = s3_tile_key(
-            self.date_prefix, self.path, layer, coord, format.extension)
-        key = self.bucket.get_key(key_name)
-        if key is None:
+        key_name = self._key_name(coord, format, layer)
+        try:
+            resp = self.s3_client.get_object(
+                Bucket=self.bucket_name, Key=key_name)
+        except self.s3_client.exceptions.NoSuchKey:
             return None
-        tile_data = key.get_contents_as_string()
+        tile_data = resp['Body'].read()
         return tile_data
 
-    def delete_tiles(self, coords, format, layer):
-        key_names = [
-            s3_tile_key(self.date_prefix, self.path, layer, coord,
-                        format.extension).lstrip('/')
-            for coord in coords
-        ]
+    def read_tile_hash(self, coord, format, layer):
+        """
+        Returns the content hash of the stored tile, using only a HEAD
+        request, or None if the tile doesn't exist.
+
+        Tiles written before the hash was stored in the metadata fall
+        back to the ETag, which is the MD5 of the data for these single
+        part uploads. That's only comparable for formats hashed over the
+        raw bytes, so older metatiles return an empty hash, which never
+        matches and gets them re-written with the metadata.
+        """
+
+        resp = self._head(self._key_name(coord, format, layer))
+        if resp is None:
+            return None
+        content_hash = resp.get('Metadata', {}).get(
+            self.content_hash_metadata_key)
+        if content_hash:
+            return content_hash
+        etag = resp.get('ETag')
+        if format == zip_format or not etag:
+            return ''
+        return etag.strip('"')
+
+    def _delete_keys(self, key_names):
+        """
+        Delete a batch of keys, retrying any that fail transiently.
+
+        Each key that fails is retried after its own backoff, which
+        doubles on every failure up to delete_retry_interval, so that a
+        single error doesn't hold up the rest of the batch for the full
+        interval.
+        """
 
         num_deleted = 0
-        while key_names:
-            del_result = self.bucket.delete_keys(key_names)
-            num_deleted += len(del_result.deleted)
+        # key name -> number of times that deleting it has failed
+        failures = {}
+        # key name -> earliest time at which to retry it
+        waiting = {}
+        while True:
+            del_result = self.s3_client.delete_objects(
+                Bucket=self.bucket_name,
+                Delete=dict(
+                    Objects=[dict(Key=key_name) for key_name in key_names],
+                ),
+            )
+            num_deleted += len(del_result.get('Deleted', ()))
 
-            key_names = []
-            for error in del_result.errors:
+            now = time.time()
+            for error in del_result.get('Errors', ()):
                 # retry on internal error. documentation implies that the only
                 # possible two errors are AccessDenied and InternalError.
                 # retrying when access denied seems unlikely to work, but an
                 # internal error might be transient.
-                if error.code == 'InternalError':
-                    key_names.append(error.key)
+                if error['Code'] == 'InternalError':
+                    failed_key = error['Key']
+                    n_failures = failures.get(failed_key, 0)
+                    failures[failed_key] = n_failures + 1
+                    interval = min(
+                        self.delete_retry_initial_interval * 2 ** n_failures,
+                        self.delete_retry_interval)
+                    waiting[failed_key] = now + interval
+
+            if not waiting:
+                break
+
+            # pause until the first key is ready to be retried, and then
+            # retry all the keys whose backoff has expired.
+            retry_at = min(waiting.itervalues())
+            if retry_at > now:
+                time.sleep(retry_at - now)
+            now = time.time()
+            key_names = [key_name for key_name, t in waiting.iteritems()
+                         if t <= now]
+            for key_name in key_names:
+                del waiting[key_name]
 
-            # pause a bit to give transient errors a chance to clear.
-            if key_names:
-                time.sleep(self.delete_retry_interval)
+        return num_deleted
+
+    def delete_tiles(self, coords, format, layer):
+        # the index must not claim that deleted tiles are unchanged, so
+        # forget them before they're removed.
+        if self.hash_index is not None:
+            self.hash_index.invalidate(coords, format, layer)
+
+        key_names = [
+            self._key_name(coord, format, layer)
+            for coord in coords
+        ]
+
+        batches = list(_batches(key_names, self.delete_batch_size))
+        num_deleted = sum(_map_in_pool(
+            self._delete_keys, batches, self.delete_threads))
 
         # make sure that we deleted all the tiles - this seems like the
         # expected behaviour from the calling code.
-        assert num_deleted == len(coords), \
+        assert num_deleted == len(key_names), \
             "Failed to delete some coordinates from S3."
 
         return num_deleted
 
+    def _list_keys(self):
+        paginator = self.s3_client.get_paginator('list_objects_v2')
+        for page in paginator.paginate(
+                Bucket=self.bucket_name, Prefix=self.date_prefix):
+            for obj in page.get('Contents', ()):
+                yield obj
+
     def list_tiles(self, format, layer):
         ext = '.' + format.extension
-        for key_obj in self.bucket.list(prefix=self.date_prefix):
-            key = key_obj.key
-            coord = parse_coordinate_from_path(key, ext, layer)
+        for obj in self._list_keys():
+            coord = parse_coordinate_from_path(obj['Key'], ext, layer)
             if coord:
                 yield coord
 
+    def list_tile_hashes(self, format, layer):
+        """
+        Yields (coord, content hash) for the stored tiles.
+
+        The ETag in the listing is used where it is the content hash,
+        otherwise the hash is read from each tile's metadata. Tiles
+        without a usable hash are skipped.
+        """
+
+        ext = '.' + format.extension
+        for obj in self._list_keys():
+            coord = parse_coordinate_from_path(obj['Key'], ext, layer)
+            if not coord:
+                continue
+            if format == zip_format:
+                content_hash = self.read_tile_hash(coord, format, layer)
+            else:
+                content_hash = obj['ETag'].strip('"')
+            if content_hash:
+                yield coord, content_hash
+
 
 def make_dir_path(base_path, coord, layer):
     path = os.path.join(
@@ -254,7 +471,7 @@ class TileDirectory(object):
     Writes tiles to individual files in a local directory.
     '''
 
-    def __init__(self, base_path):
+    def __init__(self, base_path, delete_threads=1):
         if os.path.exists(base_path):
             if not os.path.isdir(base_path):
                 raise IOError(
@@ -263,6 +480,7 @@ class TileDirectory(object):
             os.makedirs(base_path)
 
         self.base_path = base_path
+        self.delete_threads = delete_threads
 
     def write_tile(self, tile_data, coord, format, layer):
         dir_path = make_dir_path(self.base_path, coord, layer)
@@ -303,14 +521,32 @@ class TileDirectory(object):
         except IOError:
             return None
 
-    def delete_tiles(self, coords, format, layer):
+    def _delete_files(self, file_paths):
         delete_count = 0
-        for coord in coords:
-            file_path = make_file_path(
-                self.base_path, coord, layer, format.extension)
-            if os.path.isfile(file_path):
+        for file_path in file_paths:
+            # removing and ignoring a missing file saves a stat per tile
+            try:
                 os.remove(file_path)
+            except OSError as e:
+                if e.errno != errno.ENOENT:
+                    raise
+            else:
                 delete_count += 1
+        return delete_count
+
+    def delete_tiles(self, coords, format, layer):
+        file_paths = [
+            make_file_path(self.base_path, coord, layer, format.extension)
+            for coord in coords
+        ]
+        if not file_paths:
+            return 0
+
+        # split the files evenly across the threads
+        batch_size = -(-len(file_paths) // max(self.delete_threads, 1))
+        batches = list(_batches(file_paths, batch_size))
+        delete_count = sum(_map_in_pool(
+            self._delete_files, batches, self.delete_threads))
 
         return delete_count
 
@@ -324,10 +560,10 @@ class TileDirectory(object):
                     yield coord
 
 
-def make_tile_file_store(base_path=None):
+def make_tile_file_store(base_path=None, delete_threads=1):
     if base_path is None:
         base_path = 'tiles'
-    return TileDirectory(base_path)
+    return TileDirectory(base_path, delete_threads=delete_threads)
 
 
 class Memory(object):
@@ -351,14 +587,50 @@ class Memory(object):
         return [self.data] if self.data else []
 
 
+def make_s3_client(aws_access_key_id=None, aws_secret_access_key=None,
+                   max_pool_connections=10, max_attempts=5):
+    """
+    Makes an S3 client that can be shared between threads.
+
+    Retries use botocore's adaptive mode, which backs off and also
+    limits the client's request rate when S3 starts throttling.
+    """
+
+    import boto3
+    from botocore.config import Config
+    config = Config(
+        max_pool_connections=max_pool_connections,
+        retries=dict(mode='adaptive', max_attempts=max_attempts),
+    )
+    return boto3.client(
+        's3',
+        aws_access_key_id=aws_access_key_id,
+        aws_secret_access_key=aws_secret_access_key,
+        config=config,
+    )
+
+
 def make_s3_store(bucket_name,
                   aws_access_key_id=None, aws_secret_access_key=None,
                   path='osm', reduced_redundancy=False, date_prefix='',
-                  delete_retry_interval=60, logger=None):
-    conn = connect_s3(aws_access_key_id, aws_secret_access_key)
-    bucket = Bucket(conn, bucket_name)
-    s3_store = S3(bucket, date_prefix, path, reduced_redundancy,
-                  delete_retry_interval, logger)
+                  delete_retry_interval=60, logger=None, delete_threads=1,
+                  hash_index_path=None, max_pool_connections=None,
+                  max_attempts=5):
+    # there needs to be a connection for every thread that might use the
+    # client at the same time, otherwise they wait for each other.
+    if not max_pool_connections:
+        max_pool_connections = 10
+    max_pool_connections = max(max_pool_connections, delete_threads)
+    s3_client = make_s3_client(
+        aws_access_key_id, aws_secret_access_key,
+        max_pool_connections=max_pool_connections,
+        max_attempts=max_attempts)
+    hash_index = None
+    if hash_index_path:
+        hash_index = make_tile_hash_index(hash_index_path)
+    s3_store = S3(s3_client, bucket_name, date_prefix, path,
+                  reduced_redundancy, delete_retry_interval, logger,
+                  delete_threads=delete_threads, hash_index=hash_index)
     return s3_store
 
 
@@ -381,10 +653,35 @@ def write_tile_if_changed(store, tile_data, coord, format, layer):
     """
     Only write tile data if different from existing.
 
-    Try to read the tile data from the store first. If the existing
-    data matches, don't write. Returns whether the tile was written.
+    Stores which can look up the hash of a stored tile cheaply, without
+    transferring it, are compared by hash. Otherwise, try to read the
+    tile data from the store first. If the existing data matches, don't
+    write. Returns whether the tile was written.
     """
 
+    read_tile_hash = getattr(store, 'read_tile_hash', None)
+    if read_tile_hash is not None:
+        content_hash = tile_content_hash(tile_data, format)
+
+        # a local index of what was last written avoids asking the store
+        # at all. the store is only consulted when the index doesn't
+        # know about the tile.
+        hash_index = getattr(store, 'hash_index', None)
+        indexed_hash = None
+        if hash_index is not None:
+            indexed_hash = hash_index.get(coord, format, layer)
+        if indexed_hash is not None:
+            existing_hash = indexed_hash
+        else:
+            existing_hash = read_tile_hash(coord, format, layer)
+
+        did_write = existing_hash != content_hash
+        if did_write:
+            store.write_tile(tile_data, coord, format, layer)
+        if hash_index is not None and indexed_hash != content_hash:
+            hash_index.put(coord, format, layer, content_hash)
+        return did_write
+
     existing_data = store.read_tile(coord, format, layer)
     if not existing_data or \
        not tiles_are_equal(existing_data, tile_data, format):
@@ -394,20 +691,62 @@ def write_tile_if_changed(store, tile_data, coord, format, layer):
         return False
 
 
-def make_store(yml, credentials={}, logger=None):
+class StoreWriter(object):
+    """
+    Writes tiles to a store from its own, dedicated pool of threads.
+
+    Uploads are submitted in batches and a future is returned for each
+    tile, so that callers can have many uploads in flight without
+    taking threads away from anything else, such as database queries.
+    """
+
+    def __init__(self, store, n_threads):
+        self.store = store
+        self.n_threads = n_threads
+        self.pool = CountingThreadPool(n_threads)
+
+    def write_tiles(self, tiles):
+        """
+        Submits the tiles, which are dicts with tile, coord, format and
+        layer keys, for writing if they have changed. Returns a list of
+        futures, one per tile, with whether the tile was written.
+        """
+
+        async_results = []
+        for tile in tiles:
+            async_result = self.pool.apply_async(
+                write_tile_if_changed, (
+                    self.store,
+                    tile['tile'],
+                    tile['coord'],
+                    tile['format'],
+                    tile['layer']))
+            async_results.append(async_result)
+        return async_results
+
+    def close(self):
+        self.pool.close()
+        self.pool.join()
+
+
+def make_store(yml, credentials={}, logger=None, max_pool_connections=None):
     store_type = yml.get('type')
+    delete_threads = yml.get('delete-threads') or 1
 
     if store_type == 'directory':
         path = yml.get('path')
         name = yml.get('name')
-        return make_tile_file_store(path or name)
+        return make_tile_file_store(
+            path or name, delete_threads=delete_threads)
 
     elif store_type == 's3':
         bucket = yml.get('name')
         path = yml.get('path')
         reduced_redundancy = yml.get('reduced-redundancy')
         date_prefix = yml.get('date-prefix')
-        delete_retry_interval = yml.get('delete-retry-interval')
+        delete_retry_interval = yml.get('delete-retry-interval', 60)
+        hash_index_path = yml.get('hash-index')
+        max_attempts = yml.get('max-attempts') or 5
 
         assert credentials, 'S3 store configured, but no AWS credentials ' \
             'provided. AWS credentials are required to use S3.'
@@ -417,7 +756,10 @@ def make_store(yml, credentials={}, logger=None):
         return make_s3_store(
             bucket, aws_access_key_id, aws_secret_access_key, path=path,
             reduced_redundancy=reduced_redundancy, date_prefix=date_prefix,
-            delete_retry_interval=delete_retry_interval, logger=logger)
+            delete_retry_interval=delete_retry_interval, logger=logger,
+            delete_threads=delete_threads, hash_index_path=hash_index_path,
+            max_pool_connections=max_pool_connections,
+            max_attempts=max_attempts)
 
     else:
         raise ValueError('Unrecognized store type: `{}`'.format(store_type))
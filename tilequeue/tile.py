@@ -273,6 +273,16 @@ def coord_int_zoom_up(coord_int):
     return parent_coord_int
 
 
+# the same operation over a numpy array of coord ints. bit 63 is never
+# set, so the masks are truncated to fit in a signed 64 bit integer.
+_int64_zoom_up_mask = high_row_mask & all_but_zoom_mask & ((1 << 63) - 1)
+
+
+def coord_ints_zoom_up(coord_ints):
+    zooms = coord_ints & zoom_mask
+    return ((coord_ints >> 1) & _int64_zoom_up_mask) | (zooms - 1)
+
+
 def coord_children(coord):
     first_child = coord.zoomBy(1)
     return (
@@ -368,6 +378,15 @@ def coord_is_valid(coord, max_zoom=20):
     return True
 
 
+def coord_ints_are_valid(coord_ints, max_zoom=20):
+    """coord_is_valid over a numpy array of coord ints"""
+    zooms = coord_ints & zoom_mask
+    rows = (coord_ints >> row_offset) & row_mask
+    columns = (coord_ints >> col_offset) & col_mask
+    max_colrow = 1 << zooms
+    return (zooms <= max_zoom) & (columns < max_colrow) & (rows < max_colrow)
+
+
 def metatile_zoom_from_size(metatile_size):
     metatile_zoom = 0
 
@@ -4,6 +4,11 @@ from .file import (
     load_set_from_fp,
     save_set_to_gzipped_fp,
     load_set_from_gzipped_fp,
+    save_array_to_binary_fp,
+    load_array_from_binary_fp,
+    load_array_from_toi_fp,
+    load_set_from_toi_fp,
+    save_toi_to_fp,
 )
 from .s3 import S3TilesOfInterestSet
 
@@ -14,4 +19,9 @@ __all__ = [
     load_set_from_fp,
     save_set_to_gzipped_fp,
     load_set_from_gzipped_fp,
+    save_array_to_binary_fp,
+    load_array_from_binary_fp,
+    load_array_from_toi_fp,
+    load_set_from_toi_fp,
+    save_toi_to_fp,
 ]
@@ -5,6 +5,10 @@ from tilequeue.tile import (
     serialize_coord,
 )
 import gzip
+import numpy as np
+import os
+import struct
+import zlib
 
 
 def save_set_to_fp(the_set, fp):
@@ -36,18 +40,106 @@ def save_set_to_gzipped_fp(the_set, fp):
     gzipped_fp.close()
 
 
+# The binary toi format is the sorted coordinate integers, delta
+# encoded, with the bytes of the deltas transposed so that the mostly
+# zero high bytes end up next to each other, and then zlib compressed.
+#
+# magic | n coords (little endian uint64) | compressed deltas
+binary_toi_magic = 'TOI\x01'
+binary_toi_header = struct.Struct('<4sQ')
+
+
+def save_array_to_binary_fp(coord_ints, fp):
+    coord_ints = np.unique(np.asarray(coord_ints, dtype=np.uint64))
+    deltas = np.empty_like(coord_ints)
+    if len(coord_ints):
+        deltas[0] = coord_ints[0]
+        np.subtract(coord_ints[1:], coord_ints[:-1], out=deltas[1:])
+    shuffled = deltas.astype('<u8').view(np.uint8).reshape(-1, 8).T
+    fp.write(binary_toi_header.pack(binary_toi_magic, len(coord_ints)))
+    fp.write(zlib.compress(shuffled.tobytes(), 6))
+
+
+def load_array_from_binary_fp(fp):
+    """load a sorted int64 numpy array of coordinate ints"""
+    header = fp.read(binary_toi_header.size)
+    magic, n = binary_toi_header.unpack(header)
+    assert magic == binary_toi_magic, 'Invalid binary toi'
+    shuffled = np.frombuffer(zlib.decompress(fp.read()), dtype=np.uint8)
+    assert len(shuffled) == n * 8, 'Truncated binary toi'
+    deltas = shuffled.reshape(8, n).T.copy().view('<u8').reshape(n)
+    return np.cumsum(deltas, dtype=np.uint64).astype(np.int64)
+
+
+def _is_binary_toi_fp(fp):
+    pos = fp.tell()
+    magic = fp.read(len(binary_toi_magic))
+    fp.seek(pos)
+    return magic == binary_toi_magic
+
+
+def load_array_from_toi_fp(fp):
+    """
+    load a sorted int64 numpy array of coordinate ints from either the
+    binary or the gzipped text toi format
+    """
+    if _is_binary_toi_fp(fp):
+        return load_array_from_binary_fp(fp)
+    toi_set = load_set_from_gzipped_fp(fp)
+    toi_array = np.fromiter(toi_set, dtype=np.int64, count=len(toi_set))
+    toi_array.sort()
+    return toi_array
+
+
+def load_set_from_toi_fp(fp):
+    """load a set from either the binary or gzipped text toi format"""
+    if _is_binary_toi_fp(fp):
+        return set(load_array_from_binary_fp(fp).tolist())
+    return load_set_from_gzipped_fp(fp)
+
+
+def save_toi_to_fp(toi, fp, toi_format):
+    if toi_format == 'binary':
+        if not isinstance(toi, np.ndarray):
+            toi = np.fromiter(toi, dtype=np.uint64, count=len(toi))
+        save_array_to_binary_fp(toi, fp)
+    else:
+        assert toi_format == 'gzip', 'Unknown toi format: %s' % toi_format
+        if isinstance(toi, np.ndarray):
+            toi = toi.tolist()
+        save_set_to_gzipped_fp(toi, fp)
+
+
 class FileTilesOfInterestSet(object):
-    def __init__(self, filename):
+    def __init__(self, filename, toi_format='gzip'):
         self.filename = filename
+        # the format used when writing. reads detect the format.
+        self.toi_format = toi_format
 
     def fetch_tiles_of_interest(self):
         toi_set = set()
 
-        with open(self.filename, 'r') as toi_data:
-            toi_set = load_set_from_gzipped_fp(toi_data)
+        with open(self.filename, 'rb') as toi_data:
+            toi_set = load_set_from_toi_fp(toi_data)
 
         return toi_set
 
+    def fetch_tiles_of_interest_array(self):
+        with open(self.filename, 'rb') as toi_data:
+            return load_array_from_toi_fp(toi_data)
+
+    def fetch_tiles_of_interest_if_changed(self, version):
+        """
+        return (toi_set, version), where toi_set is None if the file
+        hasn't changed since the given version
+        """
+        st = os.stat(self.filename)
+        new_version = (st.st_mtime, st.st_size)
+        if version is not None and version == new_version:
+            return None, version
+        toi_set = self.fetch_tiles_of_interest()
+        return toi_set, new_version
+
     def set_tiles_of_interest(self, new_set):
-        with open(self.filename, 'w') as toi_data:
-            save_set_to_gzipped_fp(new_set, toi_data)
+        with open(self.filename, 'wb') as toi_data:
+            save_toi_to_fp(new_set, toi_data, self.toi_format)
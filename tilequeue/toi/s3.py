@@ -1,25 +1,56 @@
 import boto
+from boto.exception import S3ResponseError
 from cStringIO import StringIO
 from tilequeue.toi import (
-    load_set_from_gzipped_fp,
-    save_set_to_gzipped_fp,
+    load_array_from_toi_fp,
+    load_set_from_toi_fp,
+    save_toi_to_fp,
 )
 
 
 class S3TilesOfInterestSet(object):
-    def __init__(self, bucket, key):
+    def __init__(self, bucket, key, toi_format='gzip'):
         s3 = boto.connect_s3()
         buk = s3.get_bucket(bucket)
         self.key = buk.get_key(key, validate=False)
+        # the format used when writing. reads detect the format.
+        self.toi_format = toi_format
 
     def fetch_tiles_of_interest(self):
         toi_data_gz = StringIO()
         self.key.get_contents_to_file(toi_data_gz)
         toi_data_gz.seek(0)
 
-        return load_set_from_gzipped_fp(toi_data_gz)
+        return load_set_from_toi_fp(toi_data_gz)
+
+    def fetch_tiles_of_interest_array(self):
+        toi_data_gz = StringIO()
+        self.key.get_contents_to_file(toi_data_gz)
+        toi_data_gz.seek(0)
+
+        return load_array_from_toi_fp(toi_data_gz)
+
+    def fetch_tiles_of_interest_if_changed(self, version):
+        """
+        return (toi_set, version), where toi_set is None if the toi
+        hasn't changed since the given version, the etag of the last
+        fetch
+        """
+        headers = {}
+        if version is not None:
+            headers['If-None-Match'] = version
+        toi_data_gz = StringIO()
+        try:
+            self.key.get_contents_to_file(toi_data_gz, headers=headers)
+        except S3ResponseError as e:
+            if e.status == 304:
+                return None, version
+            raise
+        toi_data_gz.seek(0)
+
+        return load_set_from_toi_fp(toi_data_gz), self.key.etag
 
     def set_tiles_of_interest(self, new_set):
         toi_data_gz = StringIO()
-        save_set_to_gzipped_fp(new_set, toi_data_gz)
+        save_toi_to_fp(new_set, toi_data_gz, self.toi_format)
         self.key.set_contents_from_string(toi_data_gz.getvalue())
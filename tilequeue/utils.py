@@ -4,9 +4,12 @@ import re
 from collections import defaultdict
 from datetime import datetime
 from itertools import islice
+from multiprocessing.pool import ThreadPool
 from tilequeue.tile import coord_marshall_int
 from tilequeue.tile import create_coord
 from time import time
+import numpy as np
+import threading
 
 
 def format_stacktrace_one_line(exc_info=None):
@@ -120,3 +123,67 @@ class CoordsByParent(object):
 def convert_seconds_to_millis(time_in_seconds):
     time_in_millis = int(time_in_seconds * 1000)
     return time_in_millis
+
+
+def sorted_array_contains(sorted_array, values):
+    """
+    return a boolean array of whether each of values is in sorted_array
+
+    This is a binary search for each value, and unlike np.isin does
+    not need to sort the (usually much larger) sorted_array.
+    """
+    values = np.asarray(values, dtype=sorted_array.dtype)
+    if not len(sorted_array):
+        return np.zeros(len(values), dtype=bool)
+    idx = np.searchsorted(sorted_array, values)
+    idx[idx == len(sorted_array)] = 0
+    return sorted_array[idx] == values
+
+
+class CountingThreadPool(object):
+    """
+    Thread pool which keeps count of the jobs that are waiting, running
+    and have finished, so that they can be reported.
+
+    Only apply_async is supported, which is all that the io pools use.
+    """
+
+    def __init__(self, n_threads):
+        self.n_threads = n_threads
+        self.pool = ThreadPool(n_threads)
+        self.lock = threading.Lock()
+        self.n_queued = 0
+        self.n_active = 0
+        self.n_completed = 0
+
+    def _run(self, func, args, kwds):
+        with self.lock:
+            self.n_queued -= 1
+            self.n_active += 1
+        try:
+            return func(*args, **kwds)
+        finally:
+            with self.lock:
+                self.n_active -= 1
+                self.n_completed += 1
+
+    def apply_async(self, func, args=(), kwds={}):
+        with self.lock:
+            self.n_queued += 1
+        return self.pool.apply_async(self._run, (func, args, kwds))
+
+    def counts(self):
+        """
+        Returns the number of active and queued jobs, and the number
+        completed since the last call.
+        """
+        with self.lock:
+            n_completed = self.n_completed
+            self.n_completed = 0
+            return self.n_active, self.n_queued, n_completed
+
+    def close(self):
+        self.pool.close()
+
+    def join(self):
+        self.pool.join()
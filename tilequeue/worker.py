@@ -10,7 +10,6 @@ from tilequeue.process import convert_source_data_to_feature_layers
 from tilequeue.process import process_coord
 from tilequeue.queue import JobProgressException
 from tilequeue.queue.message import QueueHandle
-from tilequeue.store import write_tile_if_changed
 from tilequeue.tile import coord_children_subrange
 from tilequeue.tile import coord_to_mercator_bounds
 from tilequeue.tile import serialize_coord
@@ -210,19 +209,19 @@ class TileQueueReader(object):
                     start=now,
                 )
 
-                coords = self.msg_marshaller.unmarshall(msg_handle.payload)
+                # check for duplicate coordinates - for the message tracking to
+                # work, we assume that coordinates are unique, as we use them
+                # as keys in a dict. (plus, it doesn't make a lot of sense to
+                # render the coordinate twice in the same job anyway).
+                # note that marshallers may return a generator here.
+                coords = list(set(
+                    self.msg_marshaller.unmarshall(msg_handle.payload)))
                 # it seems unlikely, but just in case there are no coordinates
                 # in the payload, there's nothing to do, so skip to the next
                 # payload.
                 if not coords:
                     continue
 
-                # check for duplicate coordinates - for the message tracking to
-                # work, we assume that coordinates are unique, as we use them
-                # as keys in a dict. (plus, it doesn't make a lot of sense to
-                # render the coordinate twice in the same job anyway).
-                coords = list(set(coords))
-
                 parent_tile = self._parent(coords)
 
                 queue_handle = QueueHandle(queue_id, msg_handle.handle)
@@ -463,12 +462,11 @@ class ProcessAndFormatData(object):
 
 class S3Storage(object):
 
-    def __init__(self, input_queue, output_queue, io_pool, store,
+    def __init__(self, input_queue, output_queue, store_writer,
                  tile_proc_logger, metatile_size):
         self.input_queue = input_queue
         self.output_queue = output_queue
-        self.io_pool = io_pool
-        self.store = store
+        self.store_writer = store_writer
         self.tile_proc_logger = tile_proc_logger
         self.metatile_size = metatile_size
 
@@ -545,27 +543,13 @@ class S3Storage(object):
         self.tile_proc_logger.lifecycle('s3 storage stopped')
 
     def save_tiles(self, tiles):
-        async_jobs = []
-
         if self.metatile_size:
             tiles = make_metatiles(self.metatile_size, tiles)
 
-        for tile in tiles:
-
-            async_result = self.io_pool.apply_async(
-                write_tile_if_changed, (
-                    self.store,
-                    tile['tile'],
-                    # important to use the coord from the
-                    # formatted tile here, because we could have
-                    # cut children tiles that have separate zooms
-                    # too
-                    tile['coord'],
-                    tile['format'],
-                    tile['layer']))
-            async_jobs.append(async_result)
-
-        return async_jobs
+        # important to use the coord from the formatted tile here,
+        # because we could have cut children tiles that have separate
+        # zooms too
+        return self.store_writer.write_tiles(tiles)
 
 
 CoordProcessData = namedtuple(
@@ -675,3 +659,26 @@ class QueuePrint(object):
             self.tile_proc_logger.log_queue_sizes(self.queue_info)
 
         self.tile_proc_logger.lifecycle('queue printer stopped')
+
+
+class PoolStats(object):
+    """
+    Periodically emits the counts of jobs in each thread pool.
+    """
+
+    def __init__(self, interval_seconds, pools, stats_handler,
+                 tile_proc_logger, stop):
+        self.interval_seconds = interval_seconds
+        self.pools = pools
+        self.stats_handler = stats_handler
+        self.tile_proc_logger = tile_proc_logger
+        self.stop = stop
+
+    def __call__(self):
+        while not self.stop.wait(self.interval_seconds):
+            for pool_name, pool in self.pools:
+                n_active, n_queued, n_completed = pool.counts()
+                self.stats_handler.pool_counts(
+                    pool_name, n_active, n_queued, n_completed)
+
+        self.tile_proc_logger.lifecycle('pool stats stopped')